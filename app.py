@@ -1,10 +1,13 @@
 import argparse
 import configparser as cp
+import json
 import os
 import signal
+import sys
 import time
 from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from typing import Optional
 
 import dash
 import dash_bootstrap_components as dbc
@@ -15,13 +18,73 @@ import pandas as pd
 import plotly.express as px
 import psycopg2 as psyco
 import psycopg2.extensions
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output
+
+# the pipeline modules import each other by name
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_scripts")
+)
+
+import compact_frames
+import dash_profiling
+import dashboard_metrics
+import delta_engine
+import exposure_cube
+import flow_windows
+import fund_metrics
+import holders_index
+import holdings_export
+import interval_storage
+import parquet_archive
+import snapshot_store
+import sql_methods
 
 # time for thread to update database values
 UPDATE_HOUR = 11
 DATABASE_URL = os.environ["DATABASE_URL"]
+# read analytics from the parquet archive instead of psql when set
+HOLDINGS_ARCHIVE = os.environ.get("HOLDINGS_ARCHIVE")
+# leaderboard metrics from etf_daily_metrics and their column names
+LEADERBOARD_METRICS = {
+    "turnover": "Turnover",
+    "added": "Positions Added",
+    "removed": "Positions Removed",
+    "top10_weight": "Top 10 Weight",
+    "hhi": "HHI",
+}
+LEADERBOARD_SIZE = 20
+# columns of flow_windows.get_top_flows, empty when serving from the archive
+FLOW_COLUMNS = [
+    "etf",
+    "etf_name",
+    "stock",
+    "stock_name",
+    "dt",
+    "window_days",
+    "shares_change",
+    "market_val_change",
+]
+# exposure cube dimensions and their labels
+EXPOSURE_DIMENSIONS = {
+    "sector": "Sector",
+    "country": "Country",
+    "asset_class": "Asset Class",
+}
+# filter the etf table in the browser from a snapshot shipped with the page
+CLIENT_SIDE_FILTER = os.environ.get("CLIENT_SIDE_FILTER")
+# completion event published by pipeline_scheduler.py
+PIPELINE_STATE = os.environ.get("PIPELINE_STATE", "./data/pipeline_state.json")
+# where the pipeline stores holdings, the [storage] mode of config.ini
+_config = cp.ConfigParser()
+_config.read("./python_scripts/config.ini")
+STORAGE_MODE = _config.get("storage", "mode", fallback=interval_storage.ROWS)
 
 finished = False
+data_version = None
+# etf tables shipped to the browser when CLIENT_SIDE_FILTER is set
+snapshot = None
+# stock -> etfs holding it, refreshed with the top changes
+holders = holders_index.HoldersIndex()
 
 # parser = argparse.ArgumentParser("PAT or PROD server")
 # parser.add_argument(
@@ -34,6 +97,7 @@ finished = False
 # opts = parser.parse_args()
 hosts = {"PAT": "127.0.0.1", "PROD": "10.0.0.6"}
 
+
 # create function to be called on ctrl + c
 def exit_handler(signum, frame):
     global finished
@@ -46,12 +110,33 @@ def exit_handler(signum, frame):
 signal.signal(signal.SIGINT, exit_handler)
 
 
+def published_data_version() -> Optional[str]:
+    """data version of today's completed pipeline run, None if there is none"""
+    if not os.path.isfile(PIPELINE_STATE):
+        return None
+    with open(PIPELINE_STATE, "r") as f:
+        state = json.load(f)
+    finished_today = state["finished_at"][:10] == date.today().isoformat()
+    if state["status"] == "complete" and finished_today:
+        return state["data_version"]
+    return None
+
+
 def check_for_finished_pull() -> bool:
-    """check if the daily_pull.sh script has finished
+    """check if today's pipeline run has finished
+
+    Reads the completion event written by pipeline_scheduler.py, falling back
+    to the cron log of the daily_pull.sh script when there is none. The
+    dashboard's data_version is only moved on by a successful refresh.
 
     Returns:
-        bool: [True if the last line in the log file is DONE, else False]
+        bool: [True if a data version not loaded yet was published today or
+            the last line in the log file is DONE, else False]
     """
+    if os.path.isfile(PIPELINE_STATE):
+        version = published_data_version()
+        return version is not None and version != data_version
+
     with open("./bash/logs/cron.log", "r") as f:
         lines = f.readlines()
     if lines[-1].strip() == "DONE":
@@ -79,17 +164,7 @@ def connect_psql() -> psycopg2.extensions.connection:
     return conn
 
 
-# df = pd.read_sql("""SELECT * FROM etf_holdings ORDER BY dt LIMIT 100""", conn)
-def get_new_top_changes() -> int:
-    """[Update the global variable top_mv_shares_change with new data on a daily basis]
-
-    Returns:
-        int: [0 is success, else -1]
-    """
-    conn = connect_psql()
-    global top_mv_shares_change
-    top_mv_shares_change = pd.read_sql(
-        """
+TOP_CHANGES_QUERY = """
     WITH mv AS (
         SELECT
             s2.symbol AS etf,
@@ -112,11 +187,11 @@ def get_new_top_changes() -> int:
                     dt
             ) AS shares_yesterday
         FROM
-            etf_holdings
-            LEFT JOIN stocks s1 ON etf_holdings.stock_id = s1.id
-            LEFT JOIN stocks s2 ON etf_holdings.etf_id = s2.id
-        WHERE dt = (SELECT MAX(dt) FROM etf_holdings)
-        OR dt = (SELECT MAX(dt) FROM etf_holdings WHERE dt != (SELECT MAX(dt) FROM etf_holdings))
+            {holdings} h
+            LEFT JOIN stocks s1 ON h.stock_id = s1.id
+            LEFT JOIN stocks s2 ON h.etf_id = s2.id
+        WHERE dt = (SELECT MAX(dt) FROM {holdings})
+        OR dt = (SELECT MAX(dt) FROM {holdings} WHERE dt != (SELECT MAX(dt) FROM {holdings}))
     ),
     change AS (
         SELECT
@@ -130,7 +205,7 @@ def get_new_top_changes() -> int:
         FROM
             mv
         WHERE
-            dt = (SELECT MAX(dt) FROM etf_holdings)
+            dt = (SELECT MAX(dt) FROM {holdings})
         ORDER BY
             etf,
             shares_change,
@@ -163,10 +238,72 @@ def get_new_top_changes() -> int:
         etf,
         ABS(shares_change) DESC;
 
-    """,
-        conn,
+"""
+
+
+# df = pd.read_sql("""SELECT * FROM etf_holdings ORDER BY dt LIMIT 100""", conn)
+@dashboard_metrics.REFRESH_SECONDS.time()
+def get_new_top_changes(version: Optional[str] = None) -> int:
+    """[Update the global variable top_mv_shares_change with new data on a daily basis]
+
+    Args:
+        version (str, optional): data version being loaded, stamped on the
+            client side snapshot
+
+    Returns:
+        int: [0 is success, else -1]
+    """
+    global top_mv_shares_change, top_flows, leaderboard, snapshot
+    if HOLDINGS_ARCHIVE:
+        with dashboard_metrics.QUERY_SECONDS.labels("archive_top_changes").time():
+            df = parquet_archive.get_top_changes(HOLDINGS_ARCHIVE)
+        # flow windows, metrics, holders and deltas are only kept in psql
+        flows = pd.DataFrame(columns=FLOW_COLUMNS)
+        leaderboard = pd.DataFrame(
+            columns=["etf", "etf_name", "dt"] + list(LEADERBOARD_METRICS)
+        )
+    else:
+        conn = connect_psql()
+        with dashboard_metrics.QUERY_SECONDS.labels("top_changes").time():
+            df = sql_methods.read_sql_copy(
+                TOP_CHANGES_QUERY.format(
+                    holdings=interval_storage.holdings_table(STORAGE_MODE)
+                ),
+                conn,
+                parse_dates=["dt"],
+            )
+        # multi day windows are maintained by the pipeline, one lookup per window
+        with dashboard_metrics.QUERY_SECONDS.labels("top_flows").time():
+            flows = flow_windows.get_top_flows(conn)
+        with dashboard_metrics.QUERY_SECONDS.labels("leaderboard").time():
+            leaderboard = fund_metrics.get_leaderboard(conn)
+        with dashboard_metrics.QUERY_SECONDS.labels("holders_index").time():
+            indexed = holders_index.refresh_index(holders, conn, STORAGE_MODE)
+        with dashboard_metrics.QUERY_SECONDS.labels("delta_engine").time():
+            delta_engine.refresh_engine(deltas, conn)
+        conn.close()
+        print(f"Indexed holders as of {indexed}", flush=True)
+    top_flows = compact_frames.compact_holdings_frame(flows)
+
+    # categorical strings and float measures instead of objects and Decimals
+    top_mv_shares_change = compact_frames.compact_holdings_frame(df)
+    print(
+        f"Memory use: {compact_frames.memory_report(df, top_mv_shares_change)}",
+        flush=True,
     )
-    conn.close()
+
+    if CLIENT_SIDE_FILTER:
+        windows = {1: top_mv_shares_change}
+        for window in flow_windows.WINDOWS:
+            windows[window] = top_flows.loc[top_flows["window_days"] == window, :]
+        snapshot = snapshot_store.build_snapshot(
+            windows,
+            version or data_version or datetime.now().isoformat(timespec="seconds"),
+        )
+        print(snapshot_store.payload_report(snapshot, windows), flush=True)
+
+    dashboard_metrics.LAST_REFRESH.set_to_current_time()
+    dashboard_metrics.REFRESH_ROWS.set(top_mv_shares_change.shape[0])
     print(f"Data pulled at {datetime.now()}", flush=True)
     return 0
 
@@ -180,12 +317,15 @@ def get_new_top_changes_at(update_at: int = UPDATE_HOUR) -> None:
     Returns:
         [None]: [No return >> updates global variables]
     """
-    global finished
+    global finished, data_version
     while not finished:
         if datetime.now().hour == update_at:
             if check_for_finished_pull():
                 try:
-                    get_new_top_changes()
+                    version = published_data_version()
+                    get_new_top_changes(version)
+                    # a failed refresh leaves the version to be tried again
+                    data_version = version or data_version
                     print(f"Data pushed at {datetime.now()}", flush=True)
                     print("Sleeping for 1 hour...")
                     time.sleep(3_600)
@@ -210,6 +350,9 @@ def make_layout():
     Returns:
         [type]: [layout of the dash app]
     """
+    # the two latest snapshots are compared by default
+    dates = deltas.dates
+    start_date, end_date = ([None, None] + dates)[-2:]
     return html.Div(
         [
             ############################################
@@ -257,6 +400,26 @@ def make_layout():
                         width={"size": 4},
                         style={"margin-left": "1rem"},
                     ),
+                    dbc.Col(
+                        [
+                            dbc.Label("Trading Days", html_for="window-radio"),
+                            dcc.RadioItems(
+                                id="window-radio",
+                                options=[{"label": "1", "value": 1}]
+                                + [
+                                    {"label": str(window), "value": window}
+                                    for window in flow_windows.WINDOWS
+                                ],
+                                value=1,
+                                labelStyle={
+                                    "display": "inline-block",
+                                    "margin-right": "1rem",
+                                },
+                            ),
+                        ],
+                        width={"size": 4},
+                        style={"margin-left": "1rem"},
+                    ),
                 ],
                 align="center",
                 justify="start",
@@ -268,7 +431,8 @@ def make_layout():
             ############################################
             dbc.Row(
                 html.P(
-                    "The below table shows the one day change in ETF holding positions"
+                    "The below table shows the change in ETF holding positions "
+                    "over the selected number of trading days"
                 ),
                 align="center",
                 justify="start",
@@ -277,6 +441,8 @@ def make_layout():
             ############################################
             # SHOW RESULTS OF ETF SELECTION
             ############################################
+            # shipped once per page load, the etf table is filtered in the browser
+            dcc.Store(id="snapshot-store", data=snapshot),
             dbc.Row(
                 dbc.Col(
                     children=[
@@ -293,6 +459,158 @@ def make_layout():
                 align="center",
                 justify="center",
             ),
+            html.Hr(),
+            ############################################
+            # AREA TO PICK TWO DATES FOR BUYS AND SELLS
+            ############################################
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.Label(
+                                "Largest buys and sells of the selected ETF between",
+                                html_for="delta-dates",
+                            ),
+                            dcc.DatePickerRange(
+                                id="delta-dates",
+                                min_date_allowed=dates[0] if dates else None,
+                                max_date_allowed=end_date,
+                                start_date=start_date,
+                                end_date=end_date,
+                                display_format="YYYY-MM-DD",
+                            ),
+                        ],
+                        width={"size": 6},
+                        style={"margin-left": "1rem"},
+                    ),
+                ],
+                align="center",
+                justify="start",
+                no_gutters=False,
+                style={"margin-bottom": "2rem"},
+            ),
+            dbc.Row(
+                dbc.Col(
+                    children=[],
+                    id="delta-area",
+                    width={"size": "10"},
+                ),
+                align="center",
+                justify="center",
+            ),
+            html.Hr(),
+            ############################################
+            # EXPOSURE OF THE SELECTED ETF
+            ############################################
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.Label("Exposure by", html_for="exposure-radio"),
+                            dcc.RadioItems(
+                                id="exposure-radio",
+                                options=[
+                                    {"label": label, "value": value}
+                                    for value, label in EXPOSURE_DIMENSIONS.items()
+                                ],
+                                value="sector",
+                                labelStyle={
+                                    "display": "inline-block",
+                                    "margin-right": "1rem",
+                                },
+                            ),
+                        ],
+                        width={"size": 4},
+                        style={"margin-left": "1rem"},
+                    ),
+                ],
+                align="center",
+                justify="start",
+                no_gutters=False,
+                style={"margin-bottom": "2rem"},
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(dcc.Graph(id="exposure-graph"), width={"size": 5}),
+                    dbc.Col(dcc.Graph(id="rotation-graph"), width={"size": 7}),
+                ],
+                align="center",
+                justify="center",
+            ),
+            html.Hr(),
+            ############################################
+            # ETF LEADERBOARD
+            ############################################
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.Label("Rank ETFs by", html_for="leaderboard-dropdown"),
+                            dcc.Dropdown(
+                                id="leaderboard-dropdown",
+                                options=[
+                                    {"label": label, "value": value}
+                                    for value, label in LEADERBOARD_METRICS.items()
+                                ],
+                                value="turnover",
+                                clearable=False,
+                            ),
+                        ],
+                        width={"size": 4},
+                        style={"margin-left": "1rem"},
+                    ),
+                ],
+                align="center",
+                justify="start",
+                no_gutters=False,
+                style={"margin-bottom": "2rem"},
+            ),
+            dbc.Row(
+                dbc.Col(
+                    children=[],
+                    id="leaderboard-area",
+                    width={"size": "10"},
+                ),
+                align="center",
+                justify="center",
+            ),
+            html.Hr(),
+            ############################################
+            # AREA TO SEARCH FOR A STOCK
+            ############################################
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.Label("Who holds this stock?", html_for="stock-search"),
+                            dbc.Input(
+                                id="stock-search",
+                                type="text",
+                                placeholder="Stock symbol, e.g. SHOP",
+                                debounce=True,
+                            ),
+                        ],
+                        width={"size": 4},
+                        style={"margin-left": "1rem"},
+                    ),
+                ],
+                align="center",
+                justify="start",
+                no_gutters=False,
+                style={"margin-bottom": "2rem"},
+            ),
+            ############################################
+            # SHOW ETFS HOLDING THE STOCK
+            ############################################
+            dbc.Row(
+                dbc.Col(
+                    children=[],
+                    id="holders-area",
+                    width={"size": "10"},
+                ),
+                align="center",
+                justify="center",
+            ),
         ]
     )
 
@@ -302,14 +620,24 @@ app = dash.Dash(
     external_stylesheets=[dbc.themes.FLATLY],
     update_title=None,
     title="ETF Dashboard",
+    compress=True,
 )
 server = app.server
 
+# snapshots of any two dates, refreshed with the top changes
+deltas = delta_engine.DeltaEngine(connect_psql, storage_mode=STORAGE_MODE)
+dashboard_metrics.register_metrics_endpoint(server)
+dash_profiling.register_admin_endpoint(server)
+holdings_export.register_export_endpoint(
+    server, connect_psql, storage_mode=STORAGE_MODE
+)
+dash_profiling.profile_callbacks(app)
+
 # load in the data
 get_new_top_changes()
 
 # make the layout of the app
-app.layout = make_layout
+app.layout = dash_profiling.profiled("make_layout")(make_layout)
 
 # add extra thread for updating the data
 executor = ThreadPoolExecutor(max_workers=1)
@@ -319,12 +647,15 @@ future = executor.submit(get_new_top_changes_at)
 ############################################
 # HANDLING WHEN USER SELECTS ETF FOR TOP HOLDING CHANGES
 ############################################
-@app.callback(
-    [Output(component_id="table-area", component_property="children")],
-    [Input(component_id="etf-dropdown", component_property="value")],
-)
-def filter_for_etf(etf_choice):
-    dff = top_mv_shares_change.loc[top_mv_shares_change["etf"] == etf_choice, :]
+def filter_for_etf(etf_choice, window):
+    with dash_profiling.phase("filter_for_etf", "filter"):
+        if window == 1:
+            dff = top_mv_shares_change.loc[top_mv_shares_change["etf"] == etf_choice, :]
+        else:
+            dff = top_flows.loc[
+                (top_flows["etf"] == etf_choice) & (top_flows["window_days"] == window),
+                :,
+            ]
     dff = dff[
         [
             "etf",
@@ -336,6 +667,7 @@ def filter_for_etf(etf_choice):
             "dt",
         ]
     ]
+    dff = dff.assign(dt=dff["dt"].dt.date)
     dff = dff.rename(
         columns={
             "etf": "ETF Symbol",
@@ -347,7 +679,172 @@ def filter_for_etf(etf_choice):
             "market_val_change": "Change in Market Value (USD)",
         }
     )
-    return [dbc.Table.from_dataframe(dff, striped=True, bordered=True, hover=True)]
+    with dash_profiling.phase("filter_for_etf", "to_components"):
+        table = dbc.Table.from_dataframe(dff, striped=True, bordered=True, hover=True)
+    return [table]
+
+
+if CLIENT_SIDE_FILTER:
+    # assets/snapshot_filter.js, no request to the server per selection
+    app.clientside_callback(
+        ClientsideFunction(namespace="snapshot", function_name="filter_for_etf"),
+        Output(component_id="table-area", component_property="children"),
+        [
+            Input(component_id="etf-dropdown", component_property="value"),
+            Input(component_id="window-radio", component_property="value"),
+            Input(component_id="snapshot-store", component_property="data"),
+        ],
+    )
+else:
+    app.callback(
+        [Output(component_id="table-area", component_property="children")],
+        [
+            Input(component_id="etf-dropdown", component_property="value"),
+            Input(component_id="window-radio", component_property="value"),
+        ],
+    )(filter_for_etf)
+
+
+############################################
+# HANDLING WHEN USER PICKS TWO DATES FOR BUYS AND SELLS
+############################################
+@app.callback(
+    [Output(component_id="delta-area", component_property="children")],
+    [
+        Input(component_id="etf-dropdown", component_property="value"),
+        Input(component_id="delta-dates", component_property="start_date"),
+        Input(component_id="delta-dates", component_property="end_date"),
+    ],
+)
+def top_buys_and_sells(etf_choice, start_date, end_date):
+    etf_id = deltas.etf_id(etf_choice) if etf_choice else None
+    if etf_id is None or not start_date or not end_date:
+        return [[]]
+    with dash_profiling.phase("top_buys_and_sells", "delta"):
+        buys, sells = deltas.top_movers(
+            etf_id,
+            date.fromisoformat(start_date[:10]),
+            date.fromisoformat(end_date[:10]),
+        )
+
+    columns = {
+        "stock": "Stock Symbol",
+        "stock_name": "Stock Name",
+        "shares_start": "Shares Before",
+        "shares_end": "Shares After",
+        "shares_change": "Change in Shares",
+        "market_val_change": "Change in Market Value (USD)",
+    }
+    tables = []
+    with dash_profiling.phase("top_buys_and_sells", "to_components"):
+        for title, dff in [("Largest Buys", buys), ("Largest Sells", sells)]:
+            dff = dff[list(columns)].rename(columns=columns).round(2)
+            tables.append(html.H5(title))
+            tables.append(
+                dbc.Table.from_dataframe(dff, striped=True, bordered=True, hover=True)
+            )
+    return [tables]
+
+
+############################################
+# HANDLING WHEN USER PICKS AN EXPOSURE DIMENSION
+############################################
+@app.callback(
+    [
+        Output(component_id="exposure-graph", component_property="figure"),
+        Output(component_id="rotation-graph", component_property="figure"),
+    ],
+    [
+        Input(component_id="etf-dropdown", component_property="value"),
+        Input(component_id="exposure-radio", component_property="value"),
+    ],
+)
+def exposures_of_etf(etf_choice, dimension):
+    etf_id = deltas.etf_id(etf_choice) if etf_choice else None
+    if etf_id is None:
+        return [{}, {}]
+    conn = connect_psql()
+    with dashboard_metrics.QUERY_SECONDS.labels("exposures").time():
+        dff = exposure_cube.get_exposures(conn, etf_id, dimension)
+    conn.close()
+    if dff.empty:
+        return [{}, {}]
+
+    label = EXPOSURE_DIMENSIONS[dimension]
+    with dash_profiling.phase("exposures_of_etf", "to_components"):
+        latest = dff.loc[dff["dt"] == dff["dt"].max(), :]
+        breakdown = px.bar(
+            latest,
+            x="weight",
+            y="name",
+            orientation="h",
+            labels={"weight": "Weight", "name": label},
+            title=f"{etf_choice} by {label} as of {latest['dt'].iloc[0]}",
+        )
+        breakdown.update_yaxes(autorange="reversed")
+        rotation = px.area(
+            dff,
+            x="dt",
+            y="weight",
+            color="name",
+            labels={"dt": "Date", "weight": "Weight", "name": label},
+            title=f"{label} rotation of {etf_choice}",
+        )
+    return [breakdown, rotation]
+
+
+############################################
+# HANDLING WHEN USER PICKS A LEADERBOARD METRIC
+############################################
+@app.callback(
+    [Output(component_id="leaderboard-area", component_property="children")],
+    [Input(component_id="leaderboard-dropdown", component_property="value")],
+)
+def rank_etfs(metric):
+    with dash_profiling.phase("rank_etfs", "sort"):
+        dff = leaderboard.sort_values(metric, ascending=False).head(LEADERBOARD_SIZE)
+    dff = dff[["etf", "etf_name", "dt"] + list(LEADERBOARD_METRICS)]
+    dff = dff.rename(
+        columns=dict(
+            {"etf": "ETF Symbol", "etf_name": "ETF Name", "dt": "Date"},
+            **LEADERBOARD_METRICS,
+        )
+    )
+    with dash_profiling.phase("rank_etfs", "to_components"):
+        table = dbc.Table.from_dataframe(
+            dff.round(4), striped=True, bordered=True, hover=True
+        )
+    return [table]
+
+
+############################################
+# HANDLING WHEN USER SEARCHES FOR A STOCK
+############################################
+@app.callback(
+    [Output(component_id="holders-area", component_property="children")],
+    [Input(component_id="stock-search", component_property="value")],
+)
+def holders_of_stock(symbol):
+    if not symbol:
+        return [[]]
+    with dash_profiling.phase("holders_of_stock", "lookup"):
+        dff = holders.holders(symbol)
+    if dff.empty:
+        return [html.P(f"No ETF holds {symbol.upper()}")]
+    dff = dff[["etf", "etf_name", "weight", "num_shares", "shares_change", "dt"]]
+    dff = dff.rename(
+        columns={
+            "etf": "ETF Symbol",
+            "etf_name": "ETF Name",
+            "weight": "Weight",
+            "num_shares": "Shares Held",
+            "shares_change": "Change in Shares",
+            "dt": "Date",
+        }
+    )
+    with dash_profiling.phase("holders_of_stock", "to_components"):
+        table = dbc.Table.from_dataframe(dff, striped=True, bordered=True, hover=True)
+    return [table]
 
 
 app.index_string = app.index_string = """
@@ -0,0 +1,77 @@
+// ETF selection on the snapshot shipped in the snapshot-store, see
+// python_scripts/snapshot_store.py for the layout of the payload.
+(function () {
+    function element(type, children, props) {
+        return {
+            type: type,
+            namespace: "dash_html_components",
+            props: Object.assign({children: children}, props || {}),
+        };
+    }
+
+    // same markup as dbc.Table(striped=True, bordered=True, hover=True)
+    function table(headers, rows, version) {
+        var head = element("Thead", element("Tr", headers.map(function (header) {
+            return element("Th", header);
+        })));
+        var body = element("Tbody", rows.map(function (row) {
+            return element("Tr", row.map(function (value) {
+                return element("Td", value === null ? "" : String(value));
+            }));
+        }));
+        return element("Table", [head, body], {
+            className: "table table-striped table-bordered table-hover",
+            "data-version": version,
+        });
+    }
+
+    // largest absolute share change first, missing changes last, ties kept
+    // in the order they were shipped
+    function byLargestChange(changes) {
+        return function (a, b) {
+            var x = changes[a] === null ? -1 : Math.abs(changes[a]);
+            var y = changes[b] === null ? -1 : Math.abs(changes[b]);
+            return y - x || a - b;
+        };
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        snapshot: {
+            filter_for_etf: function (etfChoice, windowDays, snapshot) {
+                var headers = [
+                    "ETF Symbol",
+                    "ETF Name",
+                    "Stock Symbol",
+                    "Stock Name",
+                    "Change in Shares",
+                    "Change in Market Value (USD)",
+                    "Date Of Change",
+                ];
+                var rows = [];
+                var encoded = snapshot && snapshot.windows[String(windowDays)];
+                var range = encoded && encoded.offsets[etfChoice];
+                if (range) {
+                    var columns = encoded.columns;
+                    var dictionaries = snapshot.dictionaries;
+                    var order = [];
+                    for (var j = range[0]; j < range[1]; j++) {
+                        order.push(j);
+                    }
+                    order.sort(byLargestChange(columns.shares_change));
+                    order.forEach(function (i) {
+                        rows.push([
+                            etfChoice,
+                            dictionaries.etf_name[columns.etf_name[i]],
+                            dictionaries.stock[columns.stock[i]],
+                            dictionaries.stock_name[columns.stock_name[i]],
+                            columns.shares_change[i],
+                            columns.market_val_change[i],
+                            dictionaries.dt[columns.dt[i]],
+                        ]);
+                    });
+                }
+                return table(headers, rows, snapshot ? snapshot.version : null);
+            },
+        },
+    });
+})();
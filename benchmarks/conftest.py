@@ -0,0 +1,109 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python_scripts"
+    )
+)
+
+from synthetic_holdings import generate_symbols, write_holdings_csv
+
+# rows per holdings file, override with e.g. BENCH_SIZES=100,1000,10000
+SIZES = [int(n) for n in os.environ.get("BENCH_SIZES", "100,1000,5000").split(",")]
+# run against a real database instead of the stand-in when set
+BENCH_DATABASE_URL = os.environ.get("BENCH_DATABASE_URL")
+BENCH_SCHEMA = "etf_bench"
+UNIVERSE = 20_000
+
+
+class StandInCursor:
+    """Cursor answering stock lookups from a dict and accepting any insert"""
+
+    def __init__(self, stock_ids: dict) -> None:
+        self.stock_ids = stock_ids
+        self.rowcount = 0
+        self._result = None
+
+    def execute(self, query, params=None) -> None:
+        if "FROM stocks" in query:
+            stock_id = self.stock_ids.get(params[0])
+            self._result = None if stock_id is None else {"id": stock_id}
+        self.rowcount = 1
+
+    def fetchone(self):
+        return self._result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        return None
+
+
+class StandInConnection:
+    """Enough of a psycopg2 connection for the pipeline functions"""
+
+    def __init__(self, stock_ids: dict) -> None:
+        self.stock_ids = stock_ids
+
+    def cursor(self, cursor_factory=None) -> StandInCursor:
+        return StandInCursor(self.stock_ids)
+
+    def commit(self) -> None:
+        return None
+
+    def rollback(self) -> None:
+        return None
+
+    def close(self) -> None:
+        return None
+
+
+@pytest.fixture(scope="session")
+def symbols() -> list:
+    return generate_symbols(UNIVERSE)
+
+
+@pytest.fixture(scope="session")
+def conn(symbols):
+    """A stand-in connection, or a scratch schema on BENCH_DATABASE_URL"""
+    stock_ids = {symbol: i + 1 for i, symbol in enumerate(symbols)}
+    if BENCH_DATABASE_URL is None:
+        yield StandInConnection(stock_ids)
+        return
+
+    import psycopg2
+    import psycopg2.extras
+
+    conn = psycopg2.connect(BENCH_DATABASE_URL)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA};")
+        cursor.execute(f"SET search_path TO {BENCH_SCHEMA};")
+        with open(os.path.join(root, "sql_scripts", "create_db.sql")) as f:
+            cursor.execute(f.read())
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO stocks (id, symbol, name, exchange) VALUES %s",
+            [(i, s, f"{s} HOLDINGS INC", "BENCH") for s, i in stock_ids.items()],
+        )
+        cursor.execute(
+            "INSERT INTO stocks (id, symbol, name, exchange) "
+            "VALUES (0, 'BENCHETF', 'Benchmark ETF', 'BENCH');"
+        )
+    conn.commit()
+    yield conn
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE;")
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope="session", params=SIZES, ids=lambda n: f"{n}_rows")
+def holdings_csv(request, tmp_path_factory, symbols) -> str:
+    path = tmp_path_factory.mktemp("holdings") / f"{request.param}.csv"
+    return write_holdings_csv(str(path), n_rows=request.param, symbols=symbols)
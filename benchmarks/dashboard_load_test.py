@@ -0,0 +1,511 @@
+"""Concurrent-user load test of the dashboard
+
+Fills a scratch database on a local PostgreSQL with synthetic holdings and the
+tables derived from them, starts app.py under gunicorn as in the Procfile, and
+replays what a browser does from many virtual users: load the page, fetch the
+layout and callback graph, then pick etfs, windows, dimensions, metrics and
+stocks, sending the same _dash-update-component requests the renderer sends.
+Reports throughput and p50/p95/p99 latency per endpoint.
+
+    python benchmarks/dashboard_load_test.py postgresql://postgres@localhost/postgres \\
+        --etfs 300 --days 30 --users 50 --duration 60 --workers 1 --threads 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from os.path import abspath, dirname, join
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+import requests
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT, "python_scripts"))
+
+from load_test import create_database, populate
+from synthetic_holdings import generate_symbols
+
+# share of user actions changing each input, the etf dropdown drives most callbacks
+ACTIONS = {
+    ("etf-dropdown", "value"): 0.6,
+    ("window-radio", "value"): 0.1,
+    ("exposure-radio", "value"): 0.1,
+    ("leaderboard-dropdown", "value"): 0.05,
+    ("stock-search", "value"): 0.15,
+}
+CATEGORIES = {
+    "sector": ["Information Technology", "Financials", "Health Care", "Energy"],
+    "country": ["United States", "Canada", "Japan", "United Kingdom", "Germany"],
+    "asset_class": ["Equity", "Cash", "Futures"],
+}
+STARTUP_TIMEOUT = 600
+# seconds to wait for the users to finish their last action after the duration
+DRAIN_TIMEOUT = 300
+
+HOLDINGS_QUERY = """
+    INSERT INTO etf_holdings
+        (etf_id, stock_id, dt, num_shares, weight, market_value, average_price)
+    SELECT
+        etf_id,
+        1 + (etf_id::BIGINT * 7919 + position * 104729) %% %(universe)s,
+        dt,
+        ((etf_id + position) %% 997 + 1) * 100 * (1 + (random() - 0.5) / 10),
+        random() / %(positions)s,
+        random() * 1000000,
+        10 + random() * 100
+    FROM
+        unnest(%(etf_ids)s::INTEGER[]) etf_id,
+        generate_series(1, %(positions)s) position,
+        unnest(%(dates)s::DATE[]) dt
+    -- a few positions are missing every day, bought and sold between snapshots
+    WHERE random() > 0.03
+    ON CONFLICT DO NOTHING;
+"""
+
+EXPOSURES_QUERY = """
+    WITH categories AS (
+        SELECT
+            id,
+            dimension,
+            ROW_NUMBER() OVER (PARTITION BY dimension ORDER BY id) - 1 AS code,
+            COUNT(*) OVER (PARTITION BY dimension) AS n
+        FROM holding_categories
+    )
+    INSERT INTO etf_exposures
+        (etf_id, dt, category_id, positions, weight, market_value)
+    SELECT
+        h.etf_id,
+        h.dt,
+        c.id,
+        COUNT(*),
+        SUM(h.weight),
+        SUM(h.market_value)
+    FROM
+        etf_holdings h
+        JOIN categories c ON h.stock_id % c.n = c.code
+    GROUP BY
+        h.etf_id,
+        h.dt,
+        c.id;
+"""
+
+
+def trading_dates(days: int, end: date) -> list:
+    """The last `days` weekdays up to end"""
+    dates = []
+    dt = end
+    while len(dates) < days:
+        if dt.weekday() < 5:
+            dates.append(dt)
+        dt -= timedelta(days=1)
+    return sorted(dates)
+
+
+def fill_holdings(
+    params: dict, etf_ids: list, universe: int, positions: int, days: int, seed: int
+) -> None:
+    """Synthetic holdings of every etf and the tables the pipeline derives
+
+    Flow windows and fund metrics are built with the pipeline's own rebuild
+    functions, exposures from a fixed mapping of stocks to categories.
+    """
+    import flow_windows
+    import fund_metrics
+
+    conn = psycopg2.connect(**params)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT setseed(%s);", (random.Random(seed).uniform(-1, 1),))
+        cursor.execute(
+            HOLDINGS_QUERY,
+            {
+                "etf_ids": etf_ids,
+                "universe": universe,
+                "positions": positions,
+                "dates": trading_dates(days, date.today()),
+            },
+        )
+        cursor.execute(
+            "INSERT INTO holding_categories (dimension, name) "
+            "SELECT * FROM unnest(%s::TEXT[], %s::TEXT[]);",
+            (
+                [d for d, names in CATEGORIES.items() for _ in names],
+                [name for names in CATEGORIES.values() for name in names],
+            ),
+        )
+        cursor.execute(EXPOSURES_QUERY)
+    for etf_id in etf_ids:
+        flow_windows.seed_flow_dates(conn, etf_id)
+        flow_windows.rebuild_windows(conn, etf_id)
+        conn.commit()
+        fund_metrics.rebuild_metrics(conn, etf_id)
+    conn.commit()
+    conn.close()
+
+
+def start_server(dsn: str, port: int, workers: int, threads: int, env: dict):
+    """Start app.py under gunicorn and wait for it to serve the page"""
+    env = dict(os.environ, DATABASE_URL=dsn, **env)
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "app:server",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "--workers",
+            str(workers),
+            "--threads",
+            str(threads),
+            "--timeout",
+            "600",
+        ],
+        cwd=ROOT,
+        env=env,
+        start_new_session=True,
+    )
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {server.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/", timeout=5).ok:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    stop_server(server)
+    raise SystemExit("The dashboard did not start in time")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+
+
+def component_props(layout: dict) -> dict:
+    """(id, property) -> value of every component with an id in a layout"""
+    props = {}
+    stack = [layout]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict) and "props" in node:
+            node_props = node["props"]
+            if "id" in node_props:
+                for prop, value in node_props.items():
+                    props[(node_props["id"], prop)] = value
+            stack.extend(
+                value
+                for value in node_props.values()
+                if isinstance(value, (list, dict))
+            )
+    return props
+
+
+def split_prop(prop_id: str) -> dict:
+    component_id, prop = prop_id.rsplit(".", 1)
+    return {"id": component_id, "property": prop}
+
+
+def callback_body(dependency: dict, values: dict, changed: list) -> dict:
+    """Body of the _dash-update-component request of a callback"""
+    output = dependency["output"]
+    if output.startswith("..") and output.endswith(".."):
+        outputs = [split_prop(o) for o in output[2:-2].split("...")]
+    else:
+        outputs = split_prop(output)
+    return {
+        "output": output,
+        "outputs": outputs,
+        "inputs": [
+            dict(i, value=values.get((i["id"], i["property"])))
+            for i in dependency["inputs"]
+        ],
+        "state": [
+            dict(s, value=values.get((s["id"], s["property"])))
+            for s in dependency.get("state", [])
+        ],
+        "changedPropIds": changed,
+    }
+
+
+def choices(props: dict, symbols: list) -> dict:
+    """Values a user can pick for every input in ACTIONS"""
+    options = {
+        key: [o["value"] for o in props.get((key[0], "options"), [])] for key in ACTIONS
+    }
+    options[("stock-search", "value")] = symbols
+    return {key: values for key, values in options.items() if values}
+
+
+class VirtualUser(threading.Thread):
+    """A browser session: page load, then changing inputs with think time"""
+
+    def __init__(
+        self, base_url: str, symbols: list, think: float, stop_at: float, seed: int
+    ) -> None:
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.symbols = symbols
+        self.think = think
+        self.stop_at = stop_at
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def request(self, endpoint: str, method: str, path: str, body=None):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, json=body, timeout=60
+            )
+            ok = response.ok
+        except requests.RequestException:
+            response, ok = None, False
+        self.samples[endpoint].append(time.perf_counter() - start)
+        if not ok:
+            self.errors[endpoint] += 1
+            return None
+        return response
+
+    def fire(self, dependencies: list, values: dict, changed: list) -> None:
+        """Send every server side callback with one of the changed inputs"""
+        for dependency in dependencies:
+            inputs = {f"{i['id']}.{i['property']}" for i in dependency["inputs"]}
+            if inputs.isdisjoint(changed):
+                continue
+            body = callback_body(dependency, values, changed)
+            self.request(
+                f"callback {dependency['output'].strip('.')}",
+                "POST",
+                "/_dash-update-component",
+                body,
+            )
+
+    def run(self) -> None:
+        if self.request("page", "GET", "/") is None:
+            return None
+        layout = self.request("_dash-layout", "GET", "/_dash-layout")
+        graph = self.request("_dash-dependencies", "GET", "/_dash-dependencies")
+        if layout is None or graph is None:
+            return None
+        # clientside callbacks run in the browser
+        dependencies = [d for d in graph.json() if not d.get("clientside_function")]
+        values = component_props(layout.json())
+        options = choices(values, self.symbols)
+        # the renderer fires every callback once with the initial values
+        self.fire(dependencies, values, [f"{i}.{p}" for i, p in values])
+
+        keys = list(options)
+        weights = [ACTIONS[key] for key in keys]
+        while time.time() < self.stop_at:
+            time.sleep(self.rng.expovariate(1 / self.think) if self.think else 0)
+            key = self.rng.choices(keys, weights)[0]
+            values[key] = self.rng.choice(options[key])
+            self.fire(dependencies, values, [f"{key[0]}.{key[1]}"])
+
+
+def run_users(
+    base_url: str,
+    symbols: list,
+    users: int,
+    ramp: float,
+    think: float,
+    duration: float,
+    seed: int,
+    results,
+) -> None:
+    """Run a share of the virtual users, in its own process"""
+    stop_at = time.time() + duration
+    threads = []
+    for i in range(users):
+        user = VirtualUser(base_url, symbols, think, stop_at, seed + i)
+        user.start()
+        threads.append(user)
+        time.sleep(ramp)
+    for user in threads:
+        user.join()
+
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    for user in threads:
+        for endpoint, latencies in user.samples.items():
+            samples[endpoint].extend(latencies)
+        for endpoint, count in user.errors.items():
+            errors[endpoint] += count
+    results.put((dict(samples), dict(errors)))
+
+
+def report(samples: dict, errors: dict, duration: float) -> dict:
+    """Throughput and latency percentiles of every endpoint, in ms"""
+    endpoints = {}
+    for endpoint, latencies in sorted(samples.items()):
+        ms = np.array(latencies) * 1000
+        p50, p95, p99 = (float(p) for p in np.percentile(ms, [50, 95, 99]))
+        endpoints[endpoint] = {
+            "requests": len(ms),
+            "errors": errors.get(endpoint, 0),
+            "per_sec": round(len(ms) / duration, 2),
+            "p50_ms": round(p50, 1),
+            "p95_ms": round(p95, 1),
+            "p99_ms": round(p99, 1),
+            "max_ms": round(float(ms.max()), 1),
+        }
+    total = sum(values["requests"] for values in endpoints.values())
+    return {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "per_sec": round(total / duration, 2),
+        "endpoints": endpoints,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load test the dashboard with concurrent virtual users"
+    )
+    parser.add_argument("database_url", help="admin url of a local PostgreSQL")
+    parser.add_argument(
+        "--dbname", default="etf_load_dashboard", help="scratch database"
+    )
+    parser.add_argument(
+        "--reuse", action="store_true", help="keep the data of a previous run"
+    )
+    parser.add_argument("--etfs", type=int, default=300, help="number of etfs")
+    parser.add_argument("--positions", type=int, default=500, help="per etf")
+    parser.add_argument("--days", type=int, default=30, help="trading days of holdings")
+    parser.add_argument("--universe", type=int, default=20_000, help="symbols")
+    parser.add_argument("--users", type=int, default=50, help="virtual users")
+    parser.add_argument(
+        "--processes", type=int, default=4, help="client processes running the users"
+    )
+    parser.add_argument(
+        "--ramp-seconds", type=float, default=10.0, help="time to start every user"
+    )
+    parser.add_argument(
+        "--think-ms", type=float, default=1000.0, help="mean pause between actions"
+    )
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=1, help="per gunicorn worker")
+    parser.add_argument(
+        "--client-side-filter",
+        action="store_true",
+        help="start the app with CLIENT_SIDE_FILTER set",
+    )
+    parser.add_argument("--report", default=None, help="also write the report here")
+    parser.add_argument("--seed", type=int, default=0)
+    opts = parser.parse_args()
+
+    symbols = generate_symbols(opts.universe, opts.seed)
+    etf_ids = list(range(opts.universe + 1, opts.universe + opts.etfs + 1))
+    params = psycopg2.extensions.parse_dsn(opts.database_url)
+    params["dbname"] = opts.dbname
+    if not opts.reuse:
+        print(f"Creating database {opts.dbname}...", flush=True)
+        params = create_database(opts.database_url, opts.dbname)
+        populate(params, symbols, {etf_id: "" for etf_id in etf_ids})
+        print(
+            f"Filling {opts.days} days of {opts.positions} positions "
+            f"for {opts.etfs} etfs...",
+            flush=True,
+        )
+        fill_holdings(
+            params, etf_ids, opts.universe, opts.positions, opts.days, opts.seed
+        )
+
+    print(
+        f"Starting the dashboard with {opts.workers} workers "
+        f"of {opts.threads} threads...",
+        flush=True,
+    )
+    env = {"CLIENT_SIDE_FILTER": "1"} if opts.client_side_filter else {}
+    server = start_server(
+        psycopg2.extensions.make_dsn(**params),
+        opts.port,
+        opts.workers,
+        opts.threads,
+        env,
+    )
+
+    print(f"Running {opts.users} users for {opts.duration:.0f}s...", flush=True)
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = []
+    for i in range(opts.processes):
+        users = opts.users // opts.processes + (i < opts.users % opts.processes)
+        if not users:
+            continue
+        process = ctx.Process(
+            target=run_users,
+            args=(
+                f"http://127.0.0.1:{opts.port}",
+                symbols,
+                users,
+                opts.ramp_seconds / max(opts.users, 1) * opts.processes,
+                opts.think_ms / 1000,
+                opts.duration,
+                opts.seed + i * opts.users,
+                results,
+            ),
+        )
+        process.start()
+        processes.append(process)
+
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    try:
+        # read before joining, a process does not exit with data left on the queue
+        for _ in processes:
+            process_samples, process_errors = results.get(
+                timeout=opts.duration + opts.ramp_seconds + DRAIN_TIMEOUT
+            )
+            for endpoint, latencies in process_samples.items():
+                samples[endpoint].extend(latencies)
+            for endpoint, count in process_errors.items():
+                errors[endpoint] += count
+        for process in processes:
+            process.join()
+    finally:
+        stop_server(server)
+
+    result = report(samples, errors, opts.duration)
+    result["config"] = dict(vars(opts), date=date.today().isoformat())
+
+    print(
+        f"\n{'endpoint':<44}{'requests':>10}{'errors':>8}{'req/s':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    for endpoint, values in result["endpoints"].items():
+        print(
+            f"{endpoint:<44}{values['requests']:>10}{values['errors']:>8}"
+            f"{values['per_sec']:>9.1f}{values['p50_ms']:>9.1f}"
+            f"{values['p95_ms']:>9.1f}{values['p99_ms']:>9.1f}"
+        )
+    print(
+        f"\n{result['requests']:,} requests, {result['errors']} errors, "
+        f"{result['per_sec']:.1f} req/s with {opts.users} users"
+    )
+
+    if opts.report:
+        with open(opts.report, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""End-to-end load test of the daily pull against a local BlackRock stand-in
+
+Generates holdings files for many etfs, serves them from a local HTTP server
+with configurable latency and error rate, points the real download -> clean
+-> load pipeline at the server and a scratch database on a local PostgreSQL,
+and reports wall time, peak RSS and per-stage throughput.
+
+    python benchmarks/load_test.py postgresql://postgres@localhost/postgres \\
+        --etfs 1500 --rows 200,5000 --latency-ms 50 --error-rate 0.01
+"""
+
+import argparse
+import configparser as cp
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from datetime import date
+from os.path import abspath, dirname, join
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.append(join(ROOT, "python_scripts"))
+
+from synthetic_holdings import generate_symbols, write_holdings_csv
+
+# blackrock regions the etfs are spread over, as url prefixes
+REGIONS = ["ca", "us", "uk", "de", "ch", "nl", "au", "jp", "hk", "sg", "mx", "cl"]
+PIPELINES = ("daily_pull", "scheduler")
+
+
+class StandInHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the generated files after a delay, failing some requests"""
+
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+
+    def do_GET(self):
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if random.random() < self.error_rate:
+            self.send_error(503, "Injected error")
+            return None
+        return super().do_GET()
+
+    def log_message(self, format, *args):
+        return None
+
+
+def serve(directory: str, port: int, latency: float, jitter: float, error_rate: float):
+    """Run the stand-in server, in its own process"""
+    StandInHandler.latency = latency
+    StandInHandler.jitter = jitter
+    StandInHandler.error_rate = error_rate
+
+    def handler(*args, **kwargs):
+        return StandInHandler(*args, directory=directory, **kwargs)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.serve_forever()
+
+
+def create_database(admin_url: str, dbname: str) -> dict:
+    """Create a fresh scratch database with the etf schema
+
+    Returns:
+        dict: connection parameters of the new database
+    """
+    if not dbname.startswith("etf_load"):
+        raise ValueError("The scratch database name must start with etf_load")
+    admin = psycopg2.connect(admin_url)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {dbname};")
+        cursor.execute(f"CREATE DATABASE {dbname};")
+    admin.close()
+
+    params = psycopg2.extensions.parse_dsn(admin_url)
+    params["dbname"] = dbname
+    conn = psycopg2.connect(**params)
+    with conn.cursor() as cursor, open(join(ROOT, "sql_scripts", "create_db.sql")) as f:
+        cursor.execute(f.read())
+    conn.commit()
+    conn.close()
+    return params
+
+
+def populate(params: dict, symbols: list, etf_urls: dict) -> None:
+    """Fill stocks with the symbol universe and the etfs, and etf_urls"""
+    conn = psycopg2.connect(**params)
+    first_etf = len(symbols) + 1
+    with conn.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO stocks (id, symbol, name, exchange) VALUES %s",
+            [(i + 1, s, f"{s} HOLDINGS INC", "LOAD") for i, s in enumerate(symbols)]
+            + [
+                (etf_id, f"ETF{etf_id}", f"iShares Load Test ETF {etf_id}", "LOAD")
+                for etf_id in etf_urls
+            ],
+        )
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence('stocks', 'id'), %s);",
+            (first_etf + len(etf_urls),),
+        )
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO etf_urls (etf_id, csv_url, base_url) VALUES %s",
+            [(etf_id, url, url) for etf_id, url in etf_urls.items()],
+        )
+    conn.commit()
+    conn.close()
+
+
+def generate_files(
+    srv_path: str,
+    n_etfs: int,
+    rows: tuple,
+    symbols: list,
+    first_id: int,
+    port: int,
+    seed: int,
+) -> dict:
+    """Write a holdings file per etf under srv_path/<region>/<etf_id>.csv
+
+    Returns:
+        dict: etf id -> url of its file on the stand-in server
+    """
+    rng = np.random.default_rng(seed)
+    etf_urls = {}
+    for i in range(n_etfs):
+        etf_id = first_id + i
+        region = REGIONS[i % len(REGIONS)]
+        os.makedirs(join(srv_path, region), exist_ok=True)
+        write_holdings_csv(
+            join(srv_path, region, f"{etf_id}.csv"),
+            n_rows=int(rng.integers(rows[0], rows[1] + 1)),
+            fund_name=f"iShares Load Test ETF {etf_id}",
+            symbols=symbols,
+            seed=seed + etf_id,
+        )
+        etf_urls[etf_id] = f"http://127.0.0.1:{port}/{region}/{etf_id}.csv"
+    return etf_urls
+
+
+def write_config(work_path: str, params: dict) -> None:
+    """config.ini, directories and ignore list the pipeline expects, in work_path"""
+    for path in ["python_scripts/log", "data/temp", "data/manifests"]:
+        os.makedirs(join(work_path, path), exist_ok=True)
+    with open(join(work_path, "data", "ignore_non_equity_tickers.csv"), "w") as f:
+        f.write("etf_id,symbol\n")
+
+    config = cp.ConfigParser()
+    config["psql"] = {
+        "host": params.get("host", "localhost"),
+        "dbname": params["dbname"],
+        "user": params.get("user", ""),
+        "password": params.get("password", ""),
+    }
+    config["metrics"] = {
+        "json_path": "./metrics.json",
+        "textfile_path": "./metrics.prom",
+    }
+    config["archive"] = {"path": "./data/holdings_parquet"}
+    with open(join(work_path, "python_scripts", "config.ini"), "w") as f:
+        config.write(f)
+
+
+def run_pipeline(work_path: str, pipeline: str, port: str) -> None:
+    """Run the real pipeline from work_path, in its own process"""
+    os.chdir(work_path)
+    if port:
+        # the pipeline connects without a port, libpq falls back to PGPORT
+        os.environ["PGPORT"] = port
+
+    if pipeline == "scheduler":
+        import pipeline_scheduler
+
+        config = cp.ConfigParser()
+        config.read("./python_scripts/config.ini")
+        pipeline_scheduler.run_pipeline(config)
+    else:
+        import daily_pull
+
+        daily_pull.main()
+
+
+def report(summary: dict, wall_seconds: float, peak_rss_kib: int) -> dict:
+    """Per stage throughput from the run's metrics summary
+
+    Stage rates are in rows read from the files, which pass through every stage.
+    """
+    counters = summary["counters"]
+    rows = counters.get("rows_read", 0)
+    loaded = counters.get("rows_loaded", 0)
+    mib = counters.get("bytes_downloaded", 0) / 1024**2
+    stages = {}
+    for stage, values in summary["stages"].items():
+        seconds = values["seconds"]
+        stages[stage] = {
+            "seconds": round(seconds, 3),
+            "calls": values["calls"],
+            "rows_per_sec": round(rows / seconds) if seconds else None,
+        }
+        if stage.startswith("download"):
+            stages[stage]["mib_per_sec"] = round(mib / seconds, 2) if seconds else None
+
+    return {
+        "wall_seconds": round(wall_seconds, 2),
+        "peak_rss_mib": round(peak_rss_kib / 1024, 1),
+        "rows_read": rows,
+        "rows_loaded": loaded,
+        "rows_per_sec": round(loaded / wall_seconds),
+        "mib_downloaded": round(mib, 1),
+        "counters": counters,
+        "stages": stages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load test the daily pull against a local BlackRock stand-in"
+    )
+    parser.add_argument("database_url", help="admin url of a local PostgreSQL")
+    parser.add_argument("--dbname", default="etf_load_test", help="scratch database")
+    parser.add_argument("--etfs", type=int, default=150, help="number of etfs")
+    parser.add_argument(
+        "--rows", default="200,2000", help="min,max holdings per etf file"
+    )
+    parser.add_argument("--universe", type=int, default=20_000, help="symbols")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--pipeline", choices=PIPELINES, default="daily_pull")
+    parser.add_argument("--work-path", default="./load_test", help="scratch directory")
+    parser.add_argument("--report", default=None, help="also write the report here")
+    parser.add_argument("--seed", type=int, default=0)
+    opts = parser.parse_args()
+
+    rows = tuple(int(n) for n in opts.rows.split(","))
+    if len(rows) == 1:
+        rows = (rows[0], rows[0])
+    work_path = abspath(opts.work_path)
+    srv_path = join(work_path, "srv")
+
+    print(f"Generating {opts.etfs} files of {rows[0]}-{rows[1]} rows...", flush=True)
+    symbols = generate_symbols(opts.universe, opts.seed)
+    etf_urls = generate_files(
+        srv_path, opts.etfs, rows, symbols, opts.universe + 1, opts.port, opts.seed
+    )
+
+    print(f"Creating database {opts.dbname}...", flush=True)
+    params = create_database(opts.database_url, opts.dbname)
+    populate(params, symbols, etf_urls)
+    write_config(work_path, params)
+
+    # separate processes keep generation and serving out of the pipeline's RSS
+    ctx = multiprocessing.get_context("spawn")
+    server = ctx.Process(
+        target=serve,
+        args=(
+            srv_path,
+            opts.port,
+            opts.latency_ms / 1000,
+            opts.jitter_ms / 1000,
+            opts.error_rate,
+        ),
+        daemon=True,
+    )
+    server.start()
+    time.sleep(1)
+
+    print(f"Running {opts.pipeline}...", flush=True)
+    pipeline = ctx.Process(
+        target=run_pipeline,
+        args=(work_path, opts.pipeline, str(params.get("port", ""))),
+    )
+    start = time.perf_counter()
+    pipeline.start()
+    pipeline.join()
+    wall_seconds = time.perf_counter() - start
+    # the pipeline is the only child waited for so far
+    peak_rss_kib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    server.terminate()
+
+    if pipeline.exitcode != 0:
+        raise SystemExit(f"{opts.pipeline} exited with {pipeline.exitcode}")
+
+    with open(join(work_path, "metrics.json")) as f:
+        result = report(json.load(f), wall_seconds, peak_rss_kib)
+    result["config"] = dict(vars(opts), rows=rows, date=date.today().isoformat())
+
+    print(f"\n{'stage':<28}{'seconds':>10}{'calls':>8}{'rows/s':>12}")
+    for stage, values in sorted(
+        result["stages"].items(), key=lambda item: -item[1]["seconds"]
+    ):
+        print(
+            f"{stage:<28}{values['seconds']:>10.2f}{values['calls']:>8}"
+            f"{values['rows_per_sec'] or 0:>12,}"
+        )
+    print(
+        f"\nwall {result['wall_seconds']}s, peak RSS {result['peak_rss_mib']} MiB, "
+        f"{result['rows_loaded']:,.0f} rows loaded ({result['rows_per_sec']:,}/s), "
+        f"{result['mib_downloaded']} MiB downloaded"
+    )
+    print(f"counters: {result['counters']}")
+
+    if opts.report:
+        with open(opts.report, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Timings of the daily_pull hot path
+
+Run with `python -m pytest benchmarks --benchmark-autosave` and compare runs
+with `--benchmark-compare`. Set BENCH_DATABASE_URL to time the database
+functions against a real PostgreSQL instead of the in-memory stand-in.
+"""
+
+from csv_cleaning import (
+    append_stock_ids,
+    clean_blackrock_csv,
+    groupby_and_convert_types,
+)
+from sql_methods import insert_into_sql
+
+ETF_ID = "0"
+INSERT_COLS = [
+    "etf_id",
+    "stock_id",
+    "dt",
+    "num_shares",
+    "weight",
+    "market_value",
+    "average_price",
+]
+
+
+def test_clean_blackrock_csv(benchmark, holdings_csv):
+    df = benchmark(clean_blackrock_csv, holdings_csv)
+    assert df.shape[0] > 0
+
+
+def test_append_stock_ids(benchmark, holdings_csv, conn):
+    df = clean_blackrock_csv(holdings_csv)
+    result = benchmark(lambda: append_stock_ids(df.copy(), conn, ETF_ID))
+    assert result["stock_id"].notna().any()
+
+
+def test_groupby_and_convert_types(benchmark, holdings_csv, conn):
+    df = append_stock_ids(clean_blackrock_csv(holdings_csv), conn, ETF_ID)
+    result = benchmark(lambda: groupby_and_convert_types(df.copy()))
+    assert result.shape[0] > 0
+
+
+def test_insert_into_sql(benchmark, holdings_csv, conn):
+    df = groupby_and_convert_types(
+        append_stock_ids(clean_blackrock_csv(holdings_csv), conn, ETF_ID)
+    )
+
+    def clear_holdings():
+        if hasattr(conn, "server_version"):
+            with conn.cursor() as cursor:
+                cursor.execute("TRUNCATE etf_holdings;")
+            conn.commit()
+
+    rows = benchmark.pedantic(
+        insert_into_sql,
+        args=("etf_holdings", df, conn, INSERT_COLS),
+        setup=clear_holdings,
+        rounds=5,
+    )
+    assert rows == df.shape[0]
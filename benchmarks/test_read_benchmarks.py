@@ -0,0 +1,99 @@
+"""Timings of reading holdings back out of PostgreSQL
+
+pd.read_sql against read_sql_copy, whole and in chunks. Needs a real
+database, run with BENCH_DATABASE_URL set, and records the peak memory
+traced during a read next to the timings.
+"""
+
+import tracemalloc
+
+import pandas as pd
+import pytest
+
+from sql_methods import read_sql_copy
+
+# days of holdings of every etf read back, 500 positions each
+BENCH_ETFS = 20
+BENCH_DAYS = 60
+BENCH_POSITIONS = 500
+CHUNKSIZE = 50_000
+
+READ_QUERY = """
+    SELECT
+        s.symbol,
+        s.name,
+        h.etf_id,
+        h.dt,
+        h.num_shares,
+        h.weight,
+        h.market_value
+    FROM
+        etf_holdings h
+        JOIN stocks s ON h.stock_id = s.id
+    WHERE
+        h.dt >= %(start)s;
+"""
+PARAMS = {"start": "2021-01-01"}
+
+
+@pytest.fixture(scope="module")
+def holdings_table(conn):
+    if not hasattr(conn, "server_version"):
+        pytest.skip("reads need BENCH_DATABASE_URL")
+    with conn.cursor() as cursor:
+        cursor.execute("TRUNCATE etf_holdings;")
+        cursor.execute(
+            """
+            INSERT INTO etf_holdings
+                (etf_id, stock_id, dt, num_shares, weight, market_value)
+            SELECT
+                etf_id,
+                stock_id,
+                DATE '2021-01-01' + day,
+                (random() * 100000)::BIGINT,
+                random() / 100,
+                (random() * 1000000)::NUMERIC(16, 2)
+            FROM
+                generate_series(1, %s) etf_id,
+                generate_series(1, %s) stock_id,
+                generate_series(0, %s) day;
+            """,
+            (BENCH_ETFS, BENCH_POSITIONS, BENCH_DAYS - 1),
+        )
+    conn.commit()
+    yield BENCH_ETFS * BENCH_POSITIONS * BENCH_DAYS
+    with conn.cursor() as cursor:
+        cursor.execute("TRUNCATE etf_holdings;")
+    conn.commit()
+
+
+def traced(benchmark, read):
+    """Benchmark read and record the peak memory of one extra call"""
+    rows = benchmark(read)
+    tracemalloc.start()
+    read()
+    benchmark.extra_info["peak_mib"] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return rows
+
+
+def test_read_sql(benchmark, conn, holdings_table):
+    rows = traced(benchmark, lambda: len(pd.read_sql(READ_QUERY, conn, params=PARAMS)))
+    assert rows == holdings_table
+
+
+def test_read_sql_copy(benchmark, conn, holdings_table):
+    rows = traced(
+        benchmark,
+        lambda: len(read_sql_copy(READ_QUERY, conn, params=PARAMS, parse_dates=["dt"])),
+    )
+    assert rows == holdings_table
+
+
+def test_read_sql_copy_chunks(benchmark, conn, holdings_table):
+    def read():
+        chunks = read_sql_copy(READ_QUERY, conn, params=PARAMS, chunksize=CHUNKSIZE)
+        return sum(len(chunk) for chunk in chunks)
+
+    rows = traced(benchmark, read)
+    assert rows == holdings_table
@@ -0,0 +1,20 @@
+import hmac
+import os
+
+import flask
+
+# shared secret of the admin endpoints, they refuse every request without it
+ADMIN_TOKEN = os.environ.get("DASH_ADMIN_TOKEN")
+
+
+def require_admin_token() -> None:
+    """Abort with 403 unless the request carries the DASH_ADMIN_TOKEN value
+
+    The token is read from the X-Admin-Token header. Without DASH_ADMIN_TOKEN
+    every request is refused.
+    """
+    token = flask.request.headers.get("X-Admin-Token", "")
+    if ADMIN_TOKEN is None or not hmac.compare_digest(
+        token.encode(), ADMIN_TOKEN.encode()
+    ):
+        flask.abort(403)
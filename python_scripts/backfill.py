@@ -0,0 +1,402 @@
+import argparse
+import configparser as cp
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+from os.path import basename, dirname, isdir, join
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import psycopg2
+
+import exposure_cube
+import flow_windows
+import fund_metrics
+import interval_storage
+import log_setup
+from csv_cleaning import (
+    append_stock_ids,
+    clean_blackrock_csv,
+    exposure_rows,
+    groupby_and_convert_types,
+    load_stock_ids,
+    read_as_of_date,
+    read_ignore_ids,
+)
+from daily_pull import HOLDINGS_COLS
+from parquet_archive import ARCHIVE_PATH, export_holdings_to_parquet
+from sql_methods import replace_holdings
+
+DATE_DIR_PATTERN = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+# state kept by each worker process
+_worker_conn = None
+_worker_stock_ids = None
+_worker_storage_mode = interval_storage.ROWS
+
+
+def read_config(config_path: str = "./python_scripts/config.ini") -> cp.ConfigParser:
+    """Read config.ini"""
+    config = cp.ConfigParser()
+    config.read(config_path)
+    return config
+
+
+def psql_connect(config_path: str = "./python_scripts/config.ini"):
+    """Connect to the database described in config.ini"""
+    config = read_config(config_path)
+    return psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+
+
+def member_path(extract_dir: str, name: str) -> str:
+    """Path an archive member extracts to, ValueError if it is outside extract_dir"""
+    root = os.path.realpath(extract_dir)
+    path = os.path.realpath(join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Archive member {name} extracts outside {extract_dir}")
+    return path
+
+
+def extract_tar(archive: tarfile.TarFile, extract_dir: str) -> None:
+    """Extract regular files and directories only, inside extract_dir"""
+    if hasattr(tarfile, "data_filter"):
+        archive.extractall(extract_dir, filter="data")
+        return None
+    members = []
+    for member in archive.getmembers():
+        member_path(extract_dir, member.name)
+        if member.isfile() or member.isdir():
+            members.append(member)
+    archive.extractall(extract_dir, members=members)
+
+
+def find_holdings_files(source: str, extract_dir: str) -> list:
+    """List the raw holdings csvs in a directory or archive
+
+    Archives (.zip, .tar, .tar.gz) are extracted into extract_dir first, an
+    archive with a member outside extract_dir raises ValueError.
+    Files are expected to be named <etf_id>.csv as written by download_csv.
+
+    Args:
+        source (str): directory or archive of raw holdings files
+        extract_dir (str): scratch directory for archive contents
+
+    Returns:
+        list: paths of every csv found
+    """
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in archive.namelist():
+                member_path(extract_dir, name)
+            archive.extractall(extract_dir)
+        source = extract_dir
+    elif not isdir(source) and tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            extract_tar(archive, extract_dir)
+        source = extract_dir
+
+    files = []
+    for root, _, names in os.walk(source):
+        for name in names:
+            if name.lower().endswith(".csv"):
+                files.append(join(root, name))
+    return sorted(files)
+
+
+def file_as_of_date(csv_path: str):
+    """As-of date of a raw file, from its preamble or a YYYY-MM-DD parent folder"""
+    as_of = read_as_of_date(csv_path)
+    if as_of is None:
+        match = DATE_DIR_PATTERN.search(dirname(csv_path))
+        if match:
+            as_of = datetime.strptime(match.group(1), "%Y-%m-%d").date()
+    return as_of
+
+
+def init_worker(config_path: str, log_queue: Optional[Any] = None) -> None:
+    """Open one connection and stock id map per worker process"""
+    global _worker_conn, _worker_stock_ids, _worker_storage_mode
+    if log_queue is not None:
+        log_setup.use_queue(log_queue)
+    _worker_conn = psql_connect(config_path)
+    _worker_stock_ids = load_stock_ids(_worker_conn)
+    _worker_storage_mode = read_config(config_path).get(
+        "storage", "mode", fallback=interval_storage.ROWS
+    )
+
+
+def apply_snapshots(
+    conn: psycopg2.extensions.connection, etf_id: str, snapshots: List[pd.DataFrame]
+) -> None:
+    """Record backfilled snapshots of one etf as position intervals
+
+    Snapshots must be applied in date order, so when the earliest one is older
+    than the etf's latest stored snapshot the etf is rewound to it and the
+    stored snapshots from then on are applied again between the new ones.
+    Runs in the caller's transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (str): id of the etf
+        snapshots (List[pd.DataFrame]): cleaned holdings, one frame per date
+    """
+    if not snapshots:
+        return None
+    new = {pd.to_datetime(df["dt"].iloc[0]).date(): df for df in snapshots}
+    undone = interval_storage.rewind(conn, etf_id, min(new))
+    for dt, stored in undone.groupby("dt"):
+        new.setdefault(pd.to_datetime(dt).date(), stored)
+    for dt in sorted(new):
+        interval_storage.apply_snapshot(conn, new[dt], commit=False)
+
+
+def process_etf_files(etf_id: str, csv_paths: List[str]) -> List[tuple]:
+    """Clean the raw files of one etf and replace their dates in the stored
+    holdings and etf_exposures
+
+    The files are written in one transaction, in date order, as the intervals
+    storage mode needs. A file that fails to clean is skipped, a failed write
+    fails every file of the etf.
+
+    Args:
+        etf_id (str): id of the etf
+        csv_paths (List[str]): paths to its raw holdings csvs, named <etf_id>.csv
+
+    Returns:
+        List[tuple]: (csv_path, etf_id, as-of date, rows loaded, error message)
+            for every file
+    """
+    results = []
+    prepared = []
+    for csv_path in csv_paths:
+        as_of = file_as_of_date(csv_path)
+        if as_of is None:
+            results.append((csv_path, etf_id, None, 0, "no as-of date found"))
+            continue
+        try:
+            df = append_stock_ids(
+                clean_blackrock_csv(csv_path, as_of=as_of),
+                _worker_conn,
+                etf_id,
+                stock_ids=_worker_stock_ids,
+            )
+            exposures = exposure_rows(df)
+            df = groupby_and_convert_types(df)
+        except Exception as e:
+            results.append((csv_path, etf_id, as_of, 0, str(e)))
+            continue
+        prepared.append((as_of, csv_path, df, exposures))
+    prepared.sort(key=lambda file: file[:2])
+
+    # holdings and exposures are replaced together or not at all
+    try:
+        if _worker_storage_mode in (interval_storage.ROWS, interval_storage.BOTH):
+            for _, _, df, _ in prepared:
+                replace_holdings(df, _worker_conn, HOLDINGS_COLS, commit=False)
+        if _worker_storage_mode in (interval_storage.INTERVALS, interval_storage.BOTH):
+            apply_snapshots(
+                _worker_conn, etf_id, [df for _, _, df, _ in prepared if not df.empty]
+            )
+        for _, _, _, exposures in prepared:
+            exposure_cube.update_exposures(_worker_conn, exposures, commit=False)
+        _worker_conn.commit()
+    except Exception as e:
+        _worker_conn.rollback()
+        return results + [
+            (csv_path, etf_id, as_of, 0, str(e)) for as_of, csv_path, _, _ in prepared
+        ]
+
+    return results + [
+        (csv_path, etf_id, as_of, df.shape[0], None)
+        for as_of, csv_path, df, _ in prepared
+    ]
+
+
+def export_parquet(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    loaded: Dict[int, List[date]],
+) -> None:
+    """Export the backfilled dates to the parquet archive again"""
+    dates = sorted({dt for etf_dates in loaded.values() for dt in etf_dates})
+    export_holdings_to_parquet(
+        conn,
+        config.get("archive", "path", fallback=ARCHIVE_PATH),
+        dates=dates,
+        storage_mode=config.get("storage", "mode", fallback=interval_storage.ROWS),
+    )
+
+
+def rebuild_flows(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    loaded: Dict[int, List[date]],
+) -> None:
+    """Add the backfilled dates to etf_flow_dates and rebuild the flow windows"""
+    logger = logging.getLogger(__name__ + ".rebuild_flows")
+
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    for etf_id in loaded:
+        try:
+            flow_windows.seed_flow_dates(conn, etf_id, storage_mode)
+            flow_windows.rebuild_windows(conn, etf_id, storage_mode=storage_mode)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"Flow windows of ETF {etf_id} not rebuilt: {e}")
+
+
+def rebuild_metrics(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    loaded: Dict[int, List[date]],
+) -> None:
+    """Recompute the fund metrics of every snapshot of the backfilled etfs"""
+    logger = logging.getLogger(__name__ + ".rebuild_metrics")
+
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    for etf_id in loaded:
+        try:
+            fund_metrics.rebuild_metrics(conn, etf_id, storage_mode)
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"Fund metrics of ETF {etf_id} not rebuilt: {e}")
+
+
+# daily_pull.DERIVE_STEPS roll each etf forward by the one date of the run
+# manifest, a backfill rewrites many and older dates so the same steps rebuild
+# over the backfilled etfs and dates instead
+DERIVE_STEPS = [
+    ("parquet_export", export_parquet),
+    ("flow_windows", rebuild_flows),
+    ("fund_metrics", rebuild_metrics),
+]
+
+
+def backfill(
+    source: str,
+    workers: int = os.cpu_count(),
+    config_path: str = "./python_scripts/config.ini",
+    log_queue: Optional[Any] = None,
+) -> dict:
+    """Reprocess a directory or archive of raw holdings files in parallel
+
+    Every file is stamped with its own as-of date and loaded idempotently, so
+    a backfill can be rerun after changing the cleaning logic. The files of an
+    etf go to one worker. Once they are loaded the parquet archive, flow
+    windows and fund metrics are brought up to date for the backfilled dates.
+
+    Args:
+        source (str): directory or archive of raw holdings files
+        workers (int): number of worker processes
+        config_path (str): config.ini with the psql credentials
+        log_queue (optional): multiprocessing.Queue of the parent's log listener,
+            for the records of the workers
+
+    Returns:
+        dict: counts of loaded, failed and skipped files and rows
+    """
+    logger = logging.getLogger(__name__ + ".backfill")
+
+    ignore_id = read_ignore_ids()
+    extract_dir = tempfile.mkdtemp(prefix="etf_backfill_")
+    summary = {"files": 0, "loaded": 0, "failed": 0, "skipped": 0, "rows": 0}
+
+    try:
+        files = find_holdings_files(source, extract_dir)
+        todo = [f for f in files if basename(f).split(".")[0] not in ignore_id]
+        summary["files"] = len(files)
+        summary["skipped"] = len(files) - len(todo)
+        logger.info(f"Backfilling {len(todo)} files with {workers} workers...")
+
+        by_etf = defaultdict(list)
+        for f in todo:
+            by_etf[basename(f).split(".")[0]].append(f)
+
+        loaded = defaultdict(list)
+        start = time.perf_counter()
+        i = 0
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(config_path, log_queue),
+        ) as executor:
+            futures = [
+                executor.submit(process_etf_files, etf_id, paths)
+                for etf_id, paths in by_etf.items()
+            ]
+            for future in as_completed(futures):
+                for csv_path, etf_id, as_of, rows, error in future.result():
+                    i += 1
+                    if error is None:
+                        summary["loaded"] += 1
+                        summary["rows"] += rows
+                        loaded[int(etf_id)].append(as_of)
+                    else:
+                        summary["failed"] += 1
+                        logger.warning(
+                            f"ETF {etf_id} ({csv_path}) unsuccessful: {error}"
+                        )
+
+                    elapsed = time.perf_counter() - start
+                    logger.info(
+                        f"[{i}/{len(todo)}] ETF {etf_id} {as_of}: {rows} rows | "
+                        f"{summary['rows'] / elapsed:,.0f} rows/sec"
+                    )
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+    if loaded:
+        config = read_config(config_path)
+        conn = psql_connect(config_path)
+        for name, step in DERIVE_STEPS:
+            logger.info(f"Running {name}...")
+            try:
+                step(conn, config, loaded)
+            except Exception as e:
+                logger.warning(f"{name} unsuccessful: {e}")
+        conn.close()
+
+    logger.info(f"Backfill finished: {summary}")
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Reprocess raw blackrock holdings files into etf_holdings"
+    )
+    parser.add_argument("source", help="directory or archive of raw holdings csvs")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument(
+        "--config", default="./python_scripts/config.ini", help="path to config.ini"
+    )
+    opts = parser.parse_args()
+
+    # shared with the worker processes
+    log_queue = multiprocessing.Queue()
+    log_setup.setup_logging("./python_scripts/log/backfill.log", log_queue=log_queue)
+
+    backfill(
+        opts.source, workers=opts.workers, config_path=opts.config, log_queue=log_queue
+    )
+    return None
+
+
+if __name__ == "__main__":
+    main()
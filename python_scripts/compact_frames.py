@@ -0,0 +1,63 @@
+import pandas as pd
+
+# repeated strings, stored once per distinct value as categories
+CATEGORY_COLS = ["etf", "etf_name", "stock", "stock_name"]
+ID_COLS = ["etf_id", "stock_id"]
+DATE_COLS = ["dt"]
+# measures arrive as Decimal from NUMERIC columns
+MEASURE_COLS = [
+    "shares_change",
+    "market_val_change",
+    "num_shares",
+    "weight",
+    "market_value",
+    "average_price",
+]
+
+
+def memory_usage(df: pd.DataFrame) -> int:
+    """Bytes used by a dataframe, including the python objects it points to"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def compact_holdings_frame(
+    df: pd.DataFrame, float_dtype: str = "float64"
+) -> pd.DataFrame:
+    """Convert a holdings or changes frame to compact column types
+
+    Symbol and name columns become categoricals, ids become int32, Decimal
+    measures become floats and dates become datetime64. Columns that are not
+    present are left alone.
+
+    Args:
+        df (pd.DataFrame): frame read from psql or the parquet archive
+        float_dtype (str): float64, or float32 to halve the size of the measures
+
+    Returns:
+        pd.DataFrame: a compacted copy of df
+    """
+    df = df.copy()
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col in ID_COLS:
+        if col in df.columns and df[col].notna().all():
+            df[col] = df[col].astype("int32")
+    for col in MEASURE_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype(float_dtype)
+    for col in DATE_COLS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> str:
+    """One line summary of the memory saved by compact_holdings_frame"""
+    before_bytes = memory_usage(before)
+    after_bytes = memory_usage(after)
+    return (
+        f"{before.shape[0]} rows: {before_bytes / 1024:,.1f} KiB -> "
+        f"{after_bytes / 1024:,.1f} KiB "
+        f"({before_bytes / max(after_bytes, 1):.1f}x smaller)"
+    )
@@ -1,25 +1,106 @@
 import configparser as cp
 import csv
 import logging
-from datetime import date
+from datetime import date, datetime
+from typing import Optional
 
 import numpy as np
 import pandas as pd
 import psycopg2
 import psycopg2.extras
 
+import log_setup
 from sql_methods import insert_into_sql
 
 # define global constants
 CASH_FORMAT_1 = "XXX CASH"
 CASH_FROMAT_2 = "XXX/XXX"
+AS_OF_LABEL = "Fund Holdings as of"
+AS_OF_FORMATS = ["%b %d, %Y", "%d-%b-%Y", "%Y-%m-%d", "%m/%d/%Y"]
+IGNORE_PATH = "./data/ignore_non_equity_tickers.csv"
+# blackrock columns kept as categories by groupby_and_convert_types
+DIMENSION_COLS = {
+    "Sector": "sector",
+    "Location": "country",
+    "Asset Class": "asset_class",
+}
+MISSING_CATEGORY = "Other"
 
 
-def clean_blackrock_csv(csv_path: str) -> pd.DataFrame:
+def parse_as_of_date(value: str) -> Optional[date]:
+    """Parse the as-of date written in a blackrock csv preamble
+
+    Args:
+        value (str): date text, e.g. "Aug 13, 2021"
+
+    Returns:
+        Optional[date]: the parsed date, None if no format matched
+    """
+    for fmt in AS_OF_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def read_as_of_date(csv_path: str) -> Optional[date]:
+    """Read the "Fund Holdings as of" date from the preamble of a blackrock csv
+
+    Args:
+        csv_path (str): path to the csv file
+
+    Returns:
+        Optional[date]: the as-of date of the holdings, None if not found
+    """
+    with open(csv_path, "r") as f:
+        csv_reader = csv.reader(f, delimiter=",", quotechar='"')
+        for row in csv_reader:
+            if row and row[0] == "Ticker":
+                break
+            if len(row) > 1 and row[0].strip() == AS_OF_LABEL:
+                return parse_as_of_date(row[1])
+    return None
+
+
+def read_ignore_ids(ignore_path: str = IGNORE_PATH) -> list:
+    """Read the ids of non equity etfs that are not loaded
+
+    Args:
+        ignore_path (str): csv of etf ids and symbols
+
+    Returns:
+        list: etf ids as strings
+    """
+    ignore_id = []
+    with open(ignore_path, "r") as f:
+        for row in f:
+            row = row.replace("\n", "")
+            ignore_id.append(row.split(",")[0])
+    return ignore_id
+
+
+def load_stock_ids(conn: psycopg2.extensions.connection) -> dict:
+    """Map every symbol in the stocks table to its id
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+
+    Returns:
+        dict: symbol -> stock id
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT symbol, id FROM stocks;")
+        return dict(cursor.fetchall())
+
+
+def clean_blackrock_csv(csv_path: str, as_of: Optional[date] = None) -> pd.DataFrame:
     """Clean csv files from blackrock holding pages
 
     Args:
-        df (pd.DataFrame): dataframe from blackrock
+        csv_path (str): path to the csv from blackrock
+        as_of (date, optional): date to stamp the holdings with. Defaults to the
+            "Fund Holdings as of" date in the file, or today if there is none.
 
     Returns:
         pd.DataFrame: cleaned dataframe to be inserted into psql
@@ -34,11 +115,16 @@ def clean_blackrock_csv(csv_path: str) -> pd.DataFrame:
         for row in csv_reader:
             if row[0] == "Ticker":
                 n_skip = index
+            elif as_of is None and n_skip == 0 and row[0].strip() == AS_OF_LABEL:
+                as_of = parse_as_of_date(row[1]) if len(row) > 1 else None
             index += 1
         logger.debug(f"Skipping {n_skip} rows in the csv file {csv_path}")
+    if as_of is None:
+        logger.warning(f"No as-of date in {csv_path}, using today")
+        as_of = date.today()
     try:
         df = pd.read_csv(csv_path, skiprows=n_skip)
-        df.loc[:, "dt"] = date.today().strftime("%Y-%m-%d")
+        df.loc[:, "dt"] = as_of.strftime("%Y-%m-%d")
         df = df.dropna(axis=0, subset=["Ticker"])
         return df
     except Exception as e:
@@ -48,7 +134,10 @@ def clean_blackrock_csv(csv_path: str) -> pd.DataFrame:
 
 
 def append_stock_ids(
-    df: pd.DataFrame, conn: psycopg2.extensions.connection, etf_id: str
+    df: pd.DataFrame,
+    conn: psycopg2.extensions.connection,
+    etf_id: str,
+    stock_ids: Optional[dict] = None,
 ) -> pd.DataFrame:
     """Takes in pandas data frame of holdings, adds the stocks id of the stock and the etf
 
@@ -56,6 +145,8 @@ def append_stock_ids(
         df (pd.DataFrame): dataframe of stock holdings
         conn (psycopg2.extensions.connection): database connection object
         etf [str]: the ticker for the etf
+        stock_ids (dict, optional): symbol -> id map from load_stock_ids, used
+            instead of querying the stocks table for every row
 
     Returns:
         pd.DataFrame: dataframe with appended data on stock ids
@@ -76,6 +167,9 @@ def append_stock_ids(
         SELECT * FROM stocks WHERE symbol = %s
         """
 
+        # counted in the loop, logged once per etf
+        unresolved = log_setup.RowEvents()
+        currencies = log_setup.RowEvents()
         for row in df.itertuples():
             if not (
                 (
@@ -85,29 +179,89 @@ def append_stock_ids(
                 or (len(str(row.Name).strip())) == len(CASH_FROMAT_2)
                 and str(row.Name).strip()[3] == "/"
             ):
-                cursor.execute(query, (row.Ticker,))
-                res = cursor.fetchone()
-                if not (res is None):
-                    df.loc[row.Index, "stock_id"] = res["id"]
+                if stock_ids is not None:
+                    stock_id = stock_ids.get(row.Ticker)
+                else:
+                    cursor.execute(query, (row.Ticker,))
+                    res = cursor.fetchone()
+                    stock_id = None if res is None else res["id"]
+                if not (stock_id is None):
+                    df.loc[row.Index, "stock_id"] = stock_id
                 else:
-                    logger.debug(f"STOCK {row.Ticker} is not in the stock table")
+                    unresolved.add(row.Ticker)
             else:
-                logger.debug(f"Skipping over currency: {row.Ticker}")
+                currencies.add(row.Ticker)
+    unresolved.report(logger, logging.INFO, f"tickers unresolved for ETF {etf_id}")
+    currencies.report(logger, logging.DEBUG, f"currency rows skipped for ETF {etf_id}")
+    return df
+
+
+def normalize_category(values: pd.Series) -> pd.Series:
+    """Sector, location or asset class names as categoricals, blanks as Other"""
+    # blackrock writes "-" when a holding has no sector or location
+    values = values.fillna("").astype(str).str.strip()
+    values = values.replace({"": MISSING_CATEGORY, "-": MISSING_CATEGORY})
+    return values.astype("category")
+
+
+def exposure_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """Weight, market value and categories of every row of a cleaned csv
+
+    Unlike groupby_and_convert_types, rows without a stock id (tickers missing
+    from the stocks table, cash and derivatives) are kept, they are part of the
+    fund's exposures.
+
+    Args:
+        df (pd.DataFrame): output of append_stock_ids
+
+    Returns:
+        pd.DataFrame: etf_id, dt, weight, market_value and the DIMENSION_COLS
+            names, one row per csv row with a weight or market value
+    """
+    df = df.reindex(
+        columns=["etf_id", "dt", "Weight (%)", "Market Value"] + list(DIMENSION_COLS)
+    )
+    df = df.rename(
+        columns=dict(
+            {"Weight (%)": "weight", "Market Value": "market_value"}, **DIMENSION_COLS
+        )
+    )
+    for col in ["weight", "market_value"]:
+        df[col] = pd.to_numeric(
+            df[col].astype(str).str.replace(",", ""), errors="coerce"
+        )
+    df = df.dropna(subset=["weight", "market_value"], how="all")
+    df["weight"] = df["weight"].fillna(0) / 100
+    df["market_value"] = df["market_value"].fillna(0)
+    for name in DIMENSION_COLS.values():
+        df[name] = normalize_category(df[name])
     return df
 
 
-def groupby_and_convert_types(df: pd.DataFrame) -> pd.DataFrame:
+def groupby_and_convert_types(
+    df: pd.DataFrame, keep_dimensions: bool = False
+) -> pd.DataFrame:
     """Sums shares over same tickers, converts columns to numeric
     and drops NA values
 
     Args:
         df (pd.DataFrame): raw dataframe
+        keep_dimensions (bool): also keep the sector, country and asset class
+            of every holding, as categoricals
 
     Returns:
         pd.DataFrame: cleaned dataframe
     """
     logger = logging.getLogger(__name__ + ".groupby_and_convert_types")
 
+    dimensions = {}
+    if keep_dimensions:
+        dimensions = DIMENSION_COLS
+        df = df.reindex(
+            columns=list(df.columns)
+            + [col for col in dimensions if col not in df.columns]
+        )
+
     df = df[
         [
             "etf_id",
@@ -118,6 +272,7 @@ def groupby_and_convert_types(df: pd.DataFrame) -> pd.DataFrame:
             "Market Value",
             "Price",
         ]
+        + list(dimensions)
     ]
 
     df = df.dropna(
@@ -159,9 +314,15 @@ def groupby_and_convert_types(df: pd.DataFrame) -> pd.DataFrame:
             weight=pd.NamedAgg(column="Weight (%)", aggfunc="sum"),
             market_value=pd.NamedAgg(column="Market Value", aggfunc="sum"),
             average_price=pd.NamedAgg(column="Price", aggfunc="mean"),
+            **{
+                name: pd.NamedAgg(column=col, aggfunc="first")
+                for col, name in dimensions.items()
+            },
         )
         .reset_index()
     )
+    for name in dimensions.values():
+        df[name] = normalize_category(df[name])
 
     # round values
     df.loc[:, "num_shares"] = df["num_shares"].round(2)
@@ -172,19 +333,7 @@ def groupby_and_convert_types(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def main() -> None:
-    file_handler = logging.FileHandler("./log/csv_cleaning.log")
-    file_handler.setLevel(logging.WARN)
-
-    sys_handler = logging.StreamHandler()
-    sys_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter(
-        "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-    )
-    file_handler.setFormatter(formatter)
-    sys_handler.setFormatter(formatter)
-
-    logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, sys_handler])
+    log_setup.setup_logging("./log/csv_cleaning.log", file_level=logging.WARN)
     logger = logging.getLogger(__name__)
 
     logger.info("Cleaning CSVs...")
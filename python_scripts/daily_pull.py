@@ -1,37 +1,268 @@
+import argparse
 import configparser as cp
 import logging
 import traceback
-from os import listdir, remove
+from datetime import date
+from typing import Optional, Tuple
+from os import listdir, makedirs, remove
 from os.path import isfile, join
+from shutil import move
 
 import pandas as pd
 import psycopg2
 import psycopg2.extras
 
+import exposure_cube
+import flow_windows
+import fund_metrics
+import interval_storage
+import log_setup
+import run_manifest
 from csv_cleaning import (
     append_stock_ids,
     clean_blackrock_csv,
+    exposure_rows,
     groupby_and_convert_types,
+    read_as_of_date,
+    read_ignore_ids,
 )
-from holdings_scraping import download_csv
-from sql_methods import insert_into_sql
+from holdings_scraping import download_csv, download_timeout
+from parquet_archive import ARCHIVE_PATH, export_holdings_to_parquet
+from pipeline_metrics import JSON_PATH, TEXTFILE_PATH, PipelineMetrics
+from run_manifest import MANIFEST_DIR, RunManifest
+from sql_methods import holdings_loaded, insert_into_sql
 
+HOLDINGS_COLS = [
+    "etf_id",
+    "stock_id",
+    "dt",
+    "num_shares",
+    "weight",
+    "market_value",
+    "average_price",
+]
 
-def main():
 
-    file_handler = logging.FileHandler("./python_scripts/log/daily_pull.log")
-    file_handler.setLevel(logging.INFO)
+def prepare_etf(
+    conn: psycopg2.extensions.connection,
+    csv_path: str,
+    etf_id: str,
+    metrics: PipelineMetrics,
+    manifest: RunManifest,
+    storage_mode: str = interval_storage.ROWS,
+    stock_ids: Optional[dict] = None,
+) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Clean one downloaded csv into rows ready for etf_holdings
 
-    sys_handler = logging.StreamHandler()
-    sys_handler.setLevel(logging.INFO)
+    Holdings are keyed on the as-of date in the file. If that date is already
+    loaded for the etf (a weekend pull, or blackrock has not published yet) the
+    file is skipped before any id lookups.
 
-    formatter = logging.Formatter(
-        "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        csv_path (str): path of the downloaded csv
+        etf_id (str): id of the etf
+        metrics (PipelineMetrics): collects the stage timings
+        manifest (RunManifest): per etf progress of the current run
+        storage_mode (str): rows, intervals or both
+        stock_ids (dict, optional): symbol -> id map instead of per row queries
+
+    Returns:
+        Optional[Tuple[pd.DataFrame, pd.DataFrame]]: cleaned holdings and the
+            exposure_rows of every row, with or without a stock id. None if
+            already loaded
+    """
+    logger = logging.getLogger(__name__ + ".prepare_etf")
+
+    if storage_mode == interval_storage.INTERVALS:
+        is_loaded = interval_storage.snapshot_loaded
+    else:
+        is_loaded = holdings_loaded
+
+    as_of = read_as_of_date(csv_path)
+    if as_of is not None and is_loaded(conn, etf_id, as_of):
+        logger.info(f"Holdings as of {as_of} already loaded, skipping...")
+        metrics.count("etfs_duplicate")
+        manifest.mark(etf_id, run_manifest.SKIPPED, as_of=str(as_of), rows=0)
+        return None
+
+    with metrics.timer("clean", etf_id):
+        df = clean_blackrock_csv(csv_path, as_of=as_of)
+    metrics.count("rows_read", df.shape[0], etf_id)
+    with metrics.timer("append_stock_ids", etf_id):
+        df = append_stock_ids(df, conn, etf_id, stock_ids=stock_ids)
+    metrics.count("tickers_unresolved", int(df["stock_id"].isna().sum()), etf_id)
+    # exposures count the rows groupby_and_convert_types drops for lack of an id
+    exposures = exposure_rows(df)
+    with metrics.timer("groupby_and_convert_types", etf_id):
+        df = groupby_and_convert_types(df)
+    manifest.mark(etf_id, run_manifest.CLEANED, as_of=as_of and str(as_of))
+    return df, exposures
+
+
+def load_etf(
+    conn: psycopg2.extensions.connection,
+    df: pd.DataFrame,
+    etf_id: str,
+    metrics: PipelineMetrics,
+    manifest: RunManifest,
+    storage_mode: str = interval_storage.ROWS,
+    exposures: Optional[pd.DataFrame] = None,
+) -> int:
+    """Store the cleaned holdings of one etf
+
+    With the intervals (or both) storage mode the snapshot is also recorded as
+    position versions in etf_positions. Its sector, country and asset class
+    exposures are stored in etf_exposures. Everything is written in one
+    transaction, an etf is never left loaded without its exposures.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        df (pd.DataFrame): cleaned holdings from prepare_etf
+        etf_id (str): id of the etf
+        metrics (PipelineMetrics): collects the stage timings
+        manifest (RunManifest): per etf progress of the current run
+        storage_mode (str): rows, intervals or both
+        exposures (pd.DataFrame, optional): exposure rows from prepare_etf
+
+    Returns:
+        int: number of rows inserted into etf_holdings
+    """
+    logger = logging.getLogger(__name__ + ".load_etf")
+
+    rows = 0
+    try:
+        if storage_mode in (interval_storage.ROWS, interval_storage.BOTH):
+            logger.info("Inserting into table...")
+            with metrics.timer("insert_into_sql", etf_id):
+                # a failed insert must fail the etf, not mark it loaded
+                rows = insert_into_sql(
+                    "etf_holdings",
+                    df[HOLDINGS_COLS],
+                    conn,
+                    insert_cols=HOLDINGS_COLS,
+                    raise_errors=True,
+                    commit=False,
+                )
+            metrics.count("rows_loaded", rows, etf_id)
+        if storage_mode in (interval_storage.INTERVALS, interval_storage.BOTH):
+            if not df.empty:
+                with metrics.timer("apply_snapshot", etf_id):
+                    versions = interval_storage.apply_snapshot(conn, df, commit=False)
+                metrics.count(
+                    "position_versions",
+                    versions["added"] + versions["changed"],
+                    etf_id,
+                )
+                metrics.count("position_values", versions["overrides"], etf_id)
+        if exposures is not None and not exposures.empty:
+            with metrics.timer("exposures", etf_id):
+                cells = exposure_cube.update_exposures(conn, exposures, commit=False)
+            metrics.count("exposure_cells", cells, etf_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    manifest.mark(etf_id, run_manifest.LOADED, rows=rows)
+    return rows
+
+
+def process_etf(
+    conn: psycopg2.extensions.connection,
+    csv_path: str,
+    etf_id: str,
+    metrics: PipelineMetrics,
+    manifest: RunManifest,
+    storage_mode: str = interval_storage.ROWS,
+) -> int:
+    """Clean one downloaded csv and store it, see prepare_etf and load_etf
+
+    Returns:
+        int: number of rows inserted into etf_holdings
+    """
+    prepared = prepare_etf(conn, csv_path, etf_id, metrics, manifest, storage_mode)
+    if prepared is None:
+        return 0
+    df, exposures = prepared
+    return load_etf(conn, df, etf_id, metrics, manifest, storage_mode, exposures)
+
+
+def export_parquet(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    manifest: RunManifest,
+) -> None:
+    """Bring the parquet archive up to date with the stored holdings"""
+    logger = logging.getLogger(__name__ + ".export_parquet")
+
+    exported = export_holdings_to_parquet(
+        conn,
+        config.get("archive", "path", fallback=ARCHIVE_PATH),
+        storage_mode=config.get("storage", "mode", fallback=interval_storage.ROWS),
     )
-    file_handler.setFormatter(formatter)
-    sys_handler.setFormatter(formatter)
+    logger.info(f"Archived dates: {exported}")
+
+
+# tables and files derived from the loaded holdings, run in order after loading
+# by main and as concurrent stages by pipeline_scheduler
+DERIVE_STEPS = [
+    ("parquet_export", export_parquet),
+    ("flow_windows", flow_windows.update_flows),
+    ("fund_metrics", fund_metrics.update_metrics),
+]
+
+
+def clear_temp_files(
+    temp_path: str, manifest: RunManifest, raw_path: Optional[str] = None
+) -> None:
+    """Remove the csv files of finished etfs from the temp directory
+
+    Files of unfinished etfs are kept for the next run. When raw_path is set
+    the files are moved under raw_path/<date> for backfill.py instead.
+
+    Args:
+        temp_path (str): directory the csv files were downloaded to
+        manifest (RunManifest): per etf progress of the current run
+        raw_path (str, optional): raw file archive directory
+    """
+    logger = logging.getLogger(__name__ + ".clear_temp_files")
+
+    if raw_path:
+        logger.info(f"Moving raw files to {raw_path}...")
+    else:
+        logger.info("Deleting all temp files...")
 
-    logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, sys_handler])
+    files = [f for f in listdir(temp_path) if isfile(join(temp_path, f))]
+    done_ids = manifest.with_state(*run_manifest.DONE_STATES)
+    for file in files:
+        if file.split(".")[0] not in done_ids:
+            # keep unfinished files for the next run
+            continue
+        if raw_path:
+            day_path = join(raw_path, date.today().strftime("%Y-%m-%d"))
+            makedirs(day_path, exist_ok=True)
+            move(join(temp_path, file), join(day_path, file))
+        else:
+            remove(join(temp_path, file))
+
+
+def write_run_metrics(metrics: PipelineMetrics, config: cp.ConfigParser) -> None:
+    """Finish the run's metrics and write the json summary and textfile"""
+    logger = logging.getLogger(__name__ + ".write_run_metrics")
+
+    metrics.finish()
+    try:
+        metrics.write_json(config.get("metrics", "json_path", fallback=JSON_PATH))
+        metrics.write_prometheus(
+            config.get("metrics", "textfile_path", fallback=TEXTFILE_PATH)
+        )
+    except Exception as e:
+        logger.warning(f"Run metrics not written: {e}")
+
+
+def main(retry_failed_only: bool = False):
+
+    log_setup.setup_logging("./python_scripts/log/daily_pull.log")
     logger = logging.getLogger(__name__)
 
     config = cp.ConfigParser()
@@ -43,17 +274,39 @@ def main():
         password=config["psql"]["password"],
     )
 
+    metrics = PipelineMetrics("daily_pull")
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    if storage_mode not in interval_storage.STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {storage_mode}")
+
+    # resume from the state of any earlier run today
+    manifest = RunManifest.for_date(
+        manifest_dir=config.get("manifest", "path", fallback=MANIFEST_DIR)
+    )
+    if manifest.etfs:
+        logger.info(f"Resuming run: {manifest.counts()}")
+
     # read in etfs to ignore
-    ignore_id = []
-    with open("./data/ignore_non_equity_tickers.csv", "r") as f:
-        for row in f:
-            row = row.replace("/n", "")
-            ignore_id.append(row.split(",")[0])
+    ignore_id = read_ignore_ids()
 
-    logger.info("Downloading csvs...")
-    download_csv(conn)
+    # the etfs to retry, fixed before downloading moves them out of failed
+    retry_ids = None
+    if retry_failed_only:
+        retry_ids = set(manifest.with_state(run_manifest.FAILED))
+        logger.info(f"Retrying {len(retry_ids)} failed ETFs")
 
     temp_path = "./data/temp"
+    logger.info("Downloading csvs...")
+    with metrics.timer("download"):
+        download_csv(
+            conn,
+            metrics=metrics,
+            manifest=manifest,
+            retry_failed_only=retry_failed_only,
+            temp_path=temp_path,
+            timeout=download_timeout(config),
+        )
+
     files = [f for f in listdir(temp_path) if isfile(join(temp_path, f))]
     logger.info("Beginning to loop over etf_id")
     for etf in files:
@@ -61,32 +314,35 @@ def main():
         logger.info(f"Current etf: {etf_id}")
         if etf_id in ignore_id:
             logger.info("Skipped...")
+            metrics.count("etfs_skipped")
+            manifest.mark(etf_id, run_manifest.SKIPPED)
+            continue
+        elif retry_ids is not None and etf_id not in retry_ids:
+            logger.info("Not failed earlier today...")
+            continue
+        elif retry_ids is None and not manifest.needs_work(etf_id):
+            logger.info(f"Already {manifest.state(etf_id)} in this run...")
+            continue
+        elif manifest.state(etf_id) == run_manifest.FAILED:
+            # the download of this file failed, it is a stale copy
+            logger.info("Download failed, not loading stale file...")
             continue
         else:
             try:
-                df = groupby_and_convert_types(
-                    append_stock_ids(
-                        clean_blackrock_csv(join(temp_path, etf)), conn, etf_id
-                    )
-                )
-                logger.info("Inserting into table...")
-                insert_into_sql(
-                    "etf_holdings",
-                    df,
+                process_etf(
                     conn,
-                    insert_cols=[
-                        "etf_id",
-                        "stock_id",
-                        "dt",
-                        "num_shares",
-                        "weight",
-                        "market_value",
-                        "average_price",
-                    ],
+                    join(temp_path, etf),
+                    etf_id,
+                    metrics,
+                    manifest,
+                    storage_mode=storage_mode,
                 )
+                metrics.count("etfs_loaded")
                 logger.info(f"ETF {etf_id} successful")
                 # logger.info(f"df shape: {df.shape}")
             except Exception as e:
+                metrics.count("etfs_failed")
+                manifest.fail(etf_id, e)
                 logger.warning(e)
                 logger.warning(f"ETF {etf_id} unsuccessful")
 
@@ -94,14 +350,32 @@ def main():
 
     logger.info("Finished inserting all data")
 
-    logger.info("Deleting all temp files...")
-    for file in files:
-        remove(join(temp_path, file))
+    for name, step in DERIVE_STEPS:
+        logger.info(f"Running {name}...")
+        try:
+            with metrics.timer(name):
+                step(conn, config, manifest)
+        except Exception as e:
+            logger.warning(f"{name} unsuccessful: {e}")
+
+    clear_temp_files(
+        temp_path, manifest, config.get("archive", "raw_path", fallback=None)
+    )
+    write_run_metrics(metrics, config)
 
     logger.info("Temporary directory cleared.")
+    logger.info(f"Run state: {manifest.counts()}")
     return None
 
 
 if __name__ == "__main__":
 
-    main()
+    parser = argparse.ArgumentParser(description="Pull and load etf holdings")
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="only retry the etfs that failed earlier today",
+    )
+    opts = parser.parse_args()
+
+    main(retry_failed_only=opts.retry_failed)
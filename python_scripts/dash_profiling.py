@@ -0,0 +1,212 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+import dash
+import flask
+from prometheus_client import Histogram
+
+from admin_auth import require_admin_token
+from dashboard_metrics import REGISTRY
+
+# opt-in sampling of slow requests, can be switched at runtime on /admin/profiling
+PROFILE_ENABLED = os.environ.get("DASH_PROFILE", "0") == "1"
+PROFILE_THRESHOLD_MS = float(os.environ.get("DASH_PROFILE_THRESHOLD_MS", "200"))
+PROFILE_INTERVAL_MS = float(os.environ.get("DASH_PROFILE_INTERVAL_MS", "5"))
+PROFILE_PATH = os.environ.get(
+    "DASH_PROFILE_PATH", "./python_scripts/log/dash_profile.folded"
+)
+
+# request latency is only labelled for these endpoints, asset urls are versioned
+TIMED_ENDPOINTS = ("/_dash-update-component", "/_dash-layout")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CALLBACK_SECONDS = Histogram(
+    "etf_dashboard_callback_seconds",
+    "Time spent inside a dash callback or layout function",
+    ["callback"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+PHASE_SECONDS = Histogram(
+    "etf_dashboard_callback_phase_seconds",
+    "Time spent in a named phase of a dash callback",
+    ["callback", "phase"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+REQUEST_SECONDS = Histogram(
+    "etf_dashboard_request_seconds",
+    "Time to serve a dash request, including JSON serialisation",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+    registry=REGISTRY,
+)
+
+_settings = {
+    "enabled": PROFILE_ENABLED,
+    "threshold_ms": PROFILE_THRESHOLD_MS,
+    "interval_ms": PROFILE_INTERVAL_MS,
+}
+_write_lock = threading.Lock()
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval
+
+    Stacks are kept in the folded format used by flamegraph.pl and speedscope:
+    one line per unique stack, frames separated by `;`, followed by a count.
+    """
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> Counter:
+        self._stop_event.set()
+        self.join()
+        return self.stacks
+
+
+def write_folded(name: str, stacks: Counter, path: str = None) -> None:
+    """Append sampled stacks under a root frame named after the callback"""
+    with _write_lock:
+        with open(path or PROFILE_PATH, "a") as f:
+            for stack, count in stacks.items():
+                f.write(f"{name};{stack} {count}\n")
+
+
+def profiled(name: str):
+    """Record a function's latency and, when enabled, sample it if it is slow
+
+    Args:
+        name (str): label for the latency histogram and flame graph root
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sampler = None
+            if _settings["enabled"]:
+                sampler = StackSampler(
+                    threading.get_ident(), _settings["interval_ms"] / 1000
+                )
+                sampler.start()
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                CALLBACK_SECONDS.labels(name).observe(elapsed)
+                if sampler is not None:
+                    stacks = sampler.stop()
+                    if elapsed * 1000 >= _settings["threshold_ms"] and stacks:
+                        write_folded(name, stacks)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def phase(callback: str, name: str):
+    """Time one phase of a callback, e.g. filtering or building components"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.labels(callback, name).observe(time.perf_counter() - start)
+
+
+def profile_callbacks(app: dash.Dash) -> None:
+    """Wrap every callback registered on app from now on with `profiled`
+
+    Also times the dash endpoints themselves so serialisation overhead shows
+    up as the gap between request and callback latency.
+
+    Args:
+        app (dash.Dash): the dash app, before any callbacks are registered
+    """
+    register = app.callback
+
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        def wrap(func):
+            return decorator(profiled(func.__name__)(func))
+
+        return wrap
+
+    app.callback = callback
+
+    server = app.server
+
+    @server.before_request
+    def start_request_timer():
+        flask.g.request_start = time.perf_counter()
+
+    @server.after_request
+    def observe_request(response):
+        path = flask.request.path
+        if path in TIMED_ENDPOINTS and "request_start" in flask.g:
+            REQUEST_SECONDS.labels(path).observe(
+                time.perf_counter() - flask.g.request_start
+            )
+        return response
+
+
+def register_admin_endpoint(server: flask.Flask, path: str = "/admin/profiling"):
+    """Turn the sampling profiler on or off without a redeploy
+
+    GET returns the current settings. POST accepts `enabled`, `threshold_ms`
+    and `interval_ms` query parameters. Both need the DASH_ADMIN_TOKEN value in
+    an X-Admin-Token header; without DASH_ADMIN_TOKEN the endpoint is disabled.
+
+    Args:
+        server (flask.Flask): the flask server behind the dash app
+        path (str): url of the endpoint
+    """
+
+    def profiling():
+        require_admin_token()
+
+        if flask.request.method == "POST":
+            args = flask.request.args
+            try:
+                updates = {
+                    key: float(args[key])
+                    for key in ("threshold_ms", "interval_ms")
+                    if key in args
+                }
+            except ValueError:
+                flask.abort(400, "threshold_ms and interval_ms must be numbers")
+            if "enabled" in args:
+                _settings["enabled"] = args["enabled"] in ("1", "true", "on")
+            _settings.update(updates)
+
+        return flask.jsonify(dict(_settings, profile_path=PROFILE_PATH))
+
+    server.add_url_rule(path, "admin_profiling", profiling, methods=["GET", "POST"])
@@ -0,0 +1,47 @@
+import flask
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# the dashboard keeps its own registry so gunicorn reloads start clean
+REGISTRY = CollectorRegistry()
+
+REFRESH_SECONDS = Histogram(
+    "etf_dashboard_refresh_seconds",
+    "Time taken to reload the dashboard data",
+    registry=REGISTRY,
+)
+QUERY_SECONDS = Histogram(
+    "etf_dashboard_query_seconds",
+    "Time taken by dashboard data queries",
+    ["query"],
+    registry=REGISTRY,
+)
+LAST_REFRESH = Gauge(
+    "etf_dashboard_last_refresh_timestamp_seconds",
+    "Unix time of the last successful data refresh",
+    registry=REGISTRY,
+)
+REFRESH_ROWS = Gauge(
+    "etf_dashboard_rows",
+    "Number of rows held in memory after the last refresh",
+    registry=REGISTRY,
+)
+
+
+def register_metrics_endpoint(server: flask.Flask, path: str = "/metrics") -> None:
+    """Serve the dashboard registry in the prometheus text format
+
+    Args:
+        server (flask.Flask): the flask server behind the dash app
+        path (str): url of the endpoint
+    """
+
+    def metrics():
+        return flask.Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
+
+    server.add_url_rule(path, "metrics", metrics)
@@ -0,0 +1,312 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import interval_storage
+from sql_methods import read_sql_copy
+
+# snapshots and date pairs kept in memory
+KEEP_SNAPSHOTS = 8
+KEEP_PAIRS = 16
+TOP_N = 10
+DELTA_COLS = [
+    "etf_id",
+    "stock_id",
+    "shares_start",
+    "shares_end",
+    "shares_change",
+    "market_val_change",
+]
+
+SNAPSHOT_QUERY = """
+    SELECT
+        etf_id,
+        stock_id,
+        num_shares::DOUBLE PRECISION AS num_shares,
+        market_value::DOUBLE PRECISION AS market_value
+    FROM etf_holdings
+    WHERE dt = %(dt)s;
+"""
+
+# the rows mode dates come from etf_holdings itself, one index probe per date
+SNAPSHOT_DATES_QUERY = {
+    interval_storage.ROWS: """
+        WITH RECURSIVE dates AS (
+            SELECT MIN(dt) AS dt FROM etf_holdings
+            UNION ALL
+            SELECT (SELECT MIN(h.dt) FROM etf_holdings h WHERE h.dt > d.dt)
+            FROM dates d
+            WHERE d.dt IS NOT NULL
+        )
+        SELECT dt FROM dates WHERE dt IS NOT NULL ORDER BY dt;
+    """,
+    interval_storage.INTERVALS: (
+        "SELECT DISTINCT dt FROM etf_snapshot_dates ORDER BY dt;"
+    ),
+}
+
+
+class Snapshot:
+    """Positions of every etf on one date as arrays sorted by (etf_id, stock_id)
+
+    The pair is packed into one int64 key so two snapshots align with a
+    single searchsorted.
+    """
+
+    def __init__(self, dt: date, df: pd.DataFrame) -> None:
+        etf_ids = df["etf_id"].to_numpy(dtype=np.int64)
+        stock_ids = df["stock_id"].to_numpy(dtype=np.int64)
+        keys = (etf_ids << 32) | stock_ids
+        order = np.argsort(keys, kind="stable")
+        self.dt = dt
+        self.keys = keys[order]
+        self.num_shares = df["num_shares"].to_numpy(dtype=np.float64)[order]
+        self.market_value = df["market_value"].to_numpy(dtype=np.float64)[order]
+        self.etf_ids = np.unique(etf_ids)
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Shares and market value of keys, 0 for positions not held"""
+        if not len(self.keys):
+            return np.zeros(len(keys)), np.zeros(len(keys))
+        idx = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        held = self.keys[idx] == keys
+        return (
+            np.where(held, self.num_shares[idx], 0.0),
+            np.where(held, self.market_value[idx], 0.0),
+        )
+
+
+class Delta:
+    """Change of every position between two snapshots, grouped by etf
+
+    Only etfs present in both snapshots are compared, an etf that did not
+    publish on one of the dates would otherwise look fully bought or sold.
+    """
+
+    def __init__(self, start: Snapshot, end: Snapshot) -> None:
+        etfs = np.intersect1d(start.etf_ids, end.etf_ids)
+        keys = np.union1d(start.keys, end.keys)
+        keys = keys[np.isin(keys >> 32, etfs)]
+
+        shares_start, value_start = start.lookup(keys)
+        shares_end, value_end = end.lookup(keys)
+        self.start = start.dt
+        self.end = end.dt
+        self.etf_ids = (keys >> 32).astype(np.int32)
+        self.stock_ids = (keys & 0xFFFFFFFF).astype(np.int32)
+        self.shares_start = shares_start
+        self.shares_end = shares_end
+        self.shares_change = shares_end - shares_start
+        self.market_val_change = value_end - value_start
+
+        # slice of rows of every etf, keys are sorted by etf first
+        starts = np.searchsorted(self.etf_ids, etfs, side="left")
+        ends = np.searchsorted(self.etf_ids, etfs, side="right")
+        self.offsets = {
+            int(etf_id): (int(lo), int(hi))
+            for etf_id, lo, hi in zip(etfs, starts, ends)
+        }
+
+    def rows(self, idx: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "etf_id": self.etf_ids[idx],
+                "stock_id": self.stock_ids[idx],
+                "shares_start": self.shares_start[idx],
+                "shares_end": self.shares_end[idx],
+                "shares_change": self.shares_change[idx],
+                "market_val_change": self.market_val_change[idx],
+            }
+        )
+
+    def top_movers(self, etf_id: int, n: int = TOP_N) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of the n largest buys and n largest sells of an etf
+
+        Selection with argpartition is linear in the etf's positions, only the
+        n selected rows are sorted.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: row indices of buys and of sells,
+                largest change first
+        """
+        lo, hi = self.offsets.get(int(etf_id), (0, 0))
+        change = self.shares_change[lo:hi]
+        return (
+            lo + select_top(change, n, change > 0),
+            lo + select_top(-change, n, change < 0),
+        )
+
+
+def select_top(values: np.ndarray, n: int, mask: np.ndarray) -> np.ndarray:
+    """Positions of the n largest values where mask is set, largest first"""
+    candidates = np.flatnonzero(mask)
+    if len(candidates) > n:
+        part = np.argpartition(values[candidates], len(candidates) - n)
+        candidates = candidates[part[-n:]]
+    return candidates[np.argsort(-values[candidates], kind="stable")]
+
+
+def load_snapshot(
+    conn: psycopg2.extensions.connection,
+    dt: date,
+    storage_mode: str = interval_storage.ROWS,
+) -> Snapshot:
+    """Read the positions of every etf on a date into a Snapshot
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        dt (date): snapshot date
+        storage_mode (str): read etf_holdings (rows, both) or etf_positions (intervals)
+
+    Returns:
+        Snapshot: the positions as sorted arrays
+    """
+    if storage_mode == interval_storage.INTERVALS:
+        df = interval_storage.snapshot_as_of(conn, dt)
+        df = df[["etf_id", "stock_id", "num_shares", "market_value"]]
+    else:
+        df = read_sql_copy(SNAPSHOT_QUERY, conn, params={"dt": dt})
+    return Snapshot(dt, df.fillna({"num_shares": 0, "market_value": 0}))
+
+
+class DeltaEngine:
+    """Buys and sells of every etf between any two snapshot dates
+
+    Snapshots are read from the database once and kept as arrays, the deltas
+    of recently asked date pairs are kept too. Both caches evict the least
+    recently used entry.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], psycopg2.extensions.connection],
+        storage_mode: str = interval_storage.ROWS,
+        keep_snapshots: int = KEEP_SNAPSHOTS,
+        keep_pairs: int = KEEP_PAIRS,
+    ) -> None:
+        self.connect = connect
+        self.storage_mode = storage_mode
+        self.keep_snapshots = keep_snapshots
+        self.keep_pairs = keep_pairs
+        self.dates: List[date] = []
+        self.symbols: Dict[str, int] = {}
+        self.names: Dict[int, Tuple[str, str]] = {}
+        self.snapshots: "OrderedDict[date, Snapshot]" = OrderedDict()
+        self.deltas: "OrderedDict[Tuple[date, date], Delta]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def refresh(self, conn: psycopg2.extensions.connection) -> None:
+        """Reload the snapshot dates and stock names after a pipeline run
+
+        The latest date is dropped from the caches, etfs published late may
+        have been added to it.
+        """
+        with conn.cursor() as cursor:
+            mode = interval_storage.INTERVALS
+            if self.storage_mode != interval_storage.INTERVALS:
+                mode = interval_storage.ROWS
+            cursor.execute(SNAPSHOT_DATES_QUERY[mode])
+            dates = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT id, symbol, name FROM stocks;")
+            stocks = cursor.fetchall()
+        with self._lock:
+            self.dates = dates
+            self.symbols = {symbol: stock_id for stock_id, symbol, _ in stocks}
+            self.names = {stock_id: (symbol, name) for stock_id, symbol, name in stocks}
+            if dates:
+                self.snapshots.pop(dates[-1], None)
+                for pair in [p for p in self.deltas if dates[-1] in p]:
+                    del self.deltas[pair]
+
+    def snapshot_date(self, dt: date) -> Optional[date]:
+        """The last snapshot date on or before dt"""
+        with self._lock:
+            earlier = [d for d in self.dates if d <= dt]
+        return earlier[-1] if earlier else None
+
+    def snapshot(self, dt: date) -> Snapshot:
+        with self._lock:
+            if dt in self.snapshots:
+                self.snapshots.move_to_end(dt)
+                return self.snapshots[dt]
+        conn = self.connect()
+        try:
+            snapshot = load_snapshot(conn, dt, self.storage_mode)
+        finally:
+            conn.close()
+        with self._lock:
+            self.snapshots[dt] = snapshot
+            while len(self.snapshots) > self.keep_snapshots:
+                self.snapshots.popitem(last=False)
+        return snapshot
+
+    def delta(self, start: date, end: date) -> Delta:
+        """Deltas of every position from start to end, snapshot dates"""
+        with self._lock:
+            if (start, end) in self.deltas:
+                self.deltas.move_to_end((start, end))
+                return self.deltas[(start, end)]
+        delta = Delta(self.snapshot(start), self.snapshot(end))
+        with self._lock:
+            self.deltas[(start, end)] = delta
+            while len(self.deltas) > self.keep_pairs:
+                self.deltas.popitem(last=False)
+        return delta
+
+    def top_movers(
+        self, etf_id: int, start: date, end: date, n: int = TOP_N
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Largest buys and sells of an etf between two dates
+
+        Args:
+            etf_id (int): the etf
+            start (date): first date, the last snapshot on or before it is used
+            end (date): second date, the last snapshot on or before it is used
+            n (int): rows per side
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: buys and sells, DELTA_COLS plus
+                stock and stock_name, largest change first
+        """
+        start, end = self.snapshot_date(start), self.snapshot_date(end)
+        if start is None or end is None or start == end:
+            empty = pd.DataFrame(columns=DELTA_COLS + ["stock", "stock_name"])
+            return empty, empty
+        delta = self.delta(min(start, end), max(start, end))
+        buys, sells = delta.top_movers(etf_id, n)
+        return self.with_names(delta.rows(buys)), self.with_names(delta.rows(sells))
+
+    def with_names(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Add the symbol and name of the stock of every row"""
+        names = [self.names.get(stock_id, ("", "")) for stock_id in df["stock_id"]]
+        df["stock"] = [symbol for symbol, _ in names]
+        df["stock_name"] = [name for _, name in names]
+        return df
+
+    def etf_id(self, symbol: str) -> Optional[int]:
+        """Id of an etf from its symbol"""
+        with self._lock:
+            return self.symbols.get(symbol)
+
+
+def refresh_engine(
+    engine: DeltaEngine, conn: psycopg2.extensions.connection
+) -> List[date]:
+    """Update the engine after a pipeline run and load the two latest snapshots
+
+    Returns:
+        List[date]: the snapshot dates now available
+    """
+    logger = logging.getLogger(__name__ + ".refresh_engine")
+
+    engine.refresh(conn)
+    for dt in engine.dates[-2:]:
+        snapshot = engine.snapshot(dt)
+        logger.info(f"Loaded {len(snapshot.keys)} positions as of {dt}")
+    return engine.dates
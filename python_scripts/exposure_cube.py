@@ -0,0 +1,190 @@
+import logging
+from datetime import date
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+# dimensions of the cube, columns of csv_cleaning.exposure_rows
+DIMENSIONS = ["sector", "country", "asset_class"]
+CUBE_COLS = ["etf_id", "dt", "dimension", "name", "positions", "weight", "market_value"]
+
+EXPOSURES_QUERY = """
+    SELECT
+        e.dt,
+        c.name,
+        e.positions,
+        e.weight,
+        e.market_value
+    FROM
+        etf_exposures e
+        JOIN holding_categories c ON e.category_id = c.id
+    WHERE
+        e.etf_id = %(etf_id)s
+        AND c.dimension = %(dimension)s
+        AND (%(start)s::DATE IS NULL OR e.dt >= %(start)s)
+        AND (%(end)s::DATE IS NULL OR e.dt <= %(end)s)
+    ORDER BY
+        e.dt,
+        e.weight DESC;
+"""
+
+
+def build_exposures(df: pd.DataFrame) -> pd.DataFrame:
+    """Aggregate holdings into exposure cells, one per etf, date and category
+
+    Args:
+        df (pd.DataFrame): output of csv_cleaning.exposure_rows, every row of the
+            csv including the ones without a stock id
+
+    Returns:
+        pd.DataFrame: CUBE_COLS, the weight and market value held in every
+            sector, country and asset class
+    """
+    cells = []
+    for dimension in DIMENSIONS:
+        cell = (
+            df.groupby(["etf_id", "dt", dimension], observed=True)
+            .agg(
+                positions=pd.NamedAgg(column="weight", aggfunc="size"),
+                weight=pd.NamedAgg(column="weight", aggfunc="sum"),
+                market_value=pd.NamedAgg(column="market_value", aggfunc="sum"),
+            )
+            .reset_index()
+            .rename(columns={dimension: "name"})
+        )
+        cell["name"] = cell["name"].astype(str)
+        cell.insert(2, "dimension", dimension)
+        cells.append(cell)
+    return pd.concat(cells, ignore_index=True)[CUBE_COLS]
+
+
+def category_ids(
+    conn: psycopg2.extensions.connection, categories: pd.DataFrame
+) -> Dict[Tuple[str, str], int]:
+    """Codes of (dimension, name) pairs, adding the ones not seen before
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        categories (pd.DataFrame): dimension and name columns
+
+    Returns:
+        Dict[Tuple[str, str], int]: (dimension, name) -> holding_categories id
+    """
+    pairs = list(
+        categories[["dimension", "name"]]
+        .drop_duplicates()
+        .itertuples(index=False, name=None)
+    )
+    with conn.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO holding_categories (dimension, name) VALUES %s "
+            "ON CONFLICT (dimension, name) DO NOTHING",
+            pairs,
+        )
+        cursor.execute(
+            "SELECT dimension, name, id FROM holding_categories "
+            "WHERE (dimension, name) IN (SELECT * FROM unnest(%s::TEXT[], %s::TEXT[]));",
+            ([d for d, _ in pairs], [n for _, n in pairs]),
+        )
+        return {(dimension, name): id_ for dimension, name, id_ in cursor.fetchall()}
+
+
+def store_exposures(
+    conn: psycopg2.extensions.connection, cube: pd.DataFrame, commit: bool = True
+) -> int:
+    """Replace the exposure cells of every (etf_id, dt) in cube
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        cube (pd.DataFrame): output of build_exposures
+        commit (bool): commit the transaction, False to leave it to the caller
+
+    Returns:
+        int: number of cells written
+    """
+    if cube.empty:
+        return 0
+    keys = list(cube[["etf_id", "dt"]].drop_duplicates().itertuples(index=False))
+    try:
+        ids = category_ids(conn, cube)
+        records = [
+            (
+                int(row.etf_id),
+                row.dt,
+                ids[(row.dimension, row.name)],
+                int(row.positions),
+                float(row.weight),
+                float(row.market_value),
+            )
+            for row in cube.itertuples(index=False)
+        ]
+        with conn.cursor() as cursor:
+            for etf_id, dt in keys:
+                cursor.execute(
+                    "DELETE FROM etf_exposures WHERE etf_id = %s AND dt = %s;",
+                    (int(etf_id), dt),
+                )
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO etf_exposures "
+                "(etf_id, dt, category_id, positions, weight, market_value) VALUES %s",
+                records,
+                page_size=1000,
+            )
+    except Exception:
+        conn.rollback()
+        raise
+    if commit:
+        conn.commit()
+    return len(records)
+
+
+def update_exposures(
+    conn: psycopg2.extensions.connection, df: pd.DataFrame, commit: bool = True
+) -> int:
+    """Build and store the exposure cells of freshly cleaned holdings
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        df (pd.DataFrame): output of csv_cleaning.exposure_rows
+        commit (bool): commit the transaction, False to leave it to the caller
+
+    Returns:
+        int: number of cells written
+    """
+    logger = logging.getLogger(__name__ + ".update_exposures")
+
+    cells = store_exposures(conn, build_exposures(df), commit)
+    logger.debug(f"Stored {cells} exposure cells")
+    return cells
+
+
+def get_exposures(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    dimension: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> pd.DataFrame:
+    """Exposure of an etf to every category of a dimension over time
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): the etf
+        dimension (str): one of DIMENSIONS
+        start (date, optional): first date, inclusive
+        end (date, optional): last date, inclusive
+
+    Returns:
+        pd.DataFrame: dt, name, positions, weight and market_value
+    """
+    df = pd.read_sql(
+        EXPOSURES_QUERY,
+        conn,
+        params={"etf_id": etf_id, "dimension": dimension, "start": start, "end": end},
+    )
+    df[["weight", "market_value"]] = df[["weight", "market_value"]].astype(float)
+    return df
@@ -0,0 +1,410 @@
+import argparse
+import configparser as cp
+import logging
+from datetime import date
+from typing import List, Optional, Sequence
+
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+import interval_storage
+import log_setup
+import run_manifest
+from run_manifest import RunManifest
+
+# rolling windows in trading days, a trading day is a date the etf was loaded
+WINDOWS = (5, 20, 60)
+FLOW_COLS = ["shares_change", "market_val_change"]
+
+RECENT_DATES_QUERY = """
+    SELECT dt FROM etf_flow_dates
+    WHERE etf_id = %s
+    ORDER BY dt DESC
+    LIMIT %s;
+"""
+
+HOLDINGS_DATES_QUERY = {
+    interval_storage.ROWS: (
+        "SELECT DISTINCT dt FROM etf_holdings WHERE etf_id = %s AND dt <= %s;"
+    ),
+    interval_storage.INTERVALS: (
+        "SELECT dt FROM etf_snapshot_dates WHERE etf_id = %s AND dt <= %s;"
+    ),
+}
+
+HOLDINGS_ON_DATES_QUERY = """
+    SELECT stock_id, dt, num_shares, market_value
+    FROM etf_holdings
+    WHERE etf_id = %s AND dt = ANY(%s::DATE[]);
+"""
+
+TOP_FLOWS_QUERY = """
+    SELECT
+        etf,
+        etf_name,
+        stock,
+        stock_name,
+        dt,
+        window_days,
+        shares_change,
+        market_val_change
+    FROM
+        (
+            SELECT
+                s2.symbol AS etf,
+                s2.name AS etf_name,
+                s1.symbol AS stock,
+                s1.name AS stock_name,
+                d.dt,
+                w.window_days,
+                w.shares_change,
+                w.market_val_change,
+                rank() OVER (
+                    PARTITION BY w.etf_id,
+                    w.window_days
+                    ORDER BY
+                        w.shares_change DESC
+                )
+            FROM
+                etf_flow_windows w
+                JOIN (
+                    SELECT etf_id, MAX(dt) AS dt FROM etf_flow_dates GROUP BY etf_id
+                ) d ON w.etf_id = d.etf_id
+                LEFT JOIN stocks s1 ON w.stock_id = s1.id
+                LEFT JOIN stocks s2 ON w.etf_id = s2.id
+        ) flow_rank
+    WHERE
+        rank <= %(top_n)s
+        AND shares_change <> 0
+    ORDER BY
+        etf,
+        window_days,
+        ABS(shares_change) DESC;
+"""
+
+
+def holdings_on_dates(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    dates: Sequence[date],
+    storage_mode: str = interval_storage.ROWS,
+) -> pd.DataFrame:
+    """Shares and market value of an etf's positions on a few dates
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): id of the etf
+        dates (Sequence[date]): dates to read
+        storage_mode (str): read etf_holdings (rows, both) or etf_positions (intervals)
+
+    Returns:
+        pd.DataFrame: num_shares and market_value indexed by (dt, stock_id)
+    """
+    if storage_mode == interval_storage.INTERVALS:
+        frames = [interval_storage.snapshot_as_of(conn, dt, etf_id) for dt in dates]
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        with conn.cursor() as cursor:
+            cursor.execute(HOLDINGS_ON_DATES_QUERY, (etf_id, list(dates)))
+            df = pd.DataFrame(
+                cursor.fetchall(),
+                columns=["stock_id", "dt", "num_shares", "market_value"],
+            )
+    df["dt"] = pd.to_datetime(df["dt"]).dt.date
+    df = df.set_index(["dt", "stock_id"])[["num_shares", "market_value"]]
+    return df.astype(float)
+
+
+def holdings_change(holdings: pd.DataFrame, new: date, old: date) -> pd.DataFrame:
+    """Change in shares and market value of every position between two dates
+
+    Positions missing on one of the dates count as zero.
+
+    Args:
+        holdings (pd.DataFrame): output of holdings_on_dates
+        new (date): later date
+        old (date): earlier date
+
+    Returns:
+        pd.DataFrame: shares_change and market_val_change indexed by stock_id
+    """
+    dates = holdings.index.get_level_values("dt")
+    new_values = holdings[dates == new].droplevel("dt")
+    old_values = holdings[dates == old].droplevel("dt")
+    change = new_values.sub(old_values, fill_value=0)
+    change.columns = FLOW_COLS
+    return change
+
+
+def read_windows(conn: psycopg2.extensions.connection, etf_id: int) -> pd.DataFrame:
+    """Current window aggregates of an etf, indexed by (window_days, stock_id)"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT window_days, stock_id, shares_change, market_val_change "
+            "FROM etf_flow_windows WHERE etf_id = %s;",
+            (etf_id,),
+        )
+        df = pd.DataFrame(
+            cursor.fetchall(), columns=["window_days", "stock_id"] + FLOW_COLS
+        )
+    return df.set_index(["window_days", "stock_id"]).astype(float)
+
+
+def write_windows(
+    conn: psycopg2.extensions.connection, etf_id: int, windows: pd.DataFrame
+) -> int:
+    """Replace the window aggregates of an etf, zero windows are not stored
+
+    Runs in the caller's transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): id of the etf
+        windows (pd.DataFrame): FLOW_COLS indexed by (window_days, stock_id)
+
+    Returns:
+        int: number of rows stored
+    """
+    windows = windows.round(2)
+    windows = windows[(windows[FLOW_COLS] != 0).any(axis=1)]
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM etf_flow_windows WHERE etf_id = %s;", (etf_id,))
+        if not windows.empty:
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                INSERT INTO etf_flow_windows
+                    (etf_id, window_days, stock_id, shares_change, market_val_change)
+                VALUES %s
+                """,
+                [
+                    (etf_id, int(window_days), int(stock_id), shares, market_val)
+                    for (
+                        window_days,
+                        stock_id,
+                    ), shares, market_val in windows.itertuples(name=None)
+                ],
+            )
+    return windows.shape[0]
+
+
+def seed_flow_dates(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    storage_mode: str = interval_storage.ROWS,
+    until: date = date.max,
+) -> None:
+    """Copy the loaded dates of an etf into etf_flow_dates, one full history scan
+
+    Runs in the caller's transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): id of the etf
+        storage_mode (str): where the holdings are stored
+        until (date): last date to copy
+    """
+    mode = interval_storage.INTERVALS
+    if storage_mode != interval_storage.INTERVALS:
+        mode = interval_storage.ROWS
+    with conn.cursor() as cursor:
+        cursor.execute(HOLDINGS_DATES_QUERY[mode], (etf_id, until))
+        dates = [row[0] for row in cursor.fetchall()]
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO etf_flow_dates (etf_id, dt) VALUES %s ON CONFLICT DO NOTHING",
+            [(etf_id, dt) for dt in dates],
+        )
+
+
+def recent_dates(
+    conn: psycopg2.extensions.connection, etf_id: int, n: int
+) -> List[date]:
+    """The n latest trading dates of an etf, newest first"""
+    with conn.cursor() as cursor:
+        cursor.execute(RECENT_DATES_QUERY, (etf_id, n))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def rebuild_windows(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    windows: Sequence[int] = WINDOWS,
+    storage_mode: str = interval_storage.ROWS,
+) -> int:
+    """Recompute the windows of an etf from its holdings, up to its latest date
+
+    Each window is the change between the latest date and the date `window`
+    trading days before it (or the first date when there are fewer). Runs in
+    the caller's transaction.
+
+    Returns:
+        int: number of rows stored
+    """
+    dates = recent_dates(conn, etf_id, max(windows) + 1)
+    if not dates:
+        return write_windows(conn, etf_id, pd.DataFrame(columns=FLOW_COLS))
+    bases = {n: dates[min(n, len(dates) - 1)] for n in windows}
+    holdings = holdings_on_dates(
+        conn, etf_id, sorted({dates[0], *bases.values()}), storage_mode
+    )
+    result = pd.concat(
+        {n: holdings_change(holdings, dates[0], base) for n, base in bases.items()},
+        names=["window_days", "stock_id"],
+    )
+    return write_windows(conn, etf_id, result)
+
+
+def update_flow_windows(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    dt: date,
+    windows: Sequence[int] = WINDOWS,
+    storage_mode: str = interval_storage.ROWS,
+) -> Optional[int]:
+    """Roll the windows of an etf forward to a newly loaded date
+
+    The day's change is added to every window and the change of the day that
+    falls out of each window is subtracted, so only a handful of dates are read
+    however long the history or the windows are. The first update of an etf,
+    or a date older than its latest one (a backfill), rebuilds the windows
+    from the holdings instead.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): id of the etf
+        dt (date): the newly loaded as-of date
+        windows (Sequence[int]): window lengths in trading days
+        storage_mode (str): where the holdings are stored
+
+    Returns:
+        Optional[int]: number of window rows stored, None if dt was already applied
+    """
+    logger = logging.getLogger(__name__ + ".update_flow_windows")
+
+    etf_id = int(etf_id)
+    try:
+        dates = recent_dates(conn, etf_id, max(windows) + 1)
+        if dt in dates:
+            logger.debug(f"ETF {etf_id} windows already include {dt}")
+            conn.rollback()
+            return None
+
+        if not dates or dates[0] > dt:
+            logger.info(f"Rebuilding flow windows of ETF {etf_id}")
+            if not dates:
+                seed_flow_dates(conn, etf_id, storage_mode, until=dt)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO etf_flow_dates (etf_id, dt) VALUES (%s, %s) "
+                    "ON CONFLICT DO NOTHING;",
+                    (etf_id, dt),
+                )
+            rows = rebuild_windows(conn, etf_id, windows, storage_mode)
+            conn.commit()
+            return rows
+
+        # dates[i] is i + 1 trading days before dt
+        dates = [dt] + dates
+        needed = {dt, dates[1]}
+        for n in windows:
+            needed.update(dates[n : n + 2])
+        holdings = holdings_on_dates(conn, etf_id, sorted(needed), storage_mode)
+
+        day = holdings_change(holdings, dates[0], dates[1])
+        deltas = {}
+        for n in windows:
+            if len(dates) > n + 1:
+                dropped = holdings_change(holdings, dates[n], dates[n + 1])
+                deltas[n] = day.sub(dropped, fill_value=0)
+            else:
+                deltas[n] = day
+        deltas = pd.concat(deltas, names=["window_days", "stock_id"])
+
+        result = read_windows(conn, etf_id).add(deltas, fill_value=0)
+        rows = write_windows(conn, etf_id, result)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO etf_flow_dates (etf_id, dt) VALUES (%s, %s);",
+                (etf_id, dt),
+            )
+    except Exception:
+        conn.rollback()
+        raise
+
+    conn.commit()
+    return rows
+
+
+def update_flows(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    manifest: RunManifest,
+) -> None:
+    """Roll the flow windows of every etf loaded in this run forward"""
+    logger = logging.getLogger(__name__ + ".update_flows")
+
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    for etf_id, entry in manifest.etfs.items():
+        if entry.get("state") != run_manifest.LOADED or not entry.get("as_of"):
+            continue
+        try:
+            update_flow_windows(
+                conn,
+                etf_id,
+                date.fromisoformat(entry["as_of"]),
+                storage_mode=storage_mode,
+            )
+        except Exception as e:
+            logger.warning(f"Flow windows of ETF {etf_id} not updated: {e}")
+
+
+def get_top_flows(conn: psycopg2.extensions.connection, top_n: int = 5) -> pd.DataFrame:
+    """Largest share changes of every etf over each window, for the dashboard
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        top_n (int): positions to keep per etf and window
+
+    Returns:
+        pd.DataFrame: shaped like the dashboard's top changes, plus window_days
+    """
+    return pd.read_sql(TOP_FLOWS_QUERY, conn, params={"top_n": top_n})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rebuild the rolling flow windows, e.g. after a backfill"
+    )
+    parser.add_argument("etf_ids", nargs="*", type=int, help="default all etfs")
+    opts = parser.parse_args()
+
+    log_setup.setup_logging("./python_scripts/log/flow_windows.log")
+    logger = logging.getLogger(__name__)
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+    conn = psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+
+    etf_ids = opts.etf_ids
+    if not etf_ids:
+        etf_ids = pd.read_sql("SELECT etf_id FROM etf_urls;", conn)["etf_id"].tolist()
+    for etf_id in etf_ids:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM etf_flow_dates WHERE etf_id = %s;", (etf_id,))
+        seed_flow_dates(conn, etf_id, storage_mode)
+        rows = rebuild_windows(conn, etf_id, storage_mode=storage_mode)
+        conn.commit()
+        logger.info(f"ETF {etf_id}: {rows} window rows")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
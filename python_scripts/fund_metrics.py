@@ -0,0 +1,293 @@
+import argparse
+import configparser as cp
+import logging
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+import interval_storage
+import log_setup
+import run_manifest
+from run_manifest import RunManifest
+
+METRIC_COLS = [
+    "positions",
+    "added",
+    "removed",
+    "turnover",
+    "top10_weight",
+    "hhi",
+]
+
+# positions of a set of (etf_id, dt) snapshots
+SNAPSHOTS_QUERY = """
+    SELECT h.etf_id, h.stock_id, h.dt, h.weight::DOUBLE PRECISION AS weight
+    FROM etf_holdings h
+    WHERE (h.etf_id, h.dt) IN (
+        SELECT * FROM unnest(%s::INTEGER[], %s::DATE[])
+    );
+"""
+
+# previous snapshot of each etf, the last date the metrics were computed for
+PREVIOUS_DATES_QUERY = """
+    SELECT k.etf_id, k.dt, MAX(m.dt) AS prev_dt
+    FROM unnest(%s::INTEGER[], %s::DATE[]) AS k(etf_id, dt)
+    LEFT JOIN etf_daily_metrics m ON m.etf_id = k.etf_id AND m.dt < k.dt
+    GROUP BY k.etf_id, k.dt;
+"""
+
+LEADERBOARD_QUERY = """
+    SELECT DISTINCT ON (m.etf_id)
+        s.symbol AS etf,
+        s.name AS etf_name,
+        m.dt,
+        m.positions,
+        m.added,
+        m.removed,
+        m.turnover,
+        m.top10_weight,
+        m.hhi
+    FROM
+        etf_daily_metrics m
+        LEFT JOIN stocks s ON m.etf_id = s.id
+    ORDER BY
+        m.etf_id,
+        m.dt DESC;
+"""
+
+
+def read_snapshots(
+    conn: psycopg2.extensions.connection,
+    pairs: pd.DataFrame,
+    storage_mode: str = interval_storage.ROWS,
+) -> pd.DataFrame:
+    """Weights of every position of a set of snapshots
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        pairs (pd.DataFrame): etf_id and dt of the snapshots to read
+        storage_mode (str): read etf_holdings (rows, both) or etf_positions (intervals)
+
+    Returns:
+        pd.DataFrame: etf_id, stock_id, dt and weight
+    """
+    if storage_mode == interval_storage.INTERVALS:
+        frames = [
+            interval_storage.snapshot_as_of(conn, dt)
+            for dt in pairs["dt"].drop_duplicates()
+        ]
+        df = pd.concat(frames, ignore_index=True)[
+            ["etf_id", "stock_id", "dt", "weight"]
+        ]
+        df["dt"] = pd.to_datetime(df["dt"]).dt.date
+        df = df.merge(pairs[["etf_id", "dt"]].drop_duplicates(), on=["etf_id", "dt"])
+    else:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                SNAPSHOTS_QUERY,
+                (pairs["etf_id"].astype(int).tolist(), pairs["dt"].tolist()),
+            )
+            df = pd.DataFrame(
+                cursor.fetchall(), columns=["etf_id", "stock_id", "dt", "weight"]
+            )
+    df["weight"] = df["weight"].astype(float)
+    return df
+
+
+def compute_metrics(holdings: pd.DataFrame, pairs: pd.DataFrame) -> pd.DataFrame:
+    """Turnover, position changes and concentration of many snapshots at once
+
+    Every measure is a group-reduce over all the snapshots together, there is
+    no loop over etfs. Turnover is half the sum of absolute weight changes
+    against the previous snapshot; HHI is the sum of squared weights, after
+    scaling the weights of the snapshot to sum to one.
+
+    Args:
+        holdings (pd.DataFrame): etf_id, stock_id, dt and weight, covering the
+            snapshots and their previous snapshots
+        pairs (pd.DataFrame): etf_id, dt and prev_dt (None for a first snapshot)
+
+    Returns:
+        pd.DataFrame: etf_id, dt and METRIC_COLS, one row per pair
+    """
+    keys = ["etf_id", "dt"]
+    current = holdings.merge(pairs[keys], on=keys)
+    previous = holdings.rename(columns={"dt": "prev_dt"}).merge(
+        pairs.dropna(subset=["prev_dt"]), on=["etf_id", "prev_dt"]
+    )[keys + ["stock_id", "weight"]]
+
+    merged = current.merge(
+        previous,
+        on=keys + ["stock_id"],
+        how="outer",
+        suffixes=("", "_prev"),
+        indicator=True,
+    )
+    merged["weight_change"] = (
+        merged["weight"].fillna(0) - merged["weight_prev"].fillna(0)
+    ).abs()
+    merged["added"] = merged["_merge"] == "left_only"
+    merged["removed"] = merged["_merge"] == "right_only"
+    changes = merged.groupby(keys).agg(
+        turnover=("weight_change", "sum"),
+        added=("added", "sum"),
+        removed=("removed", "sum"),
+    )
+    changes["turnover"] /= 2
+
+    grouped = current.groupby(keys)["weight"]
+    share = current["weight"] / grouped.transform("sum")
+    top10 = (
+        current.sort_values(keys + ["weight"], ascending=[True, True, False])
+        .groupby(keys)
+        .head(10)
+        .groupby(keys)["weight"]
+        .sum()
+    )
+    concentration = pd.DataFrame(
+        {
+            "positions": grouped.size(),
+            "top10_weight": top10,
+            "hhi": (share**2).groupby([current["etf_id"], current["dt"]]).sum(),
+        }
+    )
+
+    metrics = pairs[keys + ["prev_dt"]].merge(
+        concentration.join(changes).reset_index(), on=keys, how="left"
+    )
+    # nothing to compare a first snapshot with
+    first = metrics["prev_dt"].isna()
+    metrics.loc[first, ["added", "removed", "turnover"]] = np.nan
+    metrics = metrics.dropna(subset=["positions"])
+    return metrics[keys + METRIC_COLS]
+
+
+def store_metrics(conn: psycopg2.extensions.connection, metrics: pd.DataFrame) -> int:
+    """Upsert metrics rows into etf_daily_metrics
+
+    Returns:
+        int: number of rows written
+    """
+    records = (
+        metrics[["etf_id", "dt"] + METRIC_COLS]
+        .astype(object)
+        .where(metrics.notna(), None)
+        .itertuples(index=False, name=None)
+    )
+    try:
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                f"""
+                INSERT INTO etf_daily_metrics (etf_id, dt, {", ".join(METRIC_COLS)})
+                VALUES %s
+                ON CONFLICT (etf_id, dt) DO UPDATE SET
+                {", ".join(f"{col} = EXCLUDED.{col}" for col in METRIC_COLS)}
+                """,
+                [(int(etf_id), dt) + tuple(values) for etf_id, dt, *values in records],
+            )
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return metrics.shape[0]
+
+
+def update_metrics(
+    conn: psycopg2.extensions.connection,
+    config: cp.ConfigParser,
+    manifest: RunManifest,
+) -> None:
+    """Compute the metrics of every snapshot loaded in this run"""
+    logger = logging.getLogger(__name__ + ".update_metrics")
+
+    loaded = [
+        (int(etf_id), date.fromisoformat(entry["as_of"]))
+        for etf_id, entry in manifest.etfs.items()
+        if entry.get("state") == run_manifest.LOADED and entry.get("as_of")
+    ]
+    if not loaded:
+        logger.info("No new snapshots")
+        return None
+
+    etf_ids, dates = zip(*loaded)
+    with conn.cursor() as cursor:
+        cursor.execute(PREVIOUS_DATES_QUERY, (list(etf_ids), list(dates)))
+        pairs = pd.DataFrame(cursor.fetchall(), columns=["etf_id", "dt", "prev_dt"])
+
+    snapshots = pd.concat(
+        [
+            pairs[["etf_id", "dt"]],
+            pairs.dropna(subset=["prev_dt"])[["etf_id", "prev_dt"]].rename(
+                columns={"prev_dt": "dt"}
+            ),
+        ]
+    )
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    holdings = read_snapshots(conn, snapshots, storage_mode)
+    rows = store_metrics(conn, compute_metrics(holdings, pairs))
+    logger.info(f"Stored metrics of {rows} snapshots")
+
+
+def rebuild_metrics(
+    conn: psycopg2.extensions.connection,
+    etf_id: int,
+    storage_mode: str = interval_storage.ROWS,
+) -> int:
+    """Compute the metrics of every snapshot of an etf from its full history"""
+    holdings_table = interval_storage.holdings_table(storage_mode)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT etf_id, stock_id, dt, weight::DOUBLE PRECISION "
+            f"FROM {holdings_table} WHERE etf_id = %s;",
+            (etf_id,),
+        )
+        holdings = pd.DataFrame(
+            cursor.fetchall(), columns=["etf_id", "stock_id", "dt", "weight"]
+        )
+    if holdings.empty:
+        return 0
+    pairs = holdings[["etf_id", "dt"]].drop_duplicates().sort_values("dt")
+    pairs["prev_dt"] = pairs["dt"].shift()
+    return store_metrics(conn, compute_metrics(holdings, pairs))
+
+
+def get_leaderboard(conn: psycopg2.extensions.connection) -> pd.DataFrame:
+    """Latest metrics of every etf, for the dashboard leaderboard"""
+    return pd.read_sql(LEADERBOARD_QUERY, conn)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Rebuild the daily etf metrics from the holdings history"
+    )
+    parser.add_argument("etf_ids", nargs="*", type=int, help="default all etfs")
+    opts = parser.parse_args()
+
+    log_setup.setup_logging("./python_scripts/log/fund_metrics.log")
+    logger = logging.getLogger(__name__)
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+    conn = psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    etf_ids = opts.etf_ids
+    if not etf_ids:
+        etf_ids = pd.read_sql("SELECT etf_id FROM etf_urls;", conn)["etf_id"].tolist()
+    for etf_id in etf_ids:
+        rows = rebuild_metrics(conn, etf_id, storage_mode)
+        logger.info(f"ETF {etf_id}: metrics of {rows} snapshots")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import logging
+import threading
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import interval_storage
+from sql_methods import read_sql_copy
+
+# snapshot dates kept in memory
+KEEP_DATES = 5
+HOLDER_COLS = ["etf_id", "weight", "num_shares", "shares_change"]
+
+# the rows mode dates come from etf_holdings itself, one index probe per date
+RECENT_DATES_QUERY = {
+    interval_storage.ROWS: """
+        WITH RECURSIVE dates AS (
+            SELECT MAX(dt) AS dt FROM etf_holdings
+            UNION ALL
+            SELECT (SELECT MAX(h.dt) FROM etf_holdings h WHERE h.dt < d.dt)
+            FROM dates d
+            WHERE d.dt IS NOT NULL
+        )
+        SELECT dt FROM dates WHERE dt IS NOT NULL LIMIT %s;
+    """,
+    interval_storage.INTERVALS: (
+        "SELECT DISTINCT dt FROM etf_snapshot_dates ORDER BY dt DESC LIMIT %s;"
+    ),
+}
+
+# etfs with a snapshot on a date and the date of their previous snapshot
+PREVIOUS_SNAPSHOTS_QUERY = """
+    SELECT t.etf_id, MAX(d.dt) AS prev_dt
+    FROM
+        etf_snapshot_dates t
+        LEFT JOIN etf_snapshot_dates d ON d.etf_id = t.etf_id AND d.dt < t.dt
+    WHERE t.dt = %(dt)s
+    GROUP BY t.etf_id;
+"""
+
+# every position on a date, plus positions sold out since the etf's previous date
+HOLDERS_QUERY = """
+    WITH prev_dates AS (
+        SELECT
+            e.etf_id,
+            (
+                SELECT MAX(h.dt)
+                FROM etf_holdings h
+                WHERE h.etf_id = e.etf_id AND h.dt < %(dt)s
+            ) AS dt
+        FROM (SELECT DISTINCT etf_id FROM etf_holdings WHERE dt = %(dt)s) e
+    ),
+    today AS (
+        SELECT etf_id, stock_id, weight, num_shares
+        FROM etf_holdings
+        WHERE dt = %(dt)s
+    ),
+    prev AS (
+        SELECT h.etf_id, h.stock_id, h.num_shares
+        FROM etf_holdings h
+        JOIN prev_dates d ON h.etf_id = d.etf_id AND h.dt = d.dt
+        WHERE h.etf_id IN (SELECT etf_id FROM today)
+    )
+    SELECT
+        COALESCE(t.stock_id, p.stock_id) AS stock_id,
+        COALESCE(t.etf_id, p.etf_id) AS etf_id,
+        COALESCE(t.weight, 0) AS weight,
+        COALESCE(t.num_shares, 0) AS num_shares,
+        COALESCE(t.num_shares, 0) - COALESCE(p.num_shares, 0) AS shares_change
+    FROM
+        today t
+        FULL OUTER JOIN prev p ON t.etf_id = p.etf_id
+        AND t.stock_id = p.stock_id;
+"""
+
+
+class DateIndex:
+    """Holders of every stock on one snapshot date
+
+    Rows are sorted by stock_id and each stock maps to its slice of rows, so a
+    lookup costs O(holders) whatever the number of etfs and positions.
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        df = df.sort_values(["stock_id", "weight"], ascending=[True, False])
+        stock_ids = df["stock_id"].to_numpy()
+        self.frame = df[HOLDER_COLS].reset_index(drop=True)
+        self.offsets = {}
+        if len(stock_ids):
+            # first row of every run of equal stock ids
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(stock_ids)) + 1])
+            ends = np.append(starts[1:], len(stock_ids))
+            self.offsets = {
+                int(stock_ids[start]): (int(start), int(end))
+                for start, end in zip(starts, ends)
+            }
+
+    def holders(self, stock_id: int) -> pd.DataFrame:
+        """Etfs holding (or having just sold) a stock, largest weight first"""
+        start, end = self.offsets.get(int(stock_id), (0, 0))
+        return self.frame.iloc[start:end]
+
+
+class HoldersIndex:
+    """Inverted index from stock to the etfs holding it, per snapshot date
+
+    Refreshing only builds the dates that are not indexed yet and drops the
+    oldest ones beyond `keep`.
+    """
+
+    def __init__(self, keep: int = KEEP_DATES) -> None:
+        self.keep = keep
+        self.dates: Dict[date, DateIndex] = {}
+        self.symbols: Dict[str, int] = {}
+        self.names: Dict[int, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def add_date(self, dt: date, df: pd.DataFrame) -> None:
+        """Index the holders of one date, replacing any earlier index of it"""
+        date_index = DateIndex(df)
+        with self._lock:
+            self.dates[dt] = date_index
+            for old in sorted(self.dates)[: -self.keep]:
+                del self.dates[old]
+
+    def set_stocks(self, stocks: pd.DataFrame) -> None:
+        """Set the symbol and name of every stock from (id, symbol, name) rows"""
+        symbols = dict(zip(stocks["symbol"].str.upper(), stocks["id"]))
+        names = dict(zip(stocks["id"], zip(stocks["symbol"], stocks["name"])))
+        with self._lock:
+            self.symbols = symbols
+            self.names = names
+
+    def latest_date(self) -> Optional[date]:
+        with self._lock:
+            return max(self.dates, default=None)
+
+    def holders(self, symbol: str, dt: Optional[date] = None) -> pd.DataFrame:
+        """Etfs holding a stock on a date, with their weight, shares and change
+
+        Args:
+            symbol (str): ticker of the stock, case insensitive
+            dt (date, optional): snapshot date. Defaults to the latest indexed date
+
+        Returns:
+            pd.DataFrame: one row per etf, largest weight first, empty if unknown
+        """
+        with self._lock:
+            stock_id = self.symbols.get(symbol.strip().upper())
+            dt = dt or max(self.dates, default=None)
+            date_index = self.dates.get(dt)
+        if stock_id is None or date_index is None:
+            return pd.DataFrame(columns=["etf", "etf_name", "dt"] + HOLDER_COLS)
+
+        df = date_index.holders(stock_id).copy()
+        etf_names = [self.names.get(etf_id, ("", "")) for etf_id in df["etf_id"]]
+        df.insert(0, "etf", [etf for etf, _ in etf_names])
+        df.insert(1, "etf_name", [name for _, name in etf_names])
+        df["dt"] = dt
+        return df
+
+
+def load_holders(
+    conn: psycopg2.extensions.connection,
+    dt: date,
+    storage_mode: str = interval_storage.ROWS,
+) -> pd.DataFrame:
+    """Every position on a date with its change since the etf's previous date
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        dt (date): snapshot date
+        storage_mode (str): read etf_holdings (rows, both) or etf_positions (intervals)
+
+    Returns:
+        pd.DataFrame: stock_id and HOLDER_COLS, positions sold out since the
+            previous date with a weight and shares of 0
+    """
+    if storage_mode != interval_storage.INTERVALS:
+        return read_sql_copy(HOLDERS_QUERY, conn, params={"dt": dt})
+
+    with conn.cursor() as cursor:
+        cursor.execute(PREVIOUS_SNAPSHOTS_QUERY, {"dt": dt})
+        pairs = pd.DataFrame(cursor.fetchall(), columns=["etf_id", "prev_dt"])
+    cols = ["etf_id", "stock_id", "weight", "num_shares"]
+    today = interval_storage.snapshot_as_of(conn, dt)[cols]
+    today = today[today["etf_id"].isin(pairs["etf_id"])]
+    prev = [
+        interval_storage.snapshot_as_of(conn, prev_dt)[cols].merge(
+            pairs.loc[pairs["prev_dt"] == prev_dt, ["etf_id"]]
+        )
+        for prev_dt in pairs["prev_dt"].dropna().unique()
+    ]
+    prev = pd.concat([pd.DataFrame(columns=cols)] + prev, ignore_index=True)
+
+    df = today.merge(
+        prev[["etf_id", "stock_id", "num_shares"]],
+        on=["etf_id", "stock_id"],
+        how="outer",
+        suffixes=("", "_prev"),
+    )
+    df[["weight", "num_shares", "num_shares_prev"]] = (
+        df[["weight", "num_shares", "num_shares_prev"]].astype(float).fillna(0)
+    )
+    df["shares_change"] = df["num_shares"] - df["num_shares_prev"]
+    df[["etf_id", "stock_id"]] = df[["etf_id", "stock_id"]].astype(int)
+    return df[["stock_id"] + HOLDER_COLS]
+
+
+def refresh_index(
+    index: HoldersIndex,
+    conn: psycopg2.extensions.connection,
+    storage_mode: str = interval_storage.ROWS,
+) -> List[date]:
+    """Bring the index up to date with the latest snapshot dates
+
+    Args:
+        index (HoldersIndex): the index to update in place
+        conn (psycopg2.extensions.connection): database connection object
+        storage_mode (str): where the holdings are stored
+
+    Returns:
+        List[date]: dates that were (re)built
+    """
+    logger = logging.getLogger(__name__ + ".refresh_index")
+
+    mode = interval_storage.INTERVALS
+    if storage_mode != interval_storage.INTERVALS:
+        mode = interval_storage.ROWS
+    with conn.cursor() as cursor:
+        cursor.execute(RECENT_DATES_QUERY[mode], (index.keep,))
+        recent = [row[0] for row in cursor.fetchall()]
+    # the latest date is rebuilt as etfs published late are still arriving
+    todo = [dt for dt in recent if dt not in index.dates or dt == max(recent)]
+
+    index.set_stocks(pd.read_sql("SELECT id, symbol, name FROM stocks;", conn))
+    for dt in sorted(todo):
+        df = load_holders(conn, dt, storage_mode)
+        df[HOLDER_COLS[1:]] = df[HOLDER_COLS[1:]].astype(float)
+        index.add_date(dt, df)
+        logger.info(f"Indexed {df.shape[0]} positions as of {dt}")
+    return todo
@@ -0,0 +1,279 @@
+import argparse
+import configparser as cp
+import logging
+from datetime import date
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import flask
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import interval_storage
+import log_setup
+from admin_auth import require_admin_token
+
+# rows fetched from the server side cursor at a time
+CHUNK_ROWS = 50_000
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+# longest date range the endpoint exports when no etf is given
+MAX_EXPORT_DAYS = 31
+
+EXPORT_SCHEMA = pa.schema(
+    [
+        ("etf", pa.string()),
+        ("etf_name", pa.string()),
+        ("stock", pa.string()),
+        ("stock_name", pa.string()),
+        ("dt", pa.date32()),
+        ("num_shares", pa.float64()),
+        ("weight", pa.float64()),
+        ("market_value", pa.float64()),
+        ("average_price", pa.float64()),
+    ]
+)
+
+EXPORT_QUERY = """
+    SELECT
+        s2.symbol AS etf,
+        s2.name AS etf_name,
+        s1.symbol AS stock,
+        s1.name AS stock_name,
+        h.dt,
+        h.num_shares::DOUBLE PRECISION AS num_shares,
+        h.weight::DOUBLE PRECISION AS weight,
+        h.market_value::DOUBLE PRECISION AS market_value,
+        h.average_price::DOUBLE PRECISION AS average_price
+    FROM
+        {holdings} h
+        LEFT JOIN stocks s1 ON h.stock_id = s1.id
+        LEFT JOIN stocks s2 ON h.etf_id = s2.id
+    WHERE
+        (%(start)s::DATE IS NULL OR h.dt >= %(start)s)
+        AND (%(end)s::DATE IS NULL OR h.dt <= %(end)s)
+        AND (%(etfs)s::TEXT[] IS NULL OR s2.symbol = ANY(%(etfs)s))
+        AND (%(stocks)s::TEXT[] IS NULL OR s1.symbol = ANY(%(stocks)s))
+    ORDER BY
+        h.dt,
+        s2.symbol,
+        s1.symbol;
+"""
+
+
+def iter_chunks(
+    conn: psycopg2.extensions.connection,
+    etfs: Optional[List[str]] = None,
+    stocks: Optional[List[str]] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    chunk_rows: int = CHUNK_ROWS,
+    storage_mode: str = interval_storage.ROWS,
+) -> Iterator[pd.DataFrame]:
+    """Read a selection of holdings through a server side cursor
+
+    Only one chunk is held in memory at a time, however large the selection.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etfs (List[str], optional): etf symbols, default all
+        stocks (List[str], optional): stock symbols, default all
+        start (date, optional): first date, inclusive
+        end (date, optional): last date, inclusive
+        chunk_rows (int): rows per chunk
+        storage_mode (str): read etf_holdings (rows, both) or the snapshots
+            rebuilt from etf_positions (intervals)
+
+    Yields:
+        pd.DataFrame: EXPORT_SCHEMA columns, at most chunk_rows rows
+    """
+    params = {
+        "etfs": etfs or None,
+        "stocks": stocks or None,
+        "start": start,
+        "end": end,
+    }
+    with conn.cursor(name="holdings_export") as cursor:
+        cursor.itersize = chunk_rows
+        cursor.execute(
+            EXPORT_QUERY.format(holdings=interval_storage.holdings_table(storage_mode)),
+            params,
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=EXPORT_SCHEMA.names)
+
+
+class ChunkSink:
+    """Write-only file object whose buffered bytes can be taken as they arrive"""
+
+    def __init__(self) -> None:
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        """The bytes written since the last call"""
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def iter_csv(chunks: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    """Encode chunks as one csv, header first"""
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=header).encode()
+        header = False
+    if header:
+        yield (",".join(EXPORT_SCHEMA.names) + "\n").encode()
+
+
+def iter_parquet(chunks: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    """Encode chunks as one parquet file, one row group per chunk"""
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), EXPORT_SCHEMA)
+    try:
+        for chunk in chunks:
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=EXPORT_SCHEMA, preserve_index=False)
+            )
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+ENCODERS = {"csv": iter_csv, "parquet": iter_parquet}
+
+
+def parse_symbols(values: List[str]) -> Optional[List[str]]:
+    """Symbols from repeated or comma separated parameters, upper cased"""
+    symbols = [s.strip().upper() for v in values for s in v.split(",") if s.strip()]
+    return symbols or None
+
+
+def parse_date(value: Optional[str]) -> Optional[date]:
+    """A YYYY-MM-DD parameter, None if empty"""
+    return date.fromisoformat(value) if value else None
+
+
+def register_export_endpoint(
+    server: flask.Flask,
+    connect: Callable[[], psycopg2.extensions.connection],
+    path: str = "/export/holdings",
+    storage_mode: str = interval_storage.ROWS,
+) -> None:
+    """Stream holdings as csv or parquet
+
+    Query parameters: `etf` and `stock` (repeated or comma separated symbols),
+    `start` and `end` (YYYY-MM-DD) and `format` (csv or parquet, default csv).
+    Requests need the admin token (see admin_auth.require_admin_token) and
+    either an etf or a start and end at most MAX_EXPORT_DAYS apart.
+
+    Args:
+        server (flask.Flask): the flask server behind the dash app
+        connect (Callable): returns a new database connection
+        path (str): url of the endpoint
+        storage_mode (str): where the pipeline stores holdings
+    """
+
+    def export():
+        require_admin_token()
+        args = flask.request.args
+        fmt = args.get("format", "csv")
+        if fmt not in ENCODERS:
+            flask.abort(400, f"format must be one of {list(ENCODERS)}")
+        try:
+            start = parse_date(args.get("start"))
+            end = parse_date(args.get("end"))
+        except ValueError:
+            flask.abort(400, "start and end must be YYYY-MM-DD")
+        etfs = parse_symbols(args.getlist("etf"))
+        stocks = parse_symbols(args.getlist("stock"))
+        if etfs is None and (
+            start is None or end is None or (end - start).days > MAX_EXPORT_DAYS
+        ):
+            flask.abort(
+                400,
+                f"give an etf, or a start and end at most {MAX_EXPORT_DAYS} days apart",
+            )
+
+        def generate():
+            conn = connect()
+            try:
+                chunks = iter_chunks(
+                    conn, etfs, stocks, start, end, storage_mode=storage_mode
+                )
+                for data in ENCODERS[fmt](chunks):
+                    yield data
+            finally:
+                conn.close()
+
+        return flask.Response(
+            flask.stream_with_context(generate()),
+            mimetype=FORMATS[fmt],
+            headers={"Content-Disposition": f"attachment; filename=holdings.{fmt}"},
+        )
+
+    server.add_url_rule(path, "export_holdings", export)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export etf holdings history")
+    parser.add_argument("out_path", help="file to write, .csv or .parquet")
+    parser.add_argument("--etf", action="append", default=[], help="etf symbol(s)")
+    parser.add_argument("--stock", action="append", default=[], help="stock symbol(s)")
+    parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--format", choices=list(ENCODERS), help="default from suffix")
+    opts = parser.parse_args()
+
+    log_setup.setup_logging("./python_scripts/log/holdings_export.log")
+    logger = logging.getLogger(__name__)
+
+    fmt = opts.format or ("parquet" if opts.out_path.endswith(".parquet") else "csv")
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+    conn = psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+
+    written = 0
+    with open(opts.out_path, "wb") as f:
+        chunks = iter_chunks(
+            conn,
+            parse_symbols(opts.etf),
+            parse_symbols(opts.stock),
+            opts.start,
+            opts.end,
+            storage_mode=config.get("storage", "mode", fallback=interval_storage.ROWS),
+        )
+        for data in ENCODERS[fmt](chunks):
+            written += f.write(data)
+    conn.close()
+    logger.info(f"Wrote {written / 1024 ** 2:,.1f} MiB to {opts.out_path}")
+
+
+if __name__ == "__main__":
+    main()
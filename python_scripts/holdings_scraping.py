@@ -1,6 +1,10 @@
 import configparser as cp
+import hashlib
 import logging
+from contextlib import nullcontext
 from logging.handlers import NTEventLogHandler
+from os.path import join
+from typing import Tuple
 
 import pandas as pd
 import psycopg2
@@ -15,7 +19,22 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 import requests
 
-from sql_methods import insert_into_sql
+import log_setup
+import run_manifest
+from sql_methods import insert_into_sql, read_sql_copy
+
+TEMP_PATH = "/home/pi/dev/etf_tracking/data/temp"
+# seconds to connect to blackrock and between bytes of a csv download
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+
+def download_timeout(config: cp.ConfigParser) -> Tuple[float, float]:
+    """(connect, read) timeout of a csv download, from the [download] section"""
+    return (
+        config.getfloat("download", "connect_timeout", fallback=CONNECT_TIMEOUT),
+        config.getfloat("download", "read_timeout", fallback=READ_TIMEOUT),
+    )
 
 
 def get_csv_download_url(url_input_path: str, url_output_path: str) -> None:
@@ -137,8 +156,78 @@ def insert_urls(conn: psycopg2.extensions.connection, csv_file: str) -> None:
     return None
 
 
-def download_csv(conn: psycopg2.extensions.connection) -> None:
+def download_etf_csv(
+    csv_url: str,
+    etf_id,
+    path: str,
+    metrics=None,
+    manifest=None,
+    timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+) -> bool:
+    """Download the holdings csv of a single etf
+
+    A download that times out fails the etf like any other error.
+
+    Args:
+        csv_url (str): blackrock download url of the csv
+        etf_id: id of the etf
+        path (str): where to save the csv
+        metrics (PipelineMetrics, optional): records per etf timings and bytes
+        manifest (RunManifest, optional): per etf progress of the current run
+        timeout (Tuple[float, float]): connect and read timeouts in seconds
+
+    Returns:
+        bool: True if the file was downloaded
+    """
+    logger = logging.getLogger(__name__ + ".download_etf_csv")
+
+    timer = metrics.timer("download_etf", etf_id) if metrics else nullcontext()
+    try:
+        with timer:
+            r = requests.get(csv_url, allow_redirects=True, timeout=timeout)
+            r.raise_for_status()
+            open(path, "wb").write(r.content)
+    except Exception as e:
+        logger.warning(f"Download of {etf_id} failed: {e}")
+        if manifest is not None:
+            manifest.fail(etf_id, f"download: {e}")
+        return False
+
+    if metrics is not None:
+        metrics.count("bytes_downloaded", len(r.content), etf_id)
+        metrics.count("files_downloaded")
+    if manifest is not None:
+        manifest.mark(
+            etf_id,
+            run_manifest.DOWNLOADED,
+            sha256=hashlib.sha256(r.content).hexdigest(),
+            bytes=len(r.content),
+        )
+    logger.debug(f"Done: {etf_id}")
+    return True
+
 
+def download_csv(
+    conn: psycopg2.extensions.connection,
+    metrics=None,
+    manifest=None,
+    retry_failed_only: bool = False,
+    temp_path: str = TEMP_PATH,
+    timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+) -> None:
+    """Download the holdings csv of every etf in etf_urls into data/temp
+
+    With a manifest, ETFs that are already finished or whose file on disk
+    matches the recorded hash are not downloaded again.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        metrics (PipelineMetrics, optional): records per etf timings and bytes
+        manifest (RunManifest, optional): per etf progress of the current run
+        retry_failed_only (bool): only download ETFs the manifest marks failed
+        temp_path (str): directory to save the csv files in
+        timeout (Tuple[float, float]): connect and read timeouts of each download
+    """
     logger = logging.getLogger(__name__ + ".download_csv")
     logger.info("Getting all urls...")
 
@@ -146,35 +235,26 @@ def download_csv(conn: psycopg2.extensions.connection) -> None:
         SELECT csv_url, etf_id from etf_urls;
     """
 
-    df_csvs = pd.read_sql(query, conn)
+    df_csvs = read_sql_copy(query, conn)
     df_csvs["Symbol"] = (
         df_csvs.csv_url.str.split("fileName=").str[-1].str.split("_holding").str[0]
     )
 
     for row in df_csvs.itertuples():
-        r = requests.get(row.csv_url, allow_redirects=True)
-        open(f"/home/pi/dev/etf_tracking/data/temp/{row.etf_id}.csv", "wb").write(
-            r.content
-        )
-        logger.debug(f"Done: {row.Symbol}")
+        path = join(temp_path, f"{row.etf_id}.csv")
+        if manifest is not None:
+            if not manifest.needs_work(row.etf_id, retry_failed_only):
+                continue
+            if manifest.is_downloaded(row.etf_id, path):
+                logger.debug(f"Already downloaded: {row.Symbol}")
+                continue
+        download_etf_csv(row.csv_url, row.etf_id, path, metrics, manifest, timeout)
 
     return None
 
 
 def main():
-    file_handler = logging.FileHandler("log/holdings_scraping.log")
-    file_handler.setLevel(logging.DEBUG)
-
-    sys_handler = logging.StreamHandler()
-    sys_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter(
-        "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-    )
-    file_handler.setFormatter(formatter)
-    sys_handler.setFormatter(formatter)
-
-    logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, sys_handler])
+    log_setup.setup_logging("log/holdings_scraping.log", file_level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
     # logger.info("Running method to save CSVs...")
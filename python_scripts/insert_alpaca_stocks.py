@@ -6,23 +6,12 @@ import alpaca_trade_api as trade_api
 import pandas as pd
 import psycopg2
 
+import log_setup
 import sql_methods
 
 
 def main() -> None:
-    file_handler = logging.FileHandler("log/insert_alpaca_stocks.log")
-    file_handler.setLevel(logging.DEBUG)
-
-    sys_handler = logging.StreamHandler()
-    sys_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter(
-        "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-    )
-    file_handler.setFormatter(formatter)
-    sys_handler.setFormatter(formatter)
-
-    logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, sys_handler])
+    log_setup.setup_logging("log/insert_alpaca_stocks.log", file_level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
     logger.info("Starting Program...")
@@ -39,20 +28,14 @@ def main() -> None:
     )
     logger.info("Connected to Alpaca API...")
 
-    df = pd.DataFrame(columns=["Symbol", "Name", "Exchange", "Country", "IPO_year"])
-
     logger.info("Creating df for all assets...")
-    for asset in api.list_assets(status="active"):
-        row = pd.DataFrame(
-            {
-                "Symbol": [asset.symbol],
-                "Name": [asset.name],
-                "Exchange": [asset.exchange],
-                "Country": [None],
-                "IPO_year": [None],
-            }
-        )
-        df = pd.concat([df, row])
+    df = pd.DataFrame(
+        [
+            (asset.symbol, asset.name, asset.exchange, None, None)
+            for asset in api.list_assets(status="active")
+        ],
+        columns=["Symbol", "Name", "Exchange", "Country", "IPO_year"],
+    )
     logger.debug("Done creating all assets df.")
 
     logger.info("Connecting to the psql database...")
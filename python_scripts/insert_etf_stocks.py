@@ -6,23 +6,12 @@ import numpy as np
 import pandas as pd
 import psycopg2
 
+import log_setup
 import sql_methods
 
 
 def main() -> None:
-    file_handler = logging.FileHandler("log/insert_etf_stocks.log")
-    file_handler.setLevel(logging.DEBUG)
-
-    sys_handler = logging.StreamHandler()
-    sys_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter(
-        "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-    )
-    file_handler.setFormatter(formatter)
-    sys_handler.setFormatter(formatter)
-
-    logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, sys_handler])
+    log_setup.setup_logging("log/insert_etf_stocks.log", file_level=logging.DEBUG)
     logger = logging.getLogger(__name__)
 
     logger.info("Starting Program...")
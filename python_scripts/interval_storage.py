@@ -0,0 +1,377 @@
+import logging
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+# storage modes for daily_pull, set in the [storage] section of config.ini
+ROWS = "rows"
+INTERVALS = "intervals"
+BOTH = "both"
+STORAGE_MODES = (ROWS, INTERVALS, BOTH)
+# table or view with rows shaped like etf_holdings in each mode
+HOLDINGS_TABLES = {
+    ROWS: "etf_holdings",
+    INTERVALS: "etf_snapshot_holdings",
+    BOTH: "etf_holdings",
+}
+
+# versioned in etf_positions, prices move daily and are kept in stock_prices
+VALUE_COLS = ["num_shares", "weight"]
+PRICE_COLS = ["market_value", "average_price"]
+CENT = Decimal("0.01")
+
+OPEN_POSITIONS_QUERY = """
+    SELECT stock_id, valid_from, num_shares, weight
+    FROM etf_positions
+    WHERE etf_id = %s AND valid_to IS NULL;
+"""
+
+# each etf rebuilt from its latest snapshot on or before the date
+AS_OF_QUERY = """
+    WITH snapshots AS (
+        SELECT etf_id, MAX(dt) AS dt
+        FROM etf_snapshot_dates
+        WHERE
+            dt <= %(dt)s
+            AND (%(etf_id)s IS NULL OR etf_id = %(etf_id)s)
+        GROUP BY etf_id
+    )
+    SELECT
+        h.etf_id,
+        h.stock_id,
+        %(dt)s::DATE AS dt,
+        h.num_shares,
+        h.weight,
+        h.market_value,
+        h.average_price
+    FROM
+        snapshots d
+        JOIN etf_snapshot_holdings h ON h.etf_id = d.etf_id
+        AND h.dt = d.dt
+    ORDER BY
+        h.etf_id,
+        h.stock_id;
+"""
+
+RANGE_QUERY = """
+    SELECT
+        etf_id,
+        stock_id,
+        dt,
+        num_shares,
+        weight,
+        market_value,
+        average_price
+    FROM
+        etf_snapshot_holdings
+    WHERE
+        dt BETWEEN %(start)s AND %(end)s
+        AND (%(etf_id)s IS NULL OR etf_id = %(etf_id)s)
+    ORDER BY
+        dt,
+        etf_id,
+        stock_id;
+"""
+
+
+def holdings_table(storage_mode: str) -> str:
+    """Where readers of daily holdings find them with a storage mode"""
+    return HOLDINGS_TABLES.get(storage_mode, HOLDINGS_TABLES[ROWS])
+
+
+def snapshot_loaded(conn: psycopg2.extensions.connection, etf_id, dt) -> bool:
+    """Check whether a snapshot was already applied to etf_positions
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id: id of the etf
+        dt: the as-of date of the snapshot
+
+    Returns:
+        bool: True if (etf_id, dt) is in etf_snapshot_dates
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM etf_snapshot_dates WHERE etf_id = %s AND dt = %s);",
+            (int(etf_id), dt),
+        )
+        return cursor.fetchone()[0]
+
+
+def as_decimal(value) -> Optional[Decimal]:
+    """The decimal a float is stored as in a NUMERIC column, None for NaN"""
+    if value is None or pd.isna(value):
+        return None
+    return Decimal(repr(float(value)))
+
+
+def store_prices(
+    cursor: psycopg2.extensions.cursor, etf_id: int, dt: date, new: pd.DataFrame
+) -> int:
+    """Record the market value and price of every position of a snapshot
+
+    The first etf applied on a date writes the price and market value per
+    share of its stocks to stock_prices. Positions whose values these do not
+    reproduce to the cent are stored in etf_position_values instead.
+
+    Args:
+        cursor (psycopg2.extensions.cursor): cursor of the apply_snapshot transaction
+        etf_id (int): id of the etf
+        dt (date): the as-of date of the snapshot
+        new (pd.DataFrame): stock_id, VALUE_COLS and PRICE_COLS of the snapshot
+
+    Returns:
+        int: number of positions stored in etf_position_values
+    """
+    rows = [
+        (int(stock_id), as_decimal(shares), as_decimal(value), as_decimal(price))
+        for stock_id, shares, value, price in new[
+            ["stock_id", "num_shares", "market_value", "average_price"]
+        ].itertuples(index=False, name=None)
+    ]
+    cursor.execute(
+        "DELETE FROM etf_position_values WHERE etf_id = %s AND dt = %s;", (etf_id, dt)
+    )
+    if not rows:
+        return 0
+    psycopg2.extras.execute_values(
+        cursor,
+        """
+        INSERT INTO stock_prices (stock_id, dt, average_price, unit_value)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        """,
+        [
+            (stock_id, dt, price, value, shares)
+            for stock_id, shares, value, price in rows
+        ],
+        template="(%s, %s::DATE, %s::NUMERIC, %s::NUMERIC / NULLIF(%s::NUMERIC, 0))",
+    )
+    cursor.execute(
+        "SELECT stock_id, average_price, unit_value FROM stock_prices "
+        "WHERE dt = %s AND stock_id = ANY(%s);",
+        (dt, [row[0] for row in rows]),
+    )
+    stored = {stock_id: (price, unit) for stock_id, price, unit in cursor.fetchall()}
+
+    overrides = []
+    for stock_id, shares, value, price in rows:
+        stored_price, unit = stored.get(stock_id, (None, None))
+        rebuilt = None
+        if shares is not None and unit is not None:
+            rebuilt = (shares * unit).quantize(CENT, rounding=ROUND_HALF_UP)
+        if rebuilt != value or stored_price != price:
+            overrides.append((etf_id, stock_id, dt, value, price))
+    if overrides:
+        psycopg2.extras.execute_values(
+            cursor,
+            """
+            INSERT INTO etf_position_values
+                (etf_id, stock_id, dt, market_value, average_price)
+            VALUES %s
+            """,
+            overrides,
+        )
+    return len(overrides)
+
+
+def apply_snapshot(
+    conn: psycopg2.extensions.connection, df: pd.DataFrame, commit: bool = True
+) -> dict:
+    """Record one day of an ETF's holdings as position intervals
+
+    A new version is written only for positions that are new or whose shares
+    or weight changed; removed and changed positions have their open version
+    closed at the snapshot date. Market values and prices move daily, they are
+    stored per snapshot by store_prices, so a snapshot rebuilt from the
+    intervals matches the loaded one exactly. Applying the same snapshot twice
+    is a no-op, but snapshots must otherwise be applied in date order.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        df (pd.DataFrame): output of groupby_and_convert_types for one etf and date
+        commit (bool): commit the transaction, False to leave it to the caller
+
+    Returns:
+        dict: number of positions added, changed, removed and unchanged, and
+            of positions with their own market value in etf_position_values
+    """
+    logger = logging.getLogger(__name__ + ".apply_snapshot")
+
+    etf_id = int(df["etf_id"].iloc[0])
+    dt = pd.to_datetime(df["dt"].iloc[0]).date()
+
+    new = df[["stock_id"] + VALUE_COLS + PRICE_COLS].copy()
+    new["stock_id"] = new["stock_id"].astype(int)
+
+    try:
+        with conn.cursor() as cursor:
+            # undo an earlier application of this same date
+            cursor.execute(
+                "DELETE FROM etf_positions WHERE etf_id = %s AND valid_from = %s;",
+                (etf_id, dt),
+            )
+            cursor.execute(
+                "UPDATE etf_positions SET valid_to = NULL WHERE etf_id = %s AND valid_to = %s;",
+                (etf_id, dt),
+            )
+
+            cursor.execute(OPEN_POSITIONS_QUERY, (etf_id,))
+            current = pd.DataFrame(
+                cursor.fetchall(),
+                columns=["stock_id", "valid_from"] + VALUE_COLS,
+            )
+            if not current.empty and (current["valid_from"] > dt).any():
+                raise ValueError(
+                    f"ETF {etf_id} has positions newer than {dt}, "
+                    "snapshots must be applied in date order"
+                )
+
+            merged = new[["stock_id"] + VALUE_COLS].merge(
+                current.drop(columns="valid_from"),
+                on="stock_id",
+                how="outer",
+                suffixes=("", "_open"),
+                indicator=True,
+            )
+            added = merged["_merge"] == "left_only"
+            removed = merged["_merge"] == "right_only"
+            both = merged["_merge"] == "both"
+            # values are rounded by groupby_and_convert_types and read back as
+            # the same decimals, so any difference is a real change
+            same = np.ones(len(merged), dtype=bool)
+            for col in VALUE_COLS:
+                value = merged[col].astype(float)
+                value_open = merged[f"{col}_open"].astype(float)
+                same &= (value == value_open) | (value.isna() & value_open.isna())
+            changed = both & ~same
+
+            to_close = merged.loc[removed | changed, "stock_id"]
+            if not to_close.empty:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    UPDATE etf_positions p
+                    SET valid_to = c.valid_to
+                    FROM (VALUES %s) AS c(etf_id, stock_id, valid_to)
+                    WHERE p.etf_id = c.etf_id
+                        AND p.stock_id = c.stock_id
+                        AND p.valid_to IS NULL
+                    """,
+                    [(etf_id, int(stock_id), dt) for stock_id in to_close],
+                    template="(%s, %s, %s::DATE)",
+                )
+
+            to_open = merged.loc[added | changed, ["stock_id"] + VALUE_COLS]
+            to_open = to_open.astype(object).where(to_open.notnull(), None)
+            if not to_open.empty:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    INSERT INTO etf_positions
+                        (etf_id, stock_id, valid_from, num_shares, weight)
+                    VALUES %s
+                    """,
+                    [
+                        (etf_id, int(row[0]), dt) + tuple(row[1:])
+                        for row in to_open.itertuples(index=False, name=None)
+                    ],
+                )
+
+            overrides = store_prices(cursor, etf_id, dt, new)
+            cursor.execute(
+                "INSERT INTO etf_snapshot_dates (etf_id, dt) VALUES (%s, %s) "
+                "ON CONFLICT DO NOTHING;",
+                (etf_id, dt),
+            )
+    except Exception:
+        conn.rollback()
+        raise
+
+    if commit:
+        conn.commit()
+    counts = {
+        "added": int(added.sum()),
+        "changed": int(changed.sum()),
+        "removed": int(removed.sum()),
+        "unchanged": int((both & ~changed).sum()),
+        "overrides": overrides,
+    }
+    logger.debug(f"ETF {etf_id} {dt}: {counts}")
+    return counts
+
+
+def rewind(conn: psycopg2.extensions.connection, etf_id: int, dt: date) -> pd.DataFrame:
+    """Undo every snapshot of an ETF from a date on, so older ones can be applied
+
+    Snapshots must be applied in date order: a backfill of an older date
+    rewinds the ETF to it, applies its snapshots and applies the returned
+    ones again. Runs in the caller's transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        etf_id (int): id of the etf
+        dt (date): first date to undo
+
+    Returns:
+        pd.DataFrame: the undone snapshots, rows shaped like etf_holdings
+    """
+    etf_id = int(etf_id)
+    undone = snapshots_between(conn, dt, date.max, etf_id)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM etf_positions WHERE etf_id = %s AND valid_from >= %s;",
+            (etf_id, dt),
+        )
+        cursor.execute(
+            "UPDATE etf_positions SET valid_to = NULL WHERE etf_id = %s AND valid_to >= %s;",
+            (etf_id, dt),
+        )
+        for table in ("etf_position_values", "etf_snapshot_dates"):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE etf_id = %s AND dt >= %s;", (etf_id, dt)
+            )
+    return undone
+
+
+def snapshot_as_of(
+    conn: psycopg2.extensions.connection, dt: date, etf_id: Optional[int] = None
+) -> pd.DataFrame:
+    """Rebuild the full holdings of every (or one) ETF on a date
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        dt (date): the date to rebuild
+        etf_id (int, optional): only rebuild this etf
+
+    Returns:
+        pd.DataFrame: rows shaped like etf_holdings
+    """
+    return pd.read_sql(AS_OF_QUERY, conn, params={"dt": dt, "etf_id": etf_id})
+
+
+def snapshots_between(
+    conn: psycopg2.extensions.connection,
+    start: date,
+    end: date,
+    etf_id: Optional[int] = None,
+) -> pd.DataFrame:
+    """Rebuild daily holdings for every snapshot date in a range
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        start (date): first date, inclusive
+        end (date): last date, inclusive
+        etf_id (int, optional): only rebuild this etf
+
+    Returns:
+        pd.DataFrame: rows shaped like etf_holdings, one set per snapshot date
+    """
+    return pd.read_sql(
+        RANGE_QUERY, conn, params={"start": start, "end": end, "etf_id": etf_id}
+    )
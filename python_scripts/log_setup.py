@@ -0,0 +1,96 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+from typing import Any, List, Optional
+
+LOG_FORMAT = "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
+# values kept as an example of an aggregated per-row event
+SAMPLE_SIZE = 5
+
+
+def setup_logging(
+    log_path: str,
+    file_level: int = logging.INFO,
+    stream_level: int = logging.INFO,
+    log_queue: Optional[Any] = None,
+) -> logging.handlers.QueueListener:
+    """Log to a file and the console from a background thread
+
+    The root logger only puts records on a queue, a listener thread formats
+    them and writes to the handlers, so logging never waits on the disk or
+    the terminal. The root level is the lowest handler level, calls below it
+    return before a record is built.
+
+    Args:
+        log_path (str): file the records are written to
+        file_level (int): lowest level written to the file
+        stream_level (int): lowest level written to the console
+        log_queue (optional): queue shared with worker processes (a
+            multiprocessing.Queue), default an in-process queue
+
+    Returns:
+        logging.handlers.QueueListener: the running listener, stopped at exit
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    file_handler = logging.FileHandler(log_path)
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(formatter)
+
+    sys_handler = logging.StreamHandler()
+    sys_handler.setLevel(stream_level)
+    sys_handler.setFormatter(formatter)
+
+    if log_queue is None:
+        log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, sys_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
+    use_queue(log_queue, min(file_level, stream_level))
+    return listener
+
+
+def use_queue(log_queue: Any, level: int = logging.INFO) -> None:
+    """Make a queue the only destination of the root logger
+
+    Also called in worker processes, with the multiprocessing.Queue given to
+    setup_logging, to send their records to the parent's listener.
+
+    Args:
+        log_queue: queue read by a QueueListener
+        level (int): lowest level put on the queue
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+
+class RowEvents:
+    """Count of a per-row event with the first few distinct values as a sample
+
+    Used in place of a log call per row: the loop only counts, one line is
+    logged once the loop is done.
+    """
+
+    def __init__(self, sample_size: int = SAMPLE_SIZE) -> None:
+        self.sample_size = sample_size
+        self.count = 0
+        self.sample: List[Any] = []
+
+    def add(self, value: Any) -> None:
+        self.count += 1
+        if len(self.sample) < self.sample_size and value not in self.sample:
+            self.sample.append(value)
+
+    def report(self, logger: logging.Logger, level: int, message: str) -> None:
+        """Log "<count> <message>, e.g. <sample>" if the event happened"""
+        if self.count and logger.isEnabledFor(level):
+            sample = ", ".join(str(value) for value in self.sample)
+            more = ", ..." if len(self.sample) == self.sample_size else ""
+            logger.log(level, f"{self.count} {message}, e.g. {sample}{more}")
@@ -0,0 +1,432 @@
+import configparser as cp
+import logging
+import os
+from datetime import date, datetime
+from os import listdir
+from os.path import isdir, join
+from typing import Iterable, List, Optional
+
+import duckdb
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import interval_storage
+import log_setup
+
+# default location of the date partitioned holdings archive
+ARCHIVE_PATH = "./data/holdings_parquet"
+PARTITION_PREFIX = "dt="
+PARTITION_FILE = "part-0.parquet"
+# parquet metadata key holding the row count and checksum a partition was
+# exported with
+STAMP_KEY = b"holdings_stamp"
+
+ARCHIVE_SCHEMA = pa.schema(
+    [
+        ("etf_id", pa.int32()),
+        ("stock_id", pa.int32()),
+        ("etf", pa.string()),
+        ("etf_name", pa.string()),
+        ("stock", pa.string()),
+        ("stock_name", pa.string()),
+        ("num_shares", pa.float64()),
+        ("weight", pa.float64()),
+        ("market_value", pa.float64()),
+        ("average_price", pa.float64()),
+    ]
+)
+
+EXPORT_QUERY = """
+    SELECT
+        h.etf_id,
+        h.stock_id,
+        s2.symbol AS etf,
+        s2.name AS etf_name,
+        s1.symbol AS stock,
+        s1.name AS stock_name,
+        h.num_shares::DOUBLE PRECISION AS num_shares,
+        h.weight::DOUBLE PRECISION AS weight,
+        h.market_value::DOUBLE PRECISION AS market_value,
+        h.average_price::DOUBLE PRECISION AS average_price
+    FROM
+        {holdings} h
+        LEFT JOIN stocks s1 ON h.stock_id = s1.id
+        LEFT JOIN stocks s2 ON h.etf_id = s2.id
+    WHERE
+        h.dt = %s
+"""
+
+# row count and an order independent checksum of every stored date, a date is
+# exported again when they no longer match its partition
+STAMP_QUERY = """
+    SELECT
+        dt,
+        COUNT(*) || ':' || COALESCE(SUM(hashtext(concat_ws(
+            ',', etf_id, stock_id, num_shares, weight, market_value, average_price
+        ))::BIGINT), 0) AS stamp
+    FROM
+        {holdings}
+    {where}
+    GROUP BY
+        dt
+"""
+
+# the archive partitions read straight from the files, the dt column comes from
+# the partition directory names
+SOURCE_QUERY = """(
+        SELECT
+            {columns},
+            CAST(dt AS DATE) AS dt
+        FROM
+            read_parquet('{files}', hive_partitioning=1)
+        {where}
+    ) holdings"""
+
+TOP_CHANGES_QUERY = """
+    WITH change AS (
+        SELECT
+            etf,
+            etf_name,
+            stock,
+            stock_name,
+            dt,
+            market_value - LAG(market_value) OVER (
+                PARTITION BY etf_id, stock_id ORDER BY dt
+            ) AS market_val_change,
+            num_shares - LAG(num_shares) OVER (
+                PARTITION BY etf_id, stock_id ORDER BY dt
+            ) AS shares_change
+        FROM
+            {holdings}
+    ),
+    ranked AS (
+        SELECT
+            change.*,
+            rank() OVER (
+                PARTITION BY etf ORDER BY shares_change DESC
+            ) AS rank
+        FROM
+            change
+        WHERE
+            dt = (SELECT MAX(dt) FROM {holdings})
+            AND shares_change IS NOT NULL
+    )
+    SELECT
+        etf,
+        etf_name,
+        stock,
+        stock_name,
+        dt,
+        shares_change,
+        market_val_change
+    FROM
+        ranked
+    WHERE
+        rank <= {top_n}
+        AND shares_change <> 0
+    ORDER BY
+        etf,
+        ABS(shares_change) DESC
+"""
+
+HISTORY_QUERY = """
+    SELECT
+        etf,
+        etf_name,
+        stock,
+        stock_name,
+        dt,
+        num_shares,
+        weight,
+        market_value,
+        num_shares - LAG(num_shares) OVER (
+            PARTITION BY etf_id, stock_id ORDER BY dt
+        ) AS shares_change,
+        market_value - LAG(market_value) OVER (
+            PARTITION BY etf_id, stock_id ORDER BY dt
+        ) AS market_val_change
+    FROM
+        {holdings}
+    {where}
+    ORDER BY
+        etf,
+        stock,
+        dt
+"""
+
+
+def archived_dates(archive_path: str = ARCHIVE_PATH) -> List[date]:
+    """List the dates that have a partition in the archive
+
+    Args:
+        archive_path (str): root directory of the parquet archive
+
+    Returns:
+        List[date]: sorted dates with a complete partition file
+    """
+    if not isdir(archive_path):
+        return []
+
+    dates = []
+    for name in listdir(archive_path):
+        if name.startswith(PARTITION_PREFIX) and os.path.isfile(
+            join(archive_path, name, PARTITION_FILE)
+        ):
+            dates.append(
+                datetime.strptime(name[len(PARTITION_PREFIX) :], "%Y-%m-%d").date()
+            )
+    return sorted(dates)
+
+
+def partition_path(archive_path: str, dt: date) -> str:
+    """Path of the parquet file holding a single date"""
+    return join(archive_path, f"{PARTITION_PREFIX}{dt:%Y-%m-%d}", PARTITION_FILE)
+
+
+def partition_stamp(archive_path: str, dt: date) -> Optional[str]:
+    """Row count and checksum a partition was exported with, read from its footer"""
+    metadata = pq.read_schema(partition_path(archive_path, dt)).metadata or {}
+    stamp = metadata.get(STAMP_KEY)
+    return stamp.decode() if stamp is not None else None
+
+
+def write_partition(
+    df: pd.DataFrame, archive_path: str, dt: date, stamp: Optional[str] = None
+) -> str:
+    """Write one date of holdings to the archive, replacing any existing partition
+
+    The file is written next to its final location and then renamed so readers
+    never see a half written partition.
+
+    Args:
+        df (pd.DataFrame): holdings for a single date with ARCHIVE_SCHEMA columns
+        archive_path (str): root directory of the parquet archive
+        dt (date): the date of the holdings
+        stamp (str, optional): row count and checksum from STAMP_QUERY, kept in
+            the file metadata
+
+    Returns:
+        str: path of the written partition file
+    """
+    path = partition_path(archive_path, dt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    table = pa.Table.from_pandas(
+        df[ARCHIVE_SCHEMA.names], schema=ARCHIVE_SCHEMA, preserve_index=False
+    )
+    if stamp is not None:
+        table = table.replace_schema_metadata({STAMP_KEY: stamp.encode()})
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_holdings_to_parquet(
+    conn: psycopg2.extensions.connection,
+    archive_path: str = ARCHIVE_PATH,
+    dates: Optional[Iterable[date]] = None,
+    storage_mode: str = interval_storage.ROWS,
+) -> List[date]:
+    """Bring the parquet archive up to date with the stored holdings
+
+    Every holdings date whose row count or checksum differs from the one its
+    partition was written with is exported, which covers new dates, ETFs
+    loaded late in a day and older dates rewritten by a backfill.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        archive_path (str): root directory of the parquet archive
+        dates (Iterable[date], optional): export exactly these dates instead
+        storage_mode (str): read etf_holdings (rows, both) or the snapshots
+            rebuilt from etf_positions (intervals)
+
+    Returns:
+        List[date]: the dates that were written
+    """
+    logger = logging.getLogger(__name__ + ".export_holdings_to_parquet")
+
+    holdings = interval_storage.holdings_table(storage_mode)
+    with conn.cursor() as cursor:
+        if dates is None:
+            cursor.execute(STAMP_QUERY.format(holdings=holdings, where=""))
+        else:
+            cursor.execute(
+                STAMP_QUERY.format(holdings=holdings, where="WHERE dt = ANY(%s)"),
+                (list(dates),),
+            )
+        stamps = dict(cursor.fetchall())
+
+    if dates is None:
+        done = set(archived_dates(archive_path))
+        to_export = {
+            dt
+            for dt, stamp in stamps.items()
+            if dt not in done or partition_stamp(archive_path, dt) != stamp
+        }
+    else:
+        to_export = set(dates)
+
+    exported = []
+    for dt in sorted(to_export):
+        df = pd.read_sql(EXPORT_QUERY.format(holdings=holdings), conn, params=(dt,))
+        write_partition(df, archive_path, dt, stamps.get(dt))
+        logger.info(f"Exported {df.shape[0]} holdings for {dt}")
+        exported.append(dt)
+
+    return exported
+
+
+def holdings_source(
+    archive_path: str = ARCHIVE_PATH,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> str:
+    """FROM clause reading a date range of the archive straight from its files
+
+    The dates are filtered on the partition column, so duckdb only opens the
+    partitions inside the range instead of the whole archive.
+
+    Args:
+        archive_path (str): root directory of the parquet archive
+        start (date, optional): first date to include
+        end (date, optional): last date to include
+
+    Returns:
+        str: a `holdings` subquery with the ARCHIVE_SCHEMA columns and dt
+    """
+    files = join(archive_path, f"{PARTITION_PREFIX}*", PARTITION_FILE)
+    conditions = []
+    if start is not None:
+        conditions.append(f"dt >= '{start:%Y-%m-%d}'")
+    if end is not None:
+        conditions.append(f"dt <= '{end:%Y-%m-%d}'")
+    return SOURCE_QUERY.format(
+        columns=", ".join(ARCHIVE_SCHEMA.names),
+        files=files.replace("'", "''"),
+        where="WHERE " + " AND ".join(conditions) if conditions else "",
+    )
+
+
+def query_archive(
+    query: str,
+    archive_path: str = ARCHIVE_PATH,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    params: Optional[list] = None,
+    **fields,
+) -> pd.DataFrame:
+    """Run a duckdb query against a date range of the archive
+
+    Args:
+        query (str): duckdb query with a {holdings} placeholder for the source
+            and ? placeholders for params
+        archive_path (str): root directory of the parquet archive
+        start (date, optional): first date to include
+        end (date, optional): last date to include
+        params (list, optional): values of the ? placeholders
+        **fields: values of the other placeholders of query
+
+    Returns:
+        pd.DataFrame: the result of the query, empty when no partition is in
+            the range
+    """
+    con = duckdb.connect()
+    try:
+        if any(
+            (start is None or dt >= start) and (end is None or dt <= end)
+            for dt in archived_dates(archive_path)
+        ):
+            source = holdings_source(archive_path, start, end)
+        else:
+            # read_parquet fails on a glob without files
+            con.register(
+                "empty_archive",
+                ARCHIVE_SCHEMA.empty_table().append_column(
+                    "dt", pa.array([], type=pa.date32())
+                ),
+            )
+            source = "empty_archive holdings"
+        return con.execute(
+            query.format(holdings=source, **fields), params or []
+        ).fetchdf()
+    finally:
+        con.close()
+
+
+def get_top_changes(archive_path: str = ARCHIVE_PATH, top_n: int = 5) -> pd.DataFrame:
+    """Top one day share changes per ETF, computed from the parquet archive
+
+    Returns the same columns as the dashboard's etf_holdings query.
+
+    Args:
+        archive_path (str): root directory of the parquet archive
+        top_n (int): number of ranked changes to keep per ETF
+
+    Returns:
+        pd.DataFrame: top changes between the two latest archived dates
+    """
+    dates = archived_dates(archive_path)
+    return query_archive(
+        TOP_CHANGES_QUERY,
+        archive_path,
+        start=dates[-2] if len(dates) > 1 else None,
+        top_n=int(top_n),
+    )
+
+
+def get_holding_history(
+    etf: str,
+    stock: Optional[str] = None,
+    archive_path: str = ARCHIVE_PATH,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> pd.DataFrame:
+    """Daily position history with day over day changes for an ETF
+
+    Args:
+        etf (str): symbol of the ETF
+        stock (str, optional): only return the history of this stock
+        archive_path (str): root directory of the parquet archive
+        start (date, optional): first date to include
+        end (date, optional): last date to include
+
+    Returns:
+        pd.DataFrame: one row per (stock, date) ordered by stock and date
+    """
+    where = "WHERE etf = ?"
+    params = [etf]
+    if stock is not None:
+        where += " AND stock = ?"
+        params.append(stock)
+
+    return query_archive(HISTORY_QUERY, archive_path, start, end, params, where=where)
+
+
+def main() -> None:
+    log_setup.setup_logging("./python_scripts/log/parquet_archive.log")
+    logger = logging.getLogger(__name__)
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+    conn = psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+
+    archive_path = config.get("archive", "path", fallback=ARCHIVE_PATH)
+    logger.info(f"Exporting holdings to {archive_path}...")
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    exported = export_holdings_to_parquet(conn, archive_path, storage_mode=storage_mode)
+    logger.info(f"Exported {len(exported)} dates")
+    conn.close()
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+
+# default output locations for a daily_pull run
+JSON_PATH = "./python_scripts/log/daily_pull_metrics.json"
+TEXTFILE_PATH = "./python_scripts/log/daily_pull.prom"
+
+
+class PipelineMetrics:
+    """Collects per-stage and per-ETF timings and counters for a pipeline run
+
+    Stage timings are accumulated, so a stage timed once per ETF reports both
+    its total time and the time spent on every individual ETF. Safe to share
+    between threads.
+    """
+
+    def __init__(self, job: str = "daily_pull") -> None:
+        self.job = job
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self._start = time.perf_counter()
+        self.wall_seconds = 0.0
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "calls": 0})
+        self.counters = defaultdict(float)
+        self.etfs = defaultdict(lambda: {"stages": {}, "counters": {}})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str, etf_id: Optional[str] = None):
+        """Time the wrapped block as `stage`, optionally attributed to an ETF"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[stage]["seconds"] += elapsed
+                self.stages[stage]["calls"] += 1
+                if etf_id is not None:
+                    etf_stages = self.etfs[str(etf_id)]["stages"]
+                    etf_stages[stage] = etf_stages.get(stage, 0.0) + elapsed
+
+    def count(self, name: str, value: float = 1, etf_id: Optional[str] = None) -> None:
+        """Add to a run counter (rows, bytes, failures...), optionally per ETF"""
+        with self._lock:
+            self.counters[name] += value
+            if etf_id is not None:
+                etf_counters = self.etfs[str(etf_id)]["counters"]
+                etf_counters[name] = etf_counters.get(name, 0) + value
+
+    def finish(self) -> None:
+        """Mark the end of the run"""
+        self.finished_at = datetime.now()
+        self.wall_seconds = time.perf_counter() - self._start
+
+    def summary(self) -> dict:
+        """The run as a json serialisable dict"""
+        stages = {}
+        for stage, values in self.stages.items():
+            stages[stage] = dict(values)
+            rows = self.counters.get("rows_loaded", 0)
+            if values["seconds"] > 0 and rows:
+                stages[stage]["rows_per_sec"] = rows / values["seconds"]
+
+        return {
+            "job": self.job,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+            "wall_seconds": self.wall_seconds,
+            "stages": stages,
+            "counters": dict(self.counters),
+            "etfs": {etf: dict(values) for etf, values in self.etfs.items()},
+        }
+
+    def write_json(self, path: str = JSON_PATH) -> None:
+        """Write the run summary as json"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path: str = TEXTFILE_PATH) -> None:
+        """Write the run in the node_exporter textfile collector format
+
+        Per-ETF stage timings are exported too; with ~150 ETFs and a handful of
+        stages that stays well within a reasonable series count.
+        """
+        registry = CollectorRegistry()
+
+        Gauge(
+            "etf_pipeline_last_run_timestamp_seconds",
+            "Unix time the pipeline run finished",
+            ["job"],
+            registry=registry,
+        ).labels(self.job).set((self.finished_at or datetime.now()).timestamp())
+        Gauge(
+            "etf_pipeline_wall_seconds",
+            "Wall clock time of the pipeline run",
+            ["job"],
+            registry=registry,
+        ).labels(self.job).set(self.wall_seconds)
+
+        stage_seconds = Gauge(
+            "etf_pipeline_stage_seconds",
+            "Total time spent in a pipeline stage",
+            ["job", "stage"],
+            registry=registry,
+        )
+        stage_calls = Gauge(
+            "etf_pipeline_stage_calls",
+            "Number of times a pipeline stage ran",
+            ["job", "stage"],
+            registry=registry,
+        )
+        for stage, values in self.stages.items():
+            stage_seconds.labels(self.job, stage).set(values["seconds"])
+            stage_calls.labels(self.job, stage).set(values["calls"])
+
+        counter = Gauge(
+            "etf_pipeline_count",
+            "Pipeline counters such as rows and bytes",
+            ["job", "name"],
+            registry=registry,
+        )
+        for name, value in self.counters.items():
+            counter.labels(self.job, name).set(value)
+
+        etf_seconds = Gauge(
+            "etf_pipeline_etf_stage_seconds",
+            "Time spent in a pipeline stage for one ETF",
+            ["job", "etf_id", "stage"],
+            registry=registry,
+        )
+        for etf_id, values in self.etfs.items():
+            for stage, seconds in values["stages"].items():
+                etf_seconds.labels(self.job, etf_id, stage).set(seconds)
+
+        write_to_textfile(path, registry)
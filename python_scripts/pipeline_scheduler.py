@@ -0,0 +1,548 @@
+import argparse
+import configparser as cp
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from os.path import join
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import psycopg2
+
+import interval_storage
+import log_setup
+import run_manifest
+from csv_cleaning import load_stock_ids, read_ignore_ids
+from daily_pull import (
+    DERIVE_STEPS,
+    clear_temp_files,
+    load_etf,
+    prepare_etf,
+    write_run_metrics,
+)
+from holdings_scraping import download_etf_csv, download_timeout
+from pipeline_metrics import PipelineMetrics
+from run_manifest import MANIFEST_DIR, RunManifest
+
+# completion event read by the dashboard
+STATE_PATH = "./data/pipeline_state.json"
+# longest a single statement may run on a stage connection
+STATEMENT_TIMEOUT = 600
+# seconds a cancelled attempt has to stop before the stage gives up on retries
+CANCEL_GRACE = 300
+
+PENDING = "pending"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class StageTimeout(Exception):
+    """A stage attempt ran longer than its timeout"""
+
+
+@dataclass
+class Stage:
+    """A node of the pipeline DAG
+
+    Attributes:
+        name (str): unique name of the stage
+        func (Callable): called with the PipelineRun, may raise to fail
+        deps (Tuple[str]): stages that must succeed before this one starts
+        retries (int): extra attempts after a failure
+        backoff (float): seconds before the first retry, doubled every retry
+        timeout (float, optional): seconds an attempt may take
+    """
+
+    name: str
+    func: Callable[["PipelineRun"], Any]
+    deps: Tuple[str, ...] = ()
+    retries: int = 2
+    backoff: float = 30.0
+    timeout: Optional[float] = None
+
+
+@dataclass
+class PipelineRun:
+    """State shared by the stages of one pipeline run"""
+
+    config: cp.ConfigParser
+    manifest: RunManifest
+    metrics: PipelineMetrics
+    temp_path: str = "./data/temp"
+    storage_mode: str = interval_storage.ROWS
+    retry_failed_only: bool = False
+    workers: int = 8
+    started_at: datetime = field(default_factory=datetime.now)
+    urls: Optional[pd.DataFrame] = None
+    stock_ids: Optional[dict] = None
+    # holdings and exposure rows from prepare_etf, waiting to be loaded
+    cleaned: Dict[str, Tuple[pd.DataFrame, pd.DataFrame]] = field(default_factory=dict)
+    stage_states: Dict[str, dict] = field(default_factory=dict)
+    cancel: Dict[str, threading.Event] = field(default_factory=dict)
+
+    def connect(self) -> psycopg2.extensions.connection:
+        """A new connection for one stage, stages never share connections
+
+        Statements are bounded by [scheduler] statement_timeout, so a cancelled
+        stage is never stuck in the database for longer.
+        """
+        timeout = self.config.getint(
+            "scheduler", "statement_timeout", fallback=STATEMENT_TIMEOUT
+        )
+        return psycopg2.connect(
+            host=self.config["psql"]["host"],
+            database=self.config["psql"]["dbname"],
+            user=self.config["psql"]["user"],
+            password=self.config["psql"]["password"],
+            options=f"-c statement_timeout={timeout * 1000}",
+        )
+
+    def raise_if_cancelled(self, stage: str) -> None:
+        """Stop a stage attempt that run_stage has timed out"""
+        event = self.cancel.get(stage)
+        if event is not None and event.is_set():
+            raise StageTimeout(f"{stage} cancelled")
+
+
+def run_stage(stage: Stage, run: PipelineRun) -> Any:
+    """Run a stage with retries, exponential backoff and a per-attempt timeout
+
+    A timed out attempt is cancelled: the stage function stops at its next
+    raise_if_cancelled check, and its statements are bounded by the
+    connection's statement_timeout. The next attempt only starts once the
+    cancelled one has stopped, if it is still running after CANCEL_GRACE the
+    stage fails without further retries.
+
+    Args:
+        stage (Stage): the stage to run
+        run (PipelineRun): state of the run
+
+    Returns:
+        Any: the stage function's return value
+    """
+    logger = logging.getLogger(__name__ + ".run_stage")
+
+    for attempt in range(stage.retries + 1):
+        result = {}
+
+        def target():
+            try:
+                result["value"] = stage.func(run)
+            except BaseException as e:
+                result["error"] = e
+
+        logger.info(f"Stage {stage.name}: attempt {attempt + 1}")
+        cancel = run.cancel[stage.name] = threading.Event()
+        thread = threading.Thread(target=target, name=stage.name, daemon=True)
+        with run.metrics.timer(f"stage_{stage.name}"):
+            thread.start()
+            thread.join(stage.timeout)
+
+        if thread.is_alive():
+            error = StageTimeout(f"{stage.name} timed out after {stage.timeout}s")
+            cancel.set()
+            thread.join(CANCEL_GRACE)
+            if thread.is_alive():
+                # a retry would run next to the attempt that is still going
+                run.metrics.count(f"stage_failures_{stage.name}")
+                logger.error(f"Stage {stage.name} did not stop, not retrying")
+                raise error
+        else:
+            error = result.get("error")
+
+        if error is None:
+            logger.info(f"Stage {stage.name} succeeded")
+            return result.get("value")
+        run.metrics.count(f"stage_failures_{stage.name}")
+
+        logger.warning(f"Stage {stage.name} attempt {attempt + 1} failed: {error}")
+        if attempt < stage.retries:
+            time.sleep(stage.backoff * 2**attempt)
+
+    raise error
+
+
+def validate_dag(stages: List[Stage]) -> None:
+    """Raise ValueError on duplicate names, unknown dependencies or cycles"""
+    names = [s.name for s in stages]
+    if len(names) != len(set(names)):
+        raise ValueError("Stage names must be unique")
+    by_name = {s.name: s for s in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"{stage.name} depends on unknown stage {dep}")
+
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle through stage {name}")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in names:
+        visit(name)
+
+
+def run_dag(stages: List[Stage], run: PipelineRun, max_workers: int = 4) -> dict:
+    """Run stages as soon as their dependencies succeed, independent ones concurrently
+
+    Stages downstream of a failed stage are skipped.
+
+    Args:
+        stages (List[Stage]): the DAG
+        run (PipelineRun): state of the run
+        max_workers (int): stages that can run at the same time
+
+    Returns:
+        dict: stage name -> {"state": ..., "error": ...}
+    """
+    validate_dag(stages)
+    pending = {s.name: s for s in stages}
+    states = {s.name: {"state": PENDING} for s in stages}
+    run.stage_states = states
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            for name, stage in list(pending.items()):
+                dep_states = [states[d]["state"] for d in stage.deps]
+                if any(s in (FAILED, SKIPPED) for s in dep_states):
+                    states[name] = {"state": SKIPPED}
+                    del pending[name]
+                elif all(s == SUCCEEDED for s in dep_states):
+                    running[executor.submit(run_stage, stage, run)] = name
+                    del pending[name]
+
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    states[name] = {"state": SUCCEEDED}
+                except BaseException as e:
+                    states[name] = {"state": FAILED, "error": str(e)}
+
+    return states
+
+
+############################################
+# PIPELINE STAGES
+############################################
+def resolve_urls(run: PipelineRun) -> None:
+    """Read etf_urls and keep the etfs this run still has to download"""
+    conn = run.connect()
+    try:
+        urls = pd.read_sql("SELECT csv_url, etf_id FROM etf_urls;", conn)
+    finally:
+        conn.close()
+
+    ignore_id = read_ignore_ids()
+    for etf_id in urls["etf_id"].astype(str):
+        if etf_id in ignore_id:
+            run.manifest.mark(etf_id, run_manifest.SKIPPED)
+
+    keep = (
+        urls["etf_id"]
+        .astype(str)
+        .map(lambda etf_id: run.manifest.needs_work(etf_id, run.retry_failed_only))
+    )
+    run.urls = urls[keep]
+
+
+def refresh_symbol_map(run: PipelineRun) -> None:
+    """Load the symbol -> id map used to resolve tickers without per row queries"""
+    conn = run.connect()
+    try:
+        run.stock_ids = load_stock_ids(conn)
+    finally:
+        conn.close()
+
+
+def download(run: PipelineRun) -> None:
+    """Download every pending etf concurrently
+
+    Individual failures are recorded in the manifest. The stage only fails,
+    and so is retried, if nothing could be downloaded.
+    """
+    os.makedirs(run.temp_path, exist_ok=True)
+    timeout = download_timeout(run.config)
+
+    def fetch(row):
+        run.raise_if_cancelled("download")
+        path = join(run.temp_path, f"{row.etf_id}.csv")
+        if run.manifest.is_downloaded(row.etf_id, path):
+            return True
+        return download_etf_csv(
+            row.csv_url, row.etf_id, path, run.metrics, run.manifest, timeout
+        )
+
+    rows = list(run.urls.itertuples())
+    with ThreadPoolExecutor(max_workers=run.workers) as executor:
+        results = list(executor.map(fetch, rows))
+
+    if rows and not any(results):
+        raise RuntimeError(f"All {len(rows)} downloads failed")
+
+
+def clean(run: PipelineRun) -> None:
+    """Clean every downloaded file concurrently, skipping dates already loaded"""
+    conn = run.connect()
+    # only reads on this connection, no transaction to share between threads
+    conn.autocommit = True
+
+    def prepare(etf_id):
+        run.raise_if_cancelled("clean")
+        try:
+            prepared = prepare_etf(
+                conn,
+                join(run.temp_path, f"{etf_id}.csv"),
+                etf_id,
+                run.metrics,
+                run.manifest,
+                storage_mode=run.storage_mode,
+                stock_ids=run.stock_ids,
+            )
+            if prepared is not None:
+                run.cleaned[etf_id] = prepared
+        except Exception as e:
+            run.metrics.count("etfs_failed")
+            run.manifest.fail(etf_id, e)
+
+    todo = run.manifest.to_prepare(run.retry_failed_only)
+    try:
+        with ThreadPoolExecutor(max_workers=run.workers) as executor:
+            list(executor.map(prepare, todo))
+    finally:
+        conn.close()
+
+
+def load(run: PipelineRun) -> None:
+    """Store every cleaned etf, one transaction per etf"""
+    conn = run.connect()
+    try:
+        for etf_id, (df, exposures) in list(run.cleaned.items()):
+            run.raise_if_cancelled("load")
+            try:
+                load_etf(
+                    conn,
+                    df,
+                    etf_id,
+                    run.metrics,
+                    run.manifest,
+                    run.storage_mode,
+                    exposures,
+                )
+                run.metrics.count("etfs_loaded")
+                del run.cleaned[etf_id]
+            except Exception as e:
+                conn.rollback()
+                run.metrics.count("etfs_failed")
+                run.manifest.fail(etf_id, e)
+    finally:
+        conn.close()
+
+
+def derive_stage(step: Callable) -> Callable[[PipelineRun], None]:
+    """Turn a daily_pull derive step into a stage function"""
+
+    def stage(run: PipelineRun) -> None:
+        conn = run.connect()
+        try:
+            step(conn, run.config, run.manifest)
+        finally:
+            conn.close()
+
+    return stage
+
+
+def cleanup(run: PipelineRun) -> None:
+    """Remove or archive the temp files of finished etfs"""
+    clear_temp_files(
+        run.temp_path,
+        run.manifest,
+        run.config.get("archive", "raw_path", fallback=None),
+    )
+
+
+def data_version(run: PipelineRun) -> Tuple[Optional[str], str]:
+    """Latest as-of date in the run and a version string unique to the run"""
+    as_of = max(
+        (e["as_of"] for e in run.manifest.etfs.values() if e.get("as_of")),
+        default=None,
+    )
+    return as_of, f"{as_of}.{run.started_at:%Y%m%dT%H%M%S}"
+
+
+def write_state(run: PipelineRun, status: str, path: str = STATE_PATH) -> dict:
+    """Write the completion (or failure) event of a run atomically"""
+    as_of, version = data_version(run)
+    state = {
+        "status": status,
+        "data_version": version,
+        "as_of": as_of,
+        "started_at": run.started_at.isoformat(),
+        "finished_at": datetime.now().isoformat(),
+        "stages": run.stage_states,
+        "etfs": run.manifest.counts(),
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+    return state
+
+
+def publish(run: PipelineRun) -> None:
+    """Write the run metrics and announce the new data version"""
+    write_run_metrics(run.metrics, run.config)
+    write_state(
+        run,
+        "complete",
+        run.config.get("scheduler", "state_path", fallback=STATE_PATH),
+    )
+
+
+def build_stages() -> List[Stage]:
+    """resolve urls -> download -> clean -> load -> derived tables -> publish"""
+    derive = [
+        Stage(name, derive_stage(step), deps=("load",), retries=1, timeout=1_800)
+        for name, step in DERIVE_STEPS
+    ]
+    return (
+        [
+            Stage("resolve_urls", resolve_urls, retries=3, backoff=60, timeout=300),
+            Stage("symbol_map", refresh_symbol_map, retries=3, backoff=60, timeout=300),
+            Stage(
+                "download",
+                download,
+                deps=("resolve_urls",),
+                retries=3,
+                backoff=300,
+                timeout=1_800,
+            ),
+            Stage(
+                "clean",
+                clean,
+                deps=("download", "symbol_map"),
+                retries=1,
+                timeout=1_800,
+            ),
+            Stage("load", load, deps=("clean",), retries=2, backoff=60, timeout=3_600),
+        ]
+        + derive
+        + [
+            Stage("cleanup", cleanup, deps=("load",), retries=0, timeout=300),
+            Stage(
+                "publish",
+                publish,
+                deps=tuple(s.name for s in derive) + ("cleanup",),
+                retries=2,
+                backoff=10,
+                timeout=300,
+            ),
+        ]
+    )
+
+
+def run_pipeline(config: cp.ConfigParser, retry_failed_only: bool = False) -> dict:
+    """Run the pipeline DAG once and write its completion event
+
+    Args:
+        config (cp.ConfigParser): parsed config.ini
+        retry_failed_only (bool): only retry the etfs that failed earlier today
+
+    Returns:
+        dict: state of every stage
+    """
+    logger = logging.getLogger(__name__ + ".run_pipeline")
+
+    storage_mode = config.get("storage", "mode", fallback=interval_storage.ROWS)
+    if storage_mode not in interval_storage.STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {storage_mode}")
+
+    manifest = RunManifest.for_date(
+        manifest_dir=config.get("manifest", "path", fallback=MANIFEST_DIR)
+    )
+    run = PipelineRun(
+        config=config,
+        manifest=manifest,
+        metrics=PipelineMetrics("pipeline_scheduler"),
+        storage_mode=storage_mode,
+        retry_failed_only=retry_failed_only,
+        workers=config.getint("scheduler", "workers", fallback=8),
+    )
+
+    states = run_dag(build_stages(), run)
+    failed = [name for name, s in states.items() if s["state"] != SUCCEEDED]
+    if failed:
+        logger.error(f"Pipeline failed, stages not completed: {failed}")
+        write_state(
+            run, "failed", config.get("scheduler", "state_path", fallback=STATE_PATH)
+        )
+    else:
+        logger.info(f"Pipeline complete: {manifest.counts()}")
+    return states
+
+
+def next_run_at(at: str, now: Optional[datetime] = None) -> datetime:
+    """Next time of day matching HH:MM"""
+    now = now or datetime.now()
+    hour, minute = (int(x) for x in at.split(":"))
+    run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the etf pipeline on a schedule")
+    parser.add_argument(
+        "--at", default=None, help="time of day to run, HH:MM (default from config)"
+    )
+    parser.add_argument("--now", action="store_true", help="run once and exit")
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="only retry the etfs that failed earlier today",
+    )
+    opts = parser.parse_args()
+
+    log_setup.setup_logging("./python_scripts/log/pipeline_scheduler.log")
+    logger = logging.getLogger(__name__)
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+
+    if opts.now:
+        run_pipeline(config, retry_failed_only=opts.retry_failed)
+        return None
+
+    at = opts.at or config.get("scheduler", "at", fallback="08:00")
+    while True:
+        run_at = next_run_at(at)
+        logger.info(f"Next run at {run_at}")
+        time.sleep(max((run_at - datetime.now()).total_seconds(), 0))
+        try:
+            run_pipeline(config)
+        except Exception as e:
+            logger.error(f"Pipeline run crashed: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import date, datetime
+from os.path import isfile, join
+from typing import List, Optional
+
+# default directory for one manifest per run date
+MANIFEST_DIR = "./data/manifests"
+
+DOWNLOADED = "downloaded"
+CLEANED = "cleaned"
+LOADED = "loaded"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# states that do not need any more work in the current run
+DONE_STATES = (LOADED, SKIPPED)
+
+
+def file_sha256(path: str) -> str:
+    """sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """Per-ETF progress of a daily pull, persisted after every change
+
+    The manifest is a json file keyed by etf id. Every entry holds the last
+    state reached (downloaded, cleaned, loaded, failed, skipped), the sha256 of
+    the downloaded file and, for failures, the reason. A rerun on the same day
+    reads it back and only redoes the ETFs that are not finished.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.etfs = {}
+        self._lock = threading.RLock()
+        if isfile(path):
+            with open(path, "r") as f:
+                self.etfs = json.load(f).get("etfs", {})
+
+    @classmethod
+    def for_date(
+        cls, run_date: Optional[date] = None, manifest_dir: str = MANIFEST_DIR
+    ) -> "RunManifest":
+        """Open (or start) the manifest of a run date. Defaults to today."""
+        os.makedirs(manifest_dir, exist_ok=True)
+        run_date = run_date or date.today()
+        return cls(join(manifest_dir, f"daily_pull_{run_date:%Y-%m-%d}.json"))
+
+    def state(self, etf_id) -> Optional[str]:
+        """Last state reached by an ETF, None if it was never seen"""
+        return self.etfs.get(str(etf_id), {}).get("state")
+
+    def mark(self, etf_id, state: str, **fields) -> None:
+        """Record a new state for an ETF and save the manifest
+
+        Args:
+            etf_id: id of the etf
+            state (str): one of the module's state constants
+            **fields: extra values to store, e.g. sha256, rows or reason
+        """
+        with self._lock:
+            entry = self.etfs.setdefault(str(etf_id), {})
+            entry.update(fields)
+            entry["state"] = state
+            entry["updated_at"] = datetime.now().isoformat()
+            if state != FAILED:
+                entry.pop("reason", None)
+            self.save()
+
+    def fail(self, etf_id, reason) -> None:
+        """Mark an ETF as failed with the reason"""
+        self.mark(
+            etf_id, FAILED, failed_at_state=self.state(etf_id), reason=str(reason)
+        )
+
+    def is_downloaded(self, etf_id, path: str) -> bool:
+        """True if the file at path is the one recorded for this ETF"""
+        entry = self.etfs.get(str(etf_id), {})
+        return (
+            entry.get("state") in (DOWNLOADED, CLEANED, LOADED)
+            and isfile(path)
+            and entry.get("sha256") == file_sha256(path)
+        )
+
+    def needs_work(self, etf_id, retry_failed_only: bool = False) -> bool:
+        """Whether an ETF still has to be processed in this run
+
+        Args:
+            etf_id: id of the etf
+            retry_failed_only (bool): only ETFs that failed need work
+
+        Returns:
+            bool: True if the ETF has to be (re)processed
+        """
+        state = self.state(etf_id)
+        if retry_failed_only:
+            return state == FAILED
+        return state not in DONE_STATES
+
+    def to_prepare(self, retry_failed_only: bool = False) -> List[str]:
+        """Ids of the ETFs whose downloaded file still has to be cleaned and loaded
+
+        ETFs left cleaned by an interrupted run are included, their cleaned
+        holdings were only kept in memory. When retrying, so are ETFs that
+        failed after their file was downloaded.
+        """
+        with self._lock:
+            todo = self.with_state(DOWNLOADED, CLEANED)
+            if retry_failed_only:
+                todo += [
+                    etf_id
+                    for etf_id, e in self.etfs.items()
+                    if e.get("state") == FAILED
+                    and e.get("failed_at_state") in (DOWNLOADED, CLEANED)
+                    and not e.get("reason", "").startswith("download")
+                ]
+            return todo
+
+    def with_state(self, *states: str) -> List[str]:
+        """Ids of the ETFs currently in any of the given states"""
+        return [etf_id for etf_id, e in self.etfs.items() if e.get("state") in states]
+
+    def counts(self) -> dict:
+        """Number of ETFs per state"""
+        counts = {}
+        for entry in self.etfs.values():
+            counts[entry["state"]] = counts.get(entry["state"], 0) + 1
+        return counts
+
+    def save(self) -> None:
+        """Write the manifest atomically"""
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"etfs": self.etfs}, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,102 @@
+import json
+from typing import Dict
+
+import pandas as pd
+
+# columns of the etf table, in display order
+TABLE_COLS = [
+    "etf",
+    "etf_name",
+    "stock",
+    "stock_name",
+    "shares_change",
+    "market_val_change",
+    "dt",
+]
+# text columns shipped once per distinct value, rows hold an index into them
+DICTIONARY_COLS = ["etf_name", "stock", "stock_name", "dt"]
+MEASURE_COLS = ["shares_change", "market_val_change"]
+
+
+def encode_window(df: pd.DataFrame, dictionaries: Dict[str, dict]) -> dict:
+    """Columnar encoding of the changes of one window
+
+    Rows are grouped by etf and every etf maps to its slice of rows, so the
+    browser selects an etf without a scan and sorts only that slice.
+
+    Args:
+        df (pd.DataFrame): TABLE_COLS rows of one window
+        dictionaries (Dict[str, dict]): value -> code of every DICTIONARY_COLS
+            column, extended in place with the values of this window
+
+    Returns:
+        dict: offsets of every etf and one list per column
+    """
+    df = (
+        df[TABLE_COLS]
+        .assign(
+            etf=df["etf"].astype(str),
+            dt=pd.to_datetime(df["dt"]).dt.strftime("%Y-%m-%d"),
+        )
+        .sort_values("etf", kind="stable")
+        .reset_index(drop=True)
+    )
+
+    columns = {}
+    for col in DICTIONARY_COLS:
+        codes = dictionaries[col]
+        values = df[col].astype(str)
+        for value in values.unique():
+            codes.setdefault(value, len(codes))
+        columns[col] = values.map(codes).tolist()
+    for col in MEASURE_COLS:
+        columns[col] = [
+            None if pd.isna(value) else round(float(value), 2) for value in df[col]
+        ]
+
+    etfs = df["etf"].to_numpy()
+    offsets = {}
+    if len(etfs):
+        first = [0] + [i for i in range(1, len(etfs)) if etfs[i] != etfs[i - 1]]
+        last = first[1:] + [len(etfs)]
+        offsets = {etfs[start]: [start, end] for start, end in zip(first, last)}
+    return {"offsets": offsets, "columns": columns}
+
+
+def build_snapshot(windows: Dict[int, pd.DataFrame], version: str) -> dict:
+    """The dashboard's etf tables as one payload for a dcc.Store
+
+    Names, symbols and dates repeat across many rows, so they are stored once
+    in a dictionary per column and rows refer to them by position. The
+    payload is rebuilt once per data refresh and embedded in every page load.
+
+    Args:
+        windows (Dict[int, pd.DataFrame]): trading days -> changes over them
+        version (str): data version the snapshot was built from
+
+    Returns:
+        dict: json serialisable snapshot read by assets/snapshot_filter.js
+    """
+    dictionaries = {col: {} for col in DICTIONARY_COLS}
+    encoded = {
+        str(window): encode_window(df, dictionaries) for window, df in windows.items()
+    }
+    return {
+        "version": version,
+        "columns": TABLE_COLS,
+        "dictionaries": {col: list(codes) for col, codes in dictionaries.items()},
+        "windows": encoded,
+    }
+
+
+def payload_report(snapshot: dict, windows: Dict[int, pd.DataFrame]) -> str:
+    """One line summary of the size of a snapshot against plain records"""
+    encoded = len(json.dumps(snapshot, separators=(",", ":")))
+    plain = sum(
+        len(df[TABLE_COLS].astype(str).to_json(orient="records"))
+        for df in windows.values()
+    )
+    return (
+        f"snapshot {snapshot['version']}: {encoded / 1024:,.1f} KiB "
+        f"({plain / max(encoded, 1):.1f}x smaller than records)"
+    )
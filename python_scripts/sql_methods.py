@@ -1,10 +1,15 @@
 import configparser as cp
+import io
 import logging
 import logging.handlers
+import os
+import threading
+from typing import Iterator, List, Optional, Union
 
 import alpaca_trade_api as trade_api
 import pandas as pd
 import psycopg2
+import psycopg2.extras
 
 
 def insert_into_sql(
@@ -13,7 +18,9 @@ def insert_into_sql(
     conn: psycopg2.extensions.connection,
     insert_cols: list,
     on_conflict: str = "DO NOTHING",
-) -> None:
+    raise_errors: bool = False,
+    commit: bool = True,
+) -> int:
     """Insert values into a psql table
 
     Args:
@@ -22,6 +29,12 @@ def insert_into_sql(
         conn (psycopg2.extensions.connection): connection for database
         insert_cols (list): list of columns to get inputed into table
         on_conflict (str): how to handle conflicts in insert
+        raise_errors (bool): re-raise an error after the rollback instead of
+            returning 0
+        commit (bool): commit the transaction, False to leave it to the caller
+
+    Returns:
+        int: number of rows inserted, 0 if the insert was rolled back
     """
     logger = logging.getLogger(__name__ + ".insert_into_sql")
 
@@ -52,6 +65,7 @@ def insert_into_sql(
 
         # get the number of fillers needed
         str_fill = (" %s," * df.shape[1])[:-1]
+        inserted = 0
 
         try:
             for row in df.itertuples(index=False, name=None):
@@ -64,13 +78,177 @@ def insert_into_sql(
                     ON CONFLICT {on_conflict};
                 """
                 cursor.execute(query, row)
+                inserted += cursor.rowcount
 
         except Exception as e:
             logger.info(e)
             logger.info(row)
             conn.rollback()
+            if raise_errors:
+                raise
+            return 0
 
         else:
             logger.debug("Done inserting values.")
-            conn.commit()
-            logger.info("Changes commited. Closing connection...")
+            if commit:
+                conn.commit()
+                logger.info("Changes commited. Closing connection...")
+            return inserted
+
+
+def replace_holdings(
+    df: pd.DataFrame,
+    conn: psycopg2.extensions.connection,
+    insert_cols: list,
+    table_name: str = "etf_holdings",
+    commit: bool = True,
+) -> int:
+    """Idempotently load holdings, replacing every (etf_id, dt) present in df
+
+    The delete and the bulk insert run in one transaction, so loading the
+    same file twice leaves the table unchanged.
+
+    Args:
+        df (pd.DataFrame): holdings with etf_id and dt columns
+        conn (psycopg2.extensions.connection): connection for database
+        insert_cols (list): list of columns to get inputed into table
+        table_name (str): name of the holdings table
+        commit (bool): commit the transaction, False to leave it to the caller
+
+    Returns:
+        int: number of rows inserted
+    """
+    logger = logging.getLogger(__name__ + ".replace_holdings")
+
+    keys = list(df[["etf_id", "dt"]].drop_duplicates().itertuples(index=False))
+    df = df[insert_cols]
+    df = df.where(df.notnull(), None)
+
+    try:
+        with conn.cursor() as cursor:
+            for etf_id, dt in keys:
+                cursor.execute(
+                    f"DELETE FROM {table_name} WHERE etf_id = %s AND dt = %s;",
+                    (int(etf_id), dt),
+                )
+            psycopg2.extras.execute_values(
+                cursor,
+                f"INSERT INTO {table_name} ({', '.join(insert_cols)}) VALUES %s",
+                list(df.itertuples(index=False, name=None)),
+                page_size=1000,
+            )
+    except Exception:
+        conn.rollback()
+        raise
+
+    if commit:
+        conn.commit()
+    logger.debug(f"Replaced {len(keys)} (etf_id, dt) keys with {df.shape[0]} rows")
+    return df.shape[0]
+
+
+def holdings_loaded(conn: psycopg2.extensions.connection, etf_id, dt) -> bool:
+    """Check whether an etf already has holdings stored for a date
+
+    Args:
+        conn (psycopg2.extensions.connection): connection for database
+        etf_id: id of the etf
+        dt: the as-of date of the holdings
+
+    Returns:
+        bool: True if etf_holdings has rows for (etf_id, dt)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM etf_holdings WHERE etf_id = %s AND dt = %s);",
+            (int(etf_id), dt),
+        )
+        return cursor.fetchone()[0]
+
+
+def copy_sql(query: str, conn: psycopg2.extensions.connection, params=None) -> str:
+    """COPY statement writing the result of a query to stdout as csv
+
+    COPY takes no parameters, so they are bound into the query first.
+    """
+    query = query.strip().rstrip(";")
+    if params is not None:
+        with conn.cursor() as cursor:
+            query = cursor.mogrify(query, params).decode()
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+
+def read_sql_copy(
+    query: str,
+    conn: psycopg2.extensions.connection,
+    params=None,
+    parse_dates: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Read a query into a dataframe through COPY ... TO STDOUT
+
+    The server streams csv that pandas parses straight into typed columns,
+    instead of building a python tuple and Decimal per row like pd.read_sql.
+    Numbers come back as int64 or float64, NULL and empty text as NaN.
+
+    Args:
+        query (str): SELECT query, with %s or %(name)s placeholders
+        conn (psycopg2.extensions.connection): connection for database
+        params: values of the placeholders
+        parse_dates (List[str], optional): columns to parse as datetimes
+        chunksize (int, optional): yield frames of this many rows, parsed while
+            the server is still sending, instead of one frame
+
+    Returns:
+        Union[pd.DataFrame, Iterator[pd.DataFrame]]: the result, or an
+            iterator of chunks of it with chunksize
+    """
+    sql = copy_sql(query, conn, params)
+    # keep symbols such as NA as text
+    csv_args = dict(keep_default_na=False, na_values=[""], parse_dates=parse_dates)
+    if chunksize is None:
+        buffer = io.BytesIO()
+        with conn.cursor() as cursor:
+            cursor.copy_expert(sql, buffer)
+        buffer.seek(0)
+        return pd.read_csv(buffer, **csv_args)
+    return iter_sql_copy(sql, conn, chunksize, csv_args)
+
+
+def iter_sql_copy(
+    sql: str, conn: psycopg2.extensions.connection, chunksize: int, csv_args: dict
+) -> Iterator[pd.DataFrame]:
+    """Parse the output of a COPY statement in chunks as it arrives
+
+    A thread writes the COPY output into a pipe that pandas reads from, so
+    only the chunk being parsed and the pipe buffer are held in memory.
+    Stopping before the last chunk aborts the COPY, roll back the connection
+    before using it again.
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copy():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe, conn.cursor() as cursor:
+                cursor.copy_expert(sql, pipe)
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=copy, daemon=True)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            for chunk in pd.read_csv(pipe, chunksize=chunksize, **csv_args):
+                yield chunk
+    except Exception:
+        writer.join()
+        # a COPY that failed before writing leaves pandas nothing to parse,
+        # its own error is the one to report
+        if errors:
+            raise errors[0]
+        raise
+    finally:
+        writer.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,307 @@
+import argparse
+import configparser as cp
+import logging
+from os.path import isfile, join
+from typing import List, Optional
+
+import alpaca_trade_api as trade_api
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+import log_setup
+
+STOCK_DATA_PATH = "./data/original_stock_data"
+ETF_LIST_PATH = "./data/all_etfs.csv"
+# last list of active alpaca assets, used when the api is not reachable
+ALPACA_SNAPSHOT_PATH = "./data/original_stock_data/alpaca_assets.csv"
+# exchange listings, merged_stocks.csv is their union and is not read
+EXCHANGE_FILES = [
+    "tsx_stocks.csv",
+    "nyse_stocks.csv",
+    "nasdaq_stocks.csv",
+    "amex_stocks.csv",
+]
+STOCK_COLS = ["symbol", "name", "exchange", "country", "ipo_year"]
+
+
+def read_csv(path: str) -> pd.DataFrame:
+    """Read a listing csv, keeping symbols such as NA as text"""
+    return pd.read_csv(path, keep_default_na=False, na_values=[""], dtype=str)
+
+
+def alpaca_assets(config: cp.ConfigParser) -> pd.DataFrame:
+    """Active assets from the alpaca api, built in one pass
+
+    Args:
+        config (cp.ConfigParser): config with an [alpaca] section
+
+    Returns:
+        pd.DataFrame: symbol, name and exchange of every active asset
+    """
+    api = trade_api.REST(
+        config["alpaca"]["key"],
+        config["alpaca"]["secret"],
+        base_url=config["alpaca"]["url"],
+    )
+    return pd.DataFrame(
+        [
+            (asset.symbol, asset.name, asset.exchange)
+            for asset in api.list_assets(status="active")
+        ],
+        columns=["symbol", "name", "exchange"],
+    )
+
+
+def read_sources(
+    alpaca: Optional[pd.DataFrame] = None,
+    stock_data_path: str = STOCK_DATA_PATH,
+    etf_list_path: str = ETF_LIST_PATH,
+) -> pd.DataFrame:
+    """Read every symbol source into one frame, in priority order
+
+    The ishares etf list comes first, then the exchange listings, then alpaca,
+    so a symbol listed by several sources takes the values of the first one.
+
+    Args:
+        alpaca (pd.DataFrame, optional): output of alpaca_assets
+        stock_data_path (str): directory of the exchange listing csvs
+        etf_list_path (str): csv of the ishares etfs
+
+    Returns:
+        pd.DataFrame: STOCK_COLS rows from every source, duplicates included
+    """
+    etfs = read_csv(etf_list_path).rename(
+        columns={"Ticker": "symbol", "Name": "name", "IPO Date": "ipo_year"}
+    )
+    # the ishares canada etfs all list on the tsx
+    etfs["exchange"] = "TSX"
+
+    frames = [etfs]
+    for file in EXCHANGE_FILES:
+        listing = read_csv(join(stock_data_path, file))
+        frames.append(
+            listing.rename(
+                columns={
+                    "Cleaned Symbol": "symbol",
+                    "Name": "name",
+                    "Exchange": "exchange",
+                    "Country": "country",
+                    "IPO Year": "ipo_year",
+                    "IPO Date": "ipo_year",
+                }
+            ).drop(columns="Symbol")
+        )
+    if alpaca is not None:
+        frames.append(alpaca)
+
+    return pd.concat(frames, ignore_index=True).reindex(columns=STOCK_COLS)
+
+
+def normalize_stocks(df: pd.DataFrame) -> pd.DataFrame:
+    """Trim symbols and names and keep one row per symbol and exchange
+
+    Args:
+        df (pd.DataFrame): output of read_sources
+
+    Returns:
+        pd.DataFrame: STOCK_COLS, unique (symbol, exchange) pairs in source
+            priority order
+    """
+    df = df.copy()
+    # separators are kept as the sources write them (BRK/B), the stored rows
+    # and the holdings tickers matched against them use that form
+    df["symbol"] = df["symbol"].str.strip().str.upper()
+    df["name"] = df["name"].str.strip().str.replace(r"\s+", " ", regex=True)
+    for col in ["exchange", "country"]:
+        df[col] = df[col].str.strip().replace("", np.nan)
+    df["ipo_year"] = pd.to_numeric(df["ipo_year"], errors="coerce").astype("Int64")
+
+    df = df.dropna(subset=["symbol", "name", "exchange"])
+    df = df[df["symbol"] != ""]
+    return df.drop_duplicates(subset=["symbol", "exchange"], keep="first").reset_index(
+        drop=True
+    )
+
+
+def read_stocks(conn: psycopg2.extensions.connection) -> pd.DataFrame:
+    """The current stocks table"""
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(STOCK_COLS)} FROM stocks;")
+        df = pd.DataFrame(cursor.fetchall(), columns=STOCK_COLS)
+    df["ipo_year"] = df["ipo_year"].astype("Int64")
+    return df
+
+
+def diff_stocks(current: pd.DataFrame, wanted: pd.DataFrame) -> tuple:
+    """Split the wanted symbols into new rows, changed rows and collisions
+
+    A new symbol takes the values of its first source. A stored symbol is only
+    updated from a listing on its stored exchange, the holdings reference its
+    id: the same ticker on another exchange (CLF on the NYSE and the TSX) is a
+    different security and is reported as a collision instead. A value missing
+    from the sources never overwrites a stored value.
+
+    Args:
+        current (pd.DataFrame): output of read_stocks
+        wanted (pd.DataFrame): output of normalize_stocks
+
+    Returns:
+        tuple: (rows to insert, rows to update, collisions), STOCK_COLS frames,
+            the collisions with the stored exchange as exchange_db
+    """
+    stored = wanted["symbol"].isin(current["symbol"])
+    new = wanted[~stored].drop_duplicates(subset="symbol", keep="first")
+
+    merged = wanted[stored].merge(
+        current, on=["symbol", "exchange"], how="inner", suffixes=("", "_db")
+    )
+    changed = pd.Series(False, index=merged.index)
+    for col in ["name", "country", "ipo_year"]:
+        value = merged[col].astype(object)
+        stored_value = merged[f"{col}_db"].astype(object)
+        changed |= value.notna() & (stored_value.isna() | (value != stored_value))
+
+    collisions = (
+        wanted[stored & ~wanted["symbol"].isin(merged["symbol"])]
+        .drop_duplicates(subset="symbol", keep="first")
+        .merge(current[["symbol", "exchange"]], on="symbol", suffixes=("", "_db"))
+    )
+    return (
+        new[STOCK_COLS],
+        merged.loc[changed, STOCK_COLS],
+        collisions[STOCK_COLS + ["exchange_db"]],
+    )
+
+
+def to_records(df: pd.DataFrame) -> List[tuple]:
+    """Rows as tuples with None for missing values"""
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def apply_changes(
+    conn: psycopg2.extensions.connection,
+    inserts: pd.DataFrame,
+    updates: pd.DataFrame,
+) -> None:
+    """Insert and update stocks in bulk, in one transaction
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        inserts (pd.DataFrame): new rows from diff_stocks
+        updates (pd.DataFrame): changed rows from diff_stocks
+    """
+    try:
+        with conn.cursor() as cursor:
+            if not inserts.empty:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f"INSERT INTO stocks ({', '.join(STOCK_COLS)}) VALUES %s "
+                    "ON CONFLICT (symbol) DO NOTHING",
+                    to_records(inserts),
+                    page_size=1_000,
+                )
+            if not updates.empty:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    UPDATE stocks s
+                    SET
+                        name = COALESCE(u.name, s.name),
+                        country = COALESCE(u.country, s.country),
+                        ipo_year = COALESCE(u.ipo_year, s.ipo_year)
+                    FROM (VALUES %s) AS u(symbol, name, exchange, country, ipo_year)
+                    WHERE s.symbol = u.symbol AND s.exchange = u.exchange
+                    """,
+                    to_records(updates),
+                    template="(%s, %s, %s, %s, %s::INTEGER)",
+                    page_size=1_000,
+                )
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def sync_stocks(
+    conn: psycopg2.extensions.connection,
+    alpaca: Optional[pd.DataFrame] = None,
+    dry_run: bool = False,
+) -> dict:
+    """Bring the stocks table in line with every symbol source
+
+    Stocks are never deleted, their ids are referenced by the holdings.
+
+    Args:
+        conn (psycopg2.extensions.connection): database connection object
+        alpaca (pd.DataFrame, optional): output of alpaca_assets
+        dry_run (bool): only report the changes
+
+    Returns:
+        dict: number of listings read, symbols inserted and updated, and stored
+            symbols only listed on another exchange
+    """
+    logger = logging.getLogger(__name__ + ".sync_stocks")
+
+    wanted = normalize_stocks(read_sources(alpaca))
+    inserts, updates, collisions = diff_stocks(read_stocks(conn), wanted)
+    counts = {
+        "symbols": wanted.shape[0],
+        "inserted": inserts.shape[0],
+        "updated": updates.shape[0],
+        "collisions": collisions.shape[0],
+    }
+    logger.info(f"Symbol master: {counts}")
+    events = log_setup.RowEvents()
+    for row in collisions.itertuples(index=False):
+        events.add(f"{row.symbol} ({row.exchange_db}, not {row.exchange})")
+    events.report(logger, logging.WARNING, "stored symbols left as they are")
+    if not dry_run:
+        apply_changes(conn, inserts, updates)
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sync the stocks table")
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="use the last alpaca snapshot instead of calling the api",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="report the changes only"
+    )
+    opts = parser.parse_args()
+
+    log_setup.setup_logging(
+        "./python_scripts/log/sync_stocks.log", file_level=logging.DEBUG
+    )
+    logger = logging.getLogger(__name__)
+
+    config = cp.ConfigParser()
+    config.read("./python_scripts/config.ini")
+
+    alpaca = None
+    if not opts.offline:
+        try:
+            alpaca = alpaca_assets(config)
+            alpaca.to_csv(ALPACA_SNAPSHOT_PATH, index=False)
+        except Exception as e:
+            logger.warning(f"Alpaca api unavailable, using the snapshot: {e}")
+    if alpaca is None and isfile(ALPACA_SNAPSHOT_PATH):
+        alpaca = read_csv(ALPACA_SNAPSHOT_PATH)
+
+    conn = psycopg2.connect(
+        host=config["psql"]["host"],
+        database=config["psql"]["dbname"],
+        user=config["psql"]["user"],
+        password=config["psql"]["password"],
+    )
+    sync_stocks(conn, alpaca, dry_run=opts.dry_run)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import csv
+import os
+import random
+import string
+from datetime import date, datetime
+from os.path import join
+from typing import List, Optional
+
+HEADER = [
+    "Ticker",
+    "Name",
+    "Sector",
+    "Asset Class",
+    "Market Value",
+    "Weight (%)",
+    "Notional Value",
+    "Shares",
+    "Price",
+    "Location",
+    "Exchange",
+    "Currency",
+    "FX Rate",
+    "Market Currency",
+]
+SECTORS = [
+    "Financials",
+    "Energy",
+    "Materials",
+    "Industrials",
+    "Information Technology",
+    "Communication",
+    "Consumer Discretionary",
+    "Consumer Staples",
+    "Health Care",
+    "Utilities",
+    "Real Estate",
+]
+LOCATIONS = [
+    ("Canada", "Toronto Stock Exchange", "CAD"),
+    ("United States", "New York Stock Exchange Inc.", "USD"),
+    ("United States", "NASDAQ", "USD"),
+    ("United Kingdom", "London Stock Exchange", "GBP"),
+    ("Japan", "Tokyo Stock Exchange", "JPY"),
+]
+CURRENCIES = ["CAD", "USD", "EUR", "GBP", "JPY"]
+
+
+def generate_symbols(n: int, seed: int = 0) -> List[str]:
+    """Generate n unique ticker symbols
+
+    Args:
+        n (int): number of symbols
+        seed (int): random seed
+
+    Returns:
+        List[str]: unique upper case symbols of 2 to 5 letters
+    """
+    rng = random.Random(seed)
+    symbols = set()
+    while len(symbols) < n:
+        symbols.add(
+            "".join(
+                rng.choice(string.ascii_uppercase) for _ in range(rng.randint(2, 5))
+            )
+        )
+    return sorted(symbols)
+
+
+def format_number(value: float) -> str:
+    """Format a number the way blackrock does, e.g. 1,234.56"""
+    return f"{value:,.2f}"
+
+
+def holdings_rows(
+    n_rows: int,
+    symbols: Optional[List[str]] = None,
+    n_cash: int = 2,
+    n_fx: int = 2,
+    seed: int = 0,
+) -> List[list]:
+    """Generate the holding rows of a blackrock csv
+
+    Args:
+        n_rows (int): number of equity holdings
+        symbols (List[str], optional): symbols to draw holdings from
+        n_cash (int): number of "XXX CASH" rows
+        n_fx (int): number of "XXX/XXX" currency forward rows
+        seed (int): random seed
+
+    Returns:
+        List[list]: rows matching HEADER
+    """
+    rng = random.Random(seed)
+    if symbols is None:
+        symbols = generate_symbols(n_rows, seed)
+    tickers = rng.sample(symbols, min(n_rows, len(symbols)))
+
+    weights = [rng.paretovariate(1.2) for _ in tickers]
+    total_weight = sum(weights)
+    fund_value = rng.uniform(5e7, 5e9)
+
+    rows = []
+    for ticker, weight in zip(tickers, weights):
+        weight = weight / total_weight
+        price = rng.uniform(1, 500)
+        market_value = fund_value * weight
+        location, exchange, currency = rng.choice(LOCATIONS)
+        rows.append(
+            [
+                ticker,
+                f"{ticker} HOLDINGS INC",
+                rng.choice(SECTORS),
+                "Equity",
+                format_number(market_value),
+                f"{weight * 100:.2f}",
+                format_number(market_value),
+                format_number(round(market_value / price)),
+                format_number(price),
+                location,
+                exchange,
+                currency,
+                "1.00",
+                currency,
+            ]
+        )
+
+    for currency in rng.sample(CURRENCIES, n_cash):
+        value = rng.uniform(1e3, 1e6)
+        rows.append(
+            [
+                currency,
+                f"{currency} CASH",
+                "Cash and/or Derivatives",
+                "Cash",
+                format_number(value),
+                "0.01",
+                format_number(value),
+                format_number(value),
+                "100.00",
+                "Canada",
+                "-",
+                currency,
+                "1.00",
+                currency,
+            ]
+        )
+
+    for _ in range(n_fx):
+        pair = rng.sample(CURRENCIES, 2)
+        value = rng.uniform(-1e5, 1e5)
+        rows.append(
+            [
+                pair[0],
+                f"{pair[0]}/{pair[1]}",
+                "Cash and/or Derivatives",
+                "FX",
+                format_number(value),
+                "0.00",
+                format_number(value),
+                format_number(value),
+                "100.00",
+                "-",
+                "-",
+                pair[0],
+                "1.00",
+                pair[0],
+            ]
+        )
+
+    return rows
+
+
+def write_holdings_csv(
+    path: str,
+    n_rows: int = 500,
+    as_of: Optional[date] = None,
+    fund_name: str = "iShares Synthetic Index ETF",
+    symbols: Optional[List[str]] = None,
+    seed: int = 0,
+) -> str:
+    """Write a holdings file in the layout of a blackrock csv download
+
+    Args:
+        path (str): output file
+        n_rows (int): number of equity holdings
+        as_of (date, optional): "Fund Holdings as of" date. Defaults to today.
+        fund_name (str): name on the first line of the preamble
+        symbols (List[str], optional): symbols to draw holdings from
+        seed (int): random seed
+
+    Returns:
+        str: the path written
+    """
+    as_of = as_of or date.today()
+    rows = holdings_rows(n_rows, symbols=symbols, seed=seed)
+
+    with open(path, "w", newline="") as f:
+        f.write(f"{fund_name}\n")
+        f.write(f'Fund Holdings as of,"{as_of:%b %d, %Y}"\n')
+        f.write('Inception Date,"Jan 01, 2010"\n')
+        f.write(f'Shares Outstanding,"{format_number(n_rows * 1000)}"\n')
+        f.write('Stock,"-"\nBond,"-"\nCash,"-"\nOther,"-"\n \n')
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Write synthetic blackrock holdings files named <etf_id>.csv"
+    )
+    parser.add_argument("out_dir", help="directory to write the files to")
+    parser.add_argument("--etfs", type=int, default=150, help="number of files")
+    parser.add_argument("--rows", type=int, default=500, help="holdings per file")
+    parser.add_argument("--universe", type=int, default=5000, help="symbols to use")
+    parser.add_argument("--date", default=None, help="as-of date, YYYY-MM-DD")
+    parser.add_argument("--first-id", type=int, default=1, help="first etf id")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    opts = parser.parse_args()
+
+    as_of = datetime.strptime(opts.date, "%Y-%m-%d").date() if opts.date else None
+    symbols = generate_symbols(opts.universe, opts.seed)
+
+    os.makedirs(opts.out_dir, exist_ok=True)
+    for i in range(opts.etfs):
+        etf_id = opts.first_id + i
+        write_holdings_csv(
+            join(opts.out_dir, f"{etf_id}.csv"),
+            n_rows=opts.rows,
+            as_of=as_of,
+            symbols=symbols,
+            seed=opts.seed + etf_id,
+        )
+    return None
+
+
+if __name__ == "__main__":
+    main()
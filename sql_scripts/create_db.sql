@@ -21,9 +21,137 @@ CREATE TABLE etf_holdings (
     CONSTRAINT fk_stock FOREIGN KEY (stock_id) REFERENCES stocks (id)
 );
 
+CREATE INDEX etf_holdings_dt ON etf_holdings (dt, etf_id);
+
 CREATE TABLE etf_urls (
   etf_id INTEGER NOT NULL PRIMARY KEY,
   csv_url TEXT NOT NULL,
   base_url TEXT NOT NULL,
   CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id)
-);
\ No newline at end of file
+);
+
+-- optional delta encoded storage: one row per version of a position's shares
+-- and weight, valid from valid_from up to (not including) valid_to
+CREATE TABLE etf_positions (
+    etf_id INTEGER NOT NULL,
+    stock_id INTEGER NOT NULL,
+    valid_from DATE NOT NULL,
+    valid_to DATE,
+    num_shares NUMERIC,
+    weight NUMERIC,
+    PRIMARY KEY (etf_id, stock_id, valid_from),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id),
+    CONSTRAINT fk_stock FOREIGN KEY (stock_id) REFERENCES stocks (id)
+);
+
+CREATE INDEX etf_positions_open ON etf_positions (etf_id) WHERE valid_to IS NULL;
+CREATE INDEX etf_positions_range ON etf_positions (valid_from, valid_to);
+
+-- dates a snapshot was applied to etf_positions, used to rebuild daily snapshots
+CREATE TABLE etf_snapshot_dates (
+    etf_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    PRIMARY KEY (etf_id, dt),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id)
+);
+
+-- price and market value per share of a stock on a snapshot date, written by
+-- the first etf applied that day and shared by every other etf holding it
+CREATE TABLE stock_prices (
+    stock_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    average_price NUMERIC,
+    unit_value NUMERIC,
+    PRIMARY KEY (stock_id, dt),
+    CONSTRAINT fk_stock FOREIGN KEY (stock_id) REFERENCES stocks (id)
+);
+
+-- market value and price of the positions stock_prices does not reproduce,
+-- e.g. in a fund valued in another currency
+CREATE TABLE etf_position_values (
+    etf_id INTEGER NOT NULL,
+    stock_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    market_value NUMERIC,
+    average_price NUMERIC,
+    PRIMARY KEY (etf_id, stock_id, dt),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id),
+    CONSTRAINT fk_stock FOREIGN KEY (stock_id) REFERENCES stocks (id)
+);
+
+-- every applied snapshot rebuilt from the intervals, shaped like etf_holdings
+CREATE VIEW etf_snapshot_holdings AS
+SELECT
+    d.etf_id,
+    p.stock_id,
+    d.dt,
+    p.num_shares,
+    p.weight,
+    COALESCE(v.market_value, ROUND(p.num_shares * s.unit_value, 2)) AS market_value,
+    COALESCE(v.average_price, s.average_price) AS average_price
+FROM
+    etf_snapshot_dates d
+    JOIN etf_positions p ON p.etf_id = d.etf_id
+    AND p.valid_from <= d.dt
+    AND (p.valid_to IS NULL OR p.valid_to > d.dt)
+    LEFT JOIN stock_prices s ON s.stock_id = p.stock_id
+    AND s.dt = d.dt
+    LEFT JOIN etf_position_values v ON v.etf_id = d.etf_id
+    AND v.stock_id = p.stock_id
+    AND v.dt = d.dt;
+
+-- trading dates rolled into etf_flow_windows, per etf
+CREATE TABLE etf_flow_dates (
+    etf_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    PRIMARY KEY (etf_id, dt),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id)
+);
+
+-- net change of each position over the last window_days trading days,
+-- maintained incrementally by flow_windows.py, zero windows are not stored
+CREATE TABLE etf_flow_windows (
+    etf_id INTEGER NOT NULL,
+    window_days SMALLINT NOT NULL,
+    stock_id INTEGER NOT NULL,
+    shares_change NUMERIC NOT NULL,
+    market_val_change NUMERIC NOT NULL,
+    PRIMARY KEY (etf_id, window_days, stock_id),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id),
+    CONSTRAINT fk_stock FOREIGN KEY (stock_id) REFERENCES stocks (id)
+);
+
+-- per etf and snapshot: turnover against the previous snapshot and concentration
+CREATE TABLE etf_daily_metrics (
+    etf_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    positions INTEGER NOT NULL,
+    added INTEGER,
+    removed INTEGER,
+    turnover REAL,
+    top10_weight REAL,
+    hhi REAL,
+    PRIMARY KEY (etf_id, dt),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id)
+);
+
+-- sector, country and asset class names, referenced by their code
+CREATE TABLE holding_categories (
+    id SMALLSERIAL PRIMARY KEY,
+    dimension TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (dimension, name)
+);
+
+-- per etf and snapshot: weight and market value held in every category
+CREATE TABLE etf_exposures (
+    etf_id INTEGER NOT NULL,
+    dt DATE NOT NULL,
+    category_id SMALLINT NOT NULL,
+    positions INTEGER NOT NULL,
+    weight REAL,
+    market_value DOUBLE PRECISION,
+    PRIMARY KEY (etf_id, dt, category_id),
+    CONSTRAINT fk_etf FOREIGN KEY (etf_id) REFERENCES stocks (id),
+    CONSTRAINT fk_category FOREIGN KEY (category_id) REFERENCES holding_categories (id)
+);